@@ -1,13 +1,15 @@
 import os
 import sys
 import json
-import asyncio
+import logging
 from pathlib import Path
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import tempfile
+import uuid
 import shutil
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
 # Carica le variabili d'ambiente dal file .env
@@ -19,11 +21,24 @@ sys.path.insert(0, str(Path(__file__).parent / "formatting"))
 
 # Importa le dipendenze necessarie
 from chunker import Chunker, ChunkerConfig
+from checkpoint import CheckpointStore, job_key
+from retrieval import EmbeddingIndex, index_documents, answer_question
 from ingest.extractor import Ingest
-from formatting.accumulation import accumulation
+from formatting.accumulation import accumulation_async, accumulation_incremental_async
+from formatting.results import new_result_id, load_result, save_result
 from formatting.storing import store_answer, get_stored_documents
+from formatting.summary_index import (summary_id, load_summary, write_summary, remove_summary,
+                                      summary_exists_for, clear_index, sync_index, list_summaries)
+from formatting.search_index import index_document, remove_entry, clear_search_index, search
+from utils.uploadStore import UploadStore, UploadError
+from utils.asyncRuntime import getRuntime
+from utils.metrics import REGISTRY, JOBS, CACHE_LOOKUPS, JobTimings
+from utils.scheduler import jobContext, PRIORITY_CLASSES, INTERACTIVE, BULK
+from utils.cancellation import CancelToken, JobCancelled, JobRegistry, cancelScope
+from utils.usage import UsageLedger, UsageStore, usageScope
 
 app = Flask(__name__)
+log = logging.getLogger(__name__)
 
 # Configurazione CORS più esplicita
 CORS(app, resources={
@@ -35,9 +50,48 @@ CORS(app, resources={
 })
 
 # Configurazione
-app.config['MAX_CONTENT_LENGTH'] = 100 * 5000 * 2048  # 100MB max file size
+app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB per richiesta (file o blocco di upload)
 UPLOAD_FOLDER = Path(__file__).parent / "input"
 OUTPUT_FOLDER = Path(__file__).parent / "output"
+# "live" per le chiamate interattive, "batch" per i run notturni tramite Batch API
+EXECUTION_MODE = os.getenv("SUMMY_EXECUTION_MODE", "live")
+BATCH_FOLDER = OUTPUT_FOLDER / "batch"
+# Se attivo, il risultato riporta la quota di token di prompt serviti dalla cache
+MEASURE_CACHE = os.getenv("SUMMY_MEASURE_CACHE", "").lower() in {"1", "true", "yes"}
+# Indice di embedding dei chunk per /api/ask; disattivabile con SUMMY_EMBED_INDEX=0
+EMBED_INDEX = os.getenv("SUMMY_EMBED_INDEX", "1").lower() not in {"0", "false", "no"}
+EMBEDDINGS_FOLDER = OUTPUT_FOLDER / "embeddings"
+# Upload a blocchi ripristinabili: limite sul file intero, non sulla singola richiesta
+UPLOADS_FOLDER = OUTPUT_FOLDER / "uploads"
+UPLOAD_MAX_SIZE = int(os.getenv("SUMMY_UPLOAD_MAX_SIZE", 5 * 1024 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Checkpoint delle risposte del modello: un job interrotto riprende dall'ultima
+# chiamata completata. Disattivabile con SUMMY_STORE_PARTIALS=0
+STORE_PARTIALS = os.getenv("SUMMY_STORE_PARTIALS", "1").lower() not in {"0", "false", "no"}
+CHECKPOINT_FOLDER = Path(__file__).parent / ".chunk_temp"
+# Job con input oltre questa soglia (byte) passano in classe "bulk" se il client
+# non indica la priorità: cedono slot di estrazione e modello a quelli interactive
+BULK_THRESHOLD = int(os.getenv("SUMMY_BULK_THRESHOLD", 200 * 1024 * 1024))
+# Durata massima di un job in secondi (0 = nessun limite); il client può solo
+# accorciarla con il campo ``deadline``
+JOB_DEADLINE = float(os.getenv("SUMMY_JOB_DEADLINE", 0))
+# Job in corso annullabili con POST /api/jobs/<job_id>/cancel
+JOB_REGISTRY = JobRegistry(str(OUTPUT_FOLDER / "cancel"))
+# Budget di un job in token (prompt + output) e in dollari (0 = nessuno); il
+# client può solo abbassarli con il campo ``budget``. Superato il budget il job
+# si annulla come con /api/jobs/<job_id>/cancel
+JOB_MAX_TOKENS = int(os.getenv("SUMMY_JOB_MAX_TOKENS", 0))
+JOB_MAX_COST = float(os.getenv("SUMMY_JOB_MAX_COST", 0))
+# Modelli per fase (vedi summarize/routing.py): map economico, reduce forte e
+# escalation delle risposte non valide (SUMMY_MODEL_ESCALATION= la disattiva).
+# SUMMY_MODEL_ROUTES: regole JSON per tipo di documento e token del chunk
+MODEL_MAP = os.getenv("SUMMY_MODEL_MAP", "gpt-4o-mini")
+MODEL_REDUCE = os.getenv("SUMMY_MODEL_REDUCE", "gpt-4o")
+MODEL_ESCALATION = os.getenv("SUMMY_MODEL_ESCALATION", "gpt-4o") or None
+MODEL_ROUTES = json.loads(os.environ["SUMMY_MODEL_ROUTES"]) if os.getenv("SUMMY_MODEL_ROUTES") else None
+# Token, costi e latenze di ogni chiamata al modello, per i report (/api/usage)
+USAGE_STORE = UsageStore(str(OUTPUT_FOLDER / "usage.db"))
+upload_store = UploadStore(str(UPLOADS_FOLDER), UPLOAD_MAX_SIZE)
 ALLOWED_EXTENSIONS = {'pdf', 'txt', 'doc', 'docx', 'odt', 'rtf',
 	'ppt', 'pptx', 'odp', 'xlsx', 'xls', 'ods', 'csv',
 	'xml', 'json','jpg', 'jpeg', 'png', 'bmp', 'tiff', 'tif',
@@ -50,6 +104,57 @@ UPLOAD_FOLDER.mkdir(exist_ok=True, parents=True)
 (OUTPUT_FOLDER / "ingest").mkdir(exist_ok=True, parents=True)
 (OUTPUT_FOLDER / "summary").mkdir(exist_ok=True, parents=True)
 
+def request_tenant():
+    """Tenant per la ripartizione equa degli slot: header X-Tenant o indirizzo del client"""
+    return request.headers.get('X-Tenant', '').strip() or request.remote_addr
+
+@contextmanager
+def job_workspace():
+    """Cartelle ``(input, ingest)`` riservate a un job, rimosse alla fine.
+
+    Ogni richiesta lavora in ``input/<id>/`` e ``output/ingest/<id>/``: job
+    concorrenti non si cancellano i file a vicenda.
+    """
+    workspace_id = uuid.uuid4().hex
+    workspace = (UPLOAD_FOLDER / workspace_id, OUTPUT_FOLDER / "ingest" / workspace_id)
+    for directory in workspace:
+        directory.mkdir(parents=True)
+    try:
+        yield workspace
+    finally:
+        for directory in workspace:
+            shutil.rmtree(directory, ignore_errors=True)
+
+def job_priority(requested=None, preingested=None, input_dir=None):
+    """Classe richiesta dal client o, in mancanza, decisa dalla dimensione dell'input"""
+    if requested in PRIORITY_CLASSES:
+        return requested
+    size = sum(f.stat().st_size for f in input_dir.iterdir() if f.is_file()) if input_dir else 0
+    size += sum(len(d.get("content", "")) for d in preingested or [])
+    return BULK if size >= BULK_THRESHOLD else INTERACTIVE
+
+def job_limit(requested, server_limit):
+    """Il limite più stretto tra quello del client e quello del server (None = nessuno)"""
+    try:
+        requested = float(requested) if requested not in (None, "") else None
+    except (TypeError, ValueError):
+        requested = None
+    limits = [d for d in (requested, server_limit) if d and d > 0]
+    return min(limits) if limits else None
+
+def job_deadline(requested=None):
+    """Scadenza del job in secondi: la più breve tra quella del client e SUMMY_JOB_DEADLINE"""
+    return job_limit(requested, JOB_DEADLINE)
+
+def job_ledger(job_id, budget, token):
+    """Registro dei token del job con il budget del client (``{"tokens": ..., "cost_usd": ...}``)"""
+    budget = budget if isinstance(budget, dict) else {}
+    max_tokens = job_limit(budget.get("tokens"), JOB_MAX_TOKENS)
+    return UsageLedger(job_id if JOB_REGISTRY.validId(job_id) else uuid.uuid4().hex,
+                       maxTokens=int(max_tokens) if max_tokens else None,
+                       maxCost=job_limit(budget.get("cost_usd"), JOB_MAX_COST),
+                       cancelToken=token)
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -57,53 +162,69 @@ def allowed_file(filename):
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Endpoint per verificare che il server sia attivo"""
-    return jsonify({"status": "ok", "message": "Server is running"})
+    runtime = getRuntime()
+    if runtime.closing():
+        # Il worker sta drenando i job: il bilanciatore deve smettere di inviarne
+        return jsonify({"status": "draining", "inflight": runtime.inflight()}), 503
+    return jsonify({"status": "ok", "message": "Server is running", "inflight": runtime.inflight()})
+
+# Job in corso sul worker, letto dal runtime quando si scrive lo stato delle metriche
+REGISTRY.gauge("summy_jobs_inflight", "Job in esecuzione sui runtime dei worker",
+               callback=lambda: getRuntime().inflight())
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Metriche del server (tutti i worker) nel formato testuale di Prometheus"""
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route('/api/upload', methods=['POST'])
 def upload_files():
     """Endpoint per l'upload e l'elaborazione dei file"""
     try:
-        print("DEBUG: Inizio upload_files")
+        log.debug("Inizio upload_files")
 
         if 'files' not in request.files:
-            print("DEBUG: Nessun file nel request")
+            log.debug("Nessun file nel request")
             return jsonify({"error": "Nessun file fornito"}), 400
 
         files = request.files.getlist('files')
-        print(f"DEBUG: Ricevuti {len(files)} file")
+        log.debug(f"Ricevuti {len(files)} file")
 
         if not files or all(f.filename == '' for f in files):
-            print("DEBUG: Nessun file selezionato")
+            log.debug("Nessun file selezionato")
             return jsonify({"error": "Nessun file selezionato"}), 400
 
         # Raccoglie le keywords dal form
         keywords = request.form.getlist('keywords')
         keywords = [kw.strip() for kw in keywords if kw.strip()]  # Rimuove keywords vuote
-        print(f"DEBUG: Keywords ricevute: {keywords}")
+        log.debug(f"Keywords ricevute: {keywords}")
+
+        # Se presente, i nuovi file vengono aggiunti a un risultato esistente
+        result_id = request.form.get('result_id', '').strip() or None
 
-        # Rimuove tutti i file presenti nella cartella input prima di salvare i nuovi
-        for existing_file in UPLOAD_FOLDER.iterdir():
-            if existing_file.is_file():
-                existing_file.unlink()
+        unsupported = [f.filename for f in files if not (f and allowed_file(f.filename))]
+        if unsupported:
+            log.debug(f"Tipo di file non supportato: {unsupported[0]}")
+            return jsonify({"error": f"Tipo di file non supportato: {unsupported[0]}"}), 400
 
         uploaded_files = []
 
-        # Salva i file uploadati
-        for file in files:
-            if file and allowed_file(file.filename):
+        with job_workspace() as workspace:
+            # Salva i file uploadati nella cartella del job
+            for file in files:
                 filename = secure_filename(file.filename)
-                file_path = UPLOAD_FOLDER / filename
-                file.save(str(file_path))
+                file.save(str(workspace[0] / filename))
                 uploaded_files.append(filename)
-                print(f"DEBUG: Salvato file: {filename}")
-            else:
-                print(f"DEBUG: Tipo di file non supportato: {file.filename}")
-                return jsonify({"error": f"Tipo di file non supportato: {file.filename}"}), 400
+                log.debug(f"Salvato file: {filename}")
 
-        print("DEBUG: Inizio elaborazione file")
-        # Elabora i file con le keywords
-        result = process_files(keywords)
-        print(f"DEBUG: Risultato elaborazione: {result}")
+            log.debug("Inizio elaborazione file")
+            # Elabora i file con le keywords
+            result = process_files(keywords, result_id=result_id, workspace=workspace,
+                                   priority=request.form.get('priority'), tenant=request_tenant(),
+                                   job_id=request.form.get('job_id'), deadline=request.form.get('deadline'),
+                                   budget={"tokens": request.form.get('budget_tokens'),
+                                           "cost_usd": request.form.get('budget_cost_usd')})
+        log.debug(f"Risultato elaborazione: {result}")
 
         return jsonify({
             "message": "File caricati ed elaborati con successo",
@@ -113,116 +234,463 @@ def upload_files():
         })
 
     except Exception as e:
-        print(f"ERROR: Errore in upload_files: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"Errore in upload_files: {str(e)}")
         return jsonify({"error": f"Errore durante l'elaborazione: {str(e)}"}), 500
 
-def process_files(keywords=None):
-    """Elabora i file caricati attraverso il pipeline di ingest e summarization"""
+def process_files(keywords=None, result_id=None, preingested=None, priority=None, tenant=None,
+                  job_id=None, deadline=None, budget=None, workspace=None):
+    """Elabora i file caricati attraverso il pipeline di ingest e summarization.
+
+    Con ``result_id`` di un risultato esistente vengono riassunti solo i nuovi
+    file e l'accumulation li unisce in modo incrementale alla struttura salvata.
+    ``preingested`` contiene documenti già estratti in precedenza (stesso
+    contenuto): saltano l'ingest e si uniscono ai file di ``workspace``, la
+    coppia di cartelle ``(input, ingest)`` del job creata da job_workspace().
+    Il risultato riporta in ``timings`` la durata di ogni fase, in secondi.
+    ``priority`` ("interactive"/"bulk") e ``tenant`` decidono come il job
+    condivide estrazione e chiamate al modello con gli altri (utils/scheduler.py).
+    Il job si annulla con ``job_id`` (vedi cancel_job) o allo scadere di
+    ``deadline`` secondi: le chiamate in attesa non partono e il risultato
+    riporta ``cancelled``; i checkpoint restano per rilanciarlo.
+    ``usage`` riporta token, costo e latenza delle chiamate al modello per
+    fase, documento e modello; con un ``budget`` superato il job si annulla
+    (motivo "budget").
+    """
+    timings = JobTimings()
+    input_dir = workspace[0] if workspace else None
+    priority = job_priority(priority, preingested, input_dir)
+    token = CancelToken(job_deadline(deadline), job_id)
+    ledger = job_ledger(job_id, budget, token)
+    if JOB_REGISTRY.validId(job_id):
+        JOB_REGISTRY.register(job_id, token)
+    try:
+        with jobContext(priority, tenant), cancelScope(token), usageScope(ledger):
+            result = _run_pipeline(keywords, result_id, preingested, timings, workspace)
+    except JobCancelled as e:
+        result = {"error": f"Elaborazione annullata ({e.reason})", "cancelled": True, "reason": e.reason}
+    finally:
+        token.close()
+        if JOB_REGISTRY.validId(job_id):
+            JOB_REGISTRY.unregister(job_id)
+    status = "cancelled" if result.get("cancelled") else "error" if "error" in result else "success"
+    JOBS.inc(status=status)
+    result["timings"] = timings.report()
+    result["priority"] = priority
+    result["usage"] = ledger.report()
+    try:
+        USAGE_STORE.save(ledger, status=status, priority=priority, tenant=tenant,
+                         keywords=result.get("keywords_used", keywords))
+    except Exception as e:
+        log.warning(f"Salvataggio dell'uso dei token fallito: {str(e)}")
+    return result
+
+def _run_pipeline(keywords, result_id, preingested, timings, workspace=None):
+    preingested = preingested or []
+    # Loop e client condivisi del processo: niente asyncio.run per richiesta
+    runtime = getRuntime()
     try:
         # Directory
-        input_dir = UPLOAD_FOLDER
-        ingest_output_dir = OUTPUT_FOLDER / "ingest"
+        input_dir, ingest_output_dir = workspace or (None, None)
         summary_output_dir = OUTPUT_FOLDER / "summary"
 
         # Verifica presenza file
-        input_files = [f for f in input_dir.iterdir() if f.is_file()]
+        input_files = [f for f in input_dir.iterdir() if f.is_file()] if input_dir else []
 
-        if not input_files:
+        if not input_files and not preingested:
             return {"error": "Nessun file da elaborare"}
 
+        existing = load_result(result_id) if result_id else None
+        if existing and keywords and list(keywords) != list(existing.get("keywords") or []):
+            # Un focus diverso non si unisce a una struttura costruita con altre keywords
+            log.debug(f"keywords diverse da quelle del risultato {result_id}, nuovo risultato")
+            existing, result_id = None, None
+        if existing:
+            keywords = keywords or existing.get("keywords", [])
+
         # Fase 1: Ingest
-        Ingest(str(input_dir), str(ingest_output_dir))
+        if input_files:
+            with timings.stage("ingest"):
+                Ingest(str(input_dir), str(ingest_output_dir),
+                       on_document_saved=lambda doc: index_document("document", Path(doc["filename"]).stem, doc))
 
-        # Carica i file prodotti dall'ingest
-        ingest_files = list(ingest_output_dir.glob("*.json"))
+        # Carica solo i file prodotti dall'ingest per l'input corrente
+        ingest_files = [ingest_output_dir / f"{f.stem}.json" for f in input_files]
+        ingest_files = [f for f in ingest_files if f.exists()]
 
-        if not ingest_files:
+        if not ingest_files and not preingested:
             return {"error": "Nessun file prodotto dall'ingest"}
 
-        ingested_docs = []
+        ingested_docs = list(preingested)
         for json_file in ingest_files:
             with open(json_file, 'r', encoding='utf-8') as f:
                 doc_data = json.load(f)
                 ingested_docs.append(doc_data)
 
+        # Embedding dei chunk per le domande sull'archivio: solo i chunk mai visti costano
+        if EMBED_INDEX:
+            try:
+                docs_by_ref = {Path(d["filename"]).stem: d for d in ingested_docs}
+                with timings.stage("embeddings"):
+                    runtime.run(index_documents(EmbeddingIndex(EMBEDDINGS_FOLDER, client=runtime.client()), docs_by_ref))
+            except Exception as e:
+                log.warning(f"Indicizzazione embedding fallita: {str(e)}")
+
         # Fase 2: Summarization con keywords
         chunker_cfg = ChunkerConfig(
             max_tokens=1024,
+            adaptive_chunking=True,
             handle_audio_video=True,
-            model_map="gpt-4o",
-            model_reduce="gpt-4o",
-            max_concurrency=5
+            model_map=MODEL_MAP,
+            model_reduce=MODEL_REDUCE,
+            model_escalation=MODEL_ESCALATION,
+            model_routes=MODEL_ROUTES,
+            max_concurrency=5,
+            execution_mode=EXECUTION_MODE,
+            batch_dir=str(BATCH_FOLDER),
+            measure_cache=MEASURE_CACHE,
+            store_partials=STORE_PARTIALS,
+            checkpoint_dir=str(CHECKPOINT_FOLDER)
         )
-        chunker = Chunker(chunker_cfg)
+        chunker = Chunker(chunker_cfg, client=runtime.client())
+
+        # I riassunti hanno ID derivati da contenuto, configurazione e keywords:
+        # un input già visto con gli stessi parametri si riusa senza chiamare il modello
+        settings = chunker_cfg.output_settings()
+        summary_ids = [summary_id(d, settings, keywords) for d in ingested_docs]
+
+        previous_docs = []
+        replaced = False
+        if existing:
+            # Un file identico a uno già nel risultato non va riassunto di nuovo; uno con
+            # lo stesso nome ma contenuto diverso sostituisce il documento precedente
+            known = {d.get("summary_id") for d in existing.get("documents", [])}
+            fresh = [i for i, sid in enumerate(summary_ids) if sid not in known]
+            ingested_docs = [ingested_docs[i] for i in fresh]
+            summary_ids = [summary_ids[i] for i in fresh]
+            if not ingested_docs:
+                return {
+                    "status": "success",
+                    "result_id": result_id,
+                    "incremental": True,
+                    "files_processed": 0,
+                    "keywords_used": keywords or [],
+                    "accumulated_result": existing.get("result")
+                }
+            names = {d.get("filename") for d in ingested_docs}
+            previous_docs = [d for d in existing.get("documents", []) if d.get("filename") not in names]
+            replaced = len(previous_docs) < len(existing.get("documents", []))
+
+        cached = {sid: load_summary(summary_output_dir, sid) for sid in set(summary_ids)}
+        pending = [i for i, sid in enumerate(summary_ids) if cached[sid] is None]
+        CACHE_LOOKUPS.inc(len(ingested_docs) - len(pending), cache="summary", result="hit")
+        CACHE_LOOKUPS.inc(len(pending), cache="summary", result="miss")
+        log.debug(f"{len(ingested_docs) - len(pending)} riassunti riusati, {len(pending)} da calcolare")
 
         # Passa le keywords al chunker
         if keywords:
             chunker.set_keywords(keywords)
 
-        summarized_docs = asyncio.run(chunker.process_documents(ingested_docs))
-
-        # Salva i risultati del summarization
-        summary_files = []
-        for i, doc in enumerate(summarized_docs):
-            output_file = summary_output_dir / f"summary_{i}.json"
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(doc, f, indent=2, ensure_ascii=False)
-            summary_files.append(str(output_file))
+        computed = {}
+        if pending:
+            pending_docs = [ingested_docs[i] for i in pending]
+            with timings.stage("summarize"):
+                results = runtime.run(chunker.process_documents(pending_docs))
+            for i, doc in zip(pending, results):
+                computed[summary_ids[i]] = doc
+                if doc.get("fallback"):
+                    # Testo grezzo dopo un errore del modello: vale per questa risposta,
+                    # ma non finisce sotto l'ID del contenuto e la prossima volta si rifà
+                    continue
+                write_summary(summary_output_dir, summary_ids[i], doc)
+                index_document("summary", summary_ids[i], doc)
+
+        summarized_docs = [{**(cached[sid] or computed[sid]), "summary_id": sid} for sid in summary_ids]
 
         # Fase 3: Accumulation con keywords
         if summarized_docs:
-            accumulated_result = accumulation(summarized_docs, keywords)  # Passa le keywords
-
-            return {
+            batch_runner = chunker.batch_runner() if EXECUTION_MODE == "batch" else None
+            if existing:
+                keywords = keywords or existing.get("keywords", [])
+            # Stessi riassunti, keywords e risultato di partenza: stesso job, stessi checkpoint
+            checkpoint = (CheckpointStore(CHECKPOINT_FOLDER, job_key("accumulation", summary_ids, keywords, result_id))
+                          if STORE_PARTIALS and batch_runner is None else None)
+
+            with timings.stage("accumulation"):
+                if existing and not replaced:
+                    accumulated_result = runtime.run(accumulation_incremental_async(
+                        existing.get("result"), summarized_docs, keywords,
+                        client=runtime.client(), batch_runner=batch_runner, checkpoint=checkpoint,
+                        existing_documents=existing.get("documents")))
+                    all_docs = existing.get("documents", []) + summarized_docs
+                else:
+                    # Un documento sostituito è già dentro la struttura esistente: si rifà da capo
+                    if not existing:
+                        result_id = new_result_id()
+                    all_docs = previous_docs + summarized_docs
+                    accumulated_result = runtime.run(accumulation_async(  # Passa le keywords
+                        all_docs, keywords, client=runtime.client(), batch_runner=batch_runner,
+                        checkpoint=checkpoint))
+
+            if isinstance(accumulated_result, dict) and "error" not in accumulated_result:
+                save_result(result_id, accumulated_result, all_docs, keywords)
+                if checkpoint is not None:
+                    checkpoint.clear()
+
+            result = {
                 "status": "success",
-                "files_processed": len(input_files),
-                "summaries_created": len(summarized_docs),
+                "result_id": result_id,
+                "incremental": bool(existing) and not replaced,
+                "files_processed": len(input_files) + len(preingested),
+                "summaries_created": len(computed),
+                "summaries_reused": len(summarized_docs) - len(computed),
+                "summary_ids": summary_ids,
                 "keywords_used": keywords or [],
                 "accumulated_result": accumulated_result
             }
+            if MEASURE_CACHE:
+                result["prompt_cache"] = chunker.cache_report()
+            return result
 
         return {"status": "success", "files_processed": len(input_files)}
 
     except Exception as e:
         return {"error": f"Errore durante l'elaborazione: {str(e)}"}
 
-@app.route('/api/storico', methods=['GET'])
-def get_storico():
-    """Endpoint per recuperare lo storico dei documenti elaborati"""
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """Apre un upload a blocchi ripristinabile.
+
+    Body JSON: ``{"filename": ..., "size": ..., "sha256": ...}`` (sha256
+    opzionale, verificato a upload completo). I byte vanno sempre inviati: un
+    contenuto già noto non viene però salvato né estratto una seconda volta.
+    """
     try:
-        # Cerca tutti i file di summary nella directory output
-        summary_dir = OUTPUT_FOLDER / "summary"
-        summary_files = list(summary_dir.glob("*.json"))
+        payload = request.get_json(silent=True) or {}
+        filename = secure_filename(str(payload.get('filename', '')))
+        if not filename or not allowed_file(filename):
+            return jsonify({"error": f"Tipo di file non supportato: {payload.get('filename')}"}), 400
+
+        session = upload_store.createSession(filename, int(payload.get('size', -1)), payload.get('sha256') or None)
+        return jsonify({"status": "success", "chunk_size": UPLOAD_CHUNK_SIZE, **session}), 201
+
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Richiesta non valida: {str(e)}"}), 400
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Stato di un upload: il client riprende da ``offset``"""
+    try:
+        return jsonify({"status": "success", **upload_store.getSession(upload_id)})
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+def put_upload_chunk(upload_id):
+    """Riceve un blocco come corpo grezzo, scritto su disco mentre arriva.
+
+    L'offset del blocco va nell'header ``Upload-Offset`` (o nel parametro
+    ``offset``); un offset diverso da quello salvato restituisce 409 con
+    l'offset corretto.
+    """
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', 0)))
+        session = upload_store.writeChunk(upload_id, offset, request.stream)
+        return jsonify({"status": "success", **session})
 
-        documents = []
-        for file_path in summary_files:
+    except UploadError as e:
+        body = {"error": str(e)}
+        if e.status == 409:
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    doc_data = json.load(f)
-                    documents.append({
-                        "id": file_path.stem,
-                        "filename": file_path.name,
-                        "data": doc_data,
-                        "created_at": file_path.stat().st_mtime
-                    })
-            except Exception as e:
-                print(f"Errore nel caricare {file_path}: {e}")
-                continue
+                body["offset"] = upload_store.getSession(upload_id)["offset"]
+            except UploadError:
+                pass
+        return jsonify(body), e.status
+    except ValueError:
+        return jsonify({"error": "Upload-Offset non valido"}), 400
+
+@app.route('/api/uploads/process', methods=['POST'])
+def process_uploads():
+    """Elabora upload completati, come /api/upload ma senza ritrasferire i file.
+
+    Body JSON: ``{"upload_ids": [...], "keywords": [...], "result_id": ..., "priority": ...,
+    "job_id": ..., "deadline": ..., "budget": {"tokens": ..., "cost_usd": ...}}``.
+    Un contenuto già estratto in passato (stesso SHA-256) salta anche l'ingest.
+    """
+    try:
+        payload = request.get_json(silent=True) or {}
+        upload_ids = payload.get('upload_ids') or []
+        keywords = [kw.strip() for kw in payload.get('keywords') or [] if isinstance(kw, str) and kw.strip()]
+        result_id = (payload.get('result_id') or '').strip() or None
+        if not upload_ids:
+            return jsonify({"error": "Nessun upload indicato"}), 400
+
+        sessions = [upload_store.getSession(upload_id) for upload_id in upload_ids]
+        incomplete = [s["upload_id"] for s in sessions if s["status"] != "complete"]
+        if incomplete:
+            return jsonify({"error": "Upload non completati", "upload_ids": incomplete}), 409
+
+        with job_workspace() as workspace:
+            input_dir, ingest_dir = workspace
+            preingested = []
+            to_ingest = {}
+            for session in sessions:
+                filename = session["filename"]
+                document = upload_store.getIngested(session["sha256"])
+                CACHE_LOOKUPS.inc(cache="ingest", result="hit" if document else "miss")
+                if document:
+                    preingested.append({**document, "filename": filename})
+                    continue
+                target = input_dir / filename
+                try:
+                    os.link(upload_store.blobPath(session["sha256"]), target)
+                except OSError:
+                    shutil.copyfile(upload_store.blobPath(session["sha256"]), target)
+                to_ingest[target.stem] = session["sha256"]
+
+            log.debug(f"{len(preingested)} file già estratti, {len(to_ingest)} da estrarre")
+            result = process_files(keywords, result_id=result_id, preingested=preingested,
+                                   workspace=workspace,
+                                   priority=payload.get('priority'), tenant=request_tenant(),
+                                   job_id=payload.get('job_id'), deadline=payload.get('deadline'),
+                                   budget=payload.get('budget'))
+
+            # Estrazioni riusabili la prossima volta che arriva lo stesso contenuto
+            for stem, sha256 in to_ingest.items():
+                ingest_file = ingest_dir / f"{stem}.json"
+                if ingest_file.exists():
+                    with open(ingest_file, 'r', encoding='utf-8') as f:
+                        upload_store.saveIngested(sha256, json.load(f))
 
-        # Ordina per data di creazione (più recenti primi)
-        documents.sort(key=lambda x: x['created_at'], reverse=True)
+        return jsonify({
+            "message": "File elaborati con successo",
+            "uploaded_files": [s["filename"] for s in sessions],
+            "keywords": keywords,
+            "processing_result": result
+        })
+
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        log.exception(f"Errore in process_uploads: {str(e)}")
+        return jsonify({"error": f"Errore durante l'elaborazione: {str(e)}"}), 500
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Annulla un job avviato con ``job_id`` (es. l'utente ha chiuso la pagina).
+
+    Funziona anche se il job gira in un altro processo del server, e se arriva
+    prima che il job parta.
+    """
+    if not JOB_REGISTRY.validId(job_id):
+        return jsonify({"error": "job_id non valido"}), 400
+    running = JOB_REGISTRY.cancel(job_id)
+    return jsonify({"status": "cancelling", "job_id": job_id, "running_here": running}), 202
+
+@app.route('/api/usage', methods=['GET'])
+def usage_report():
+    """Token, costo e latenza delle chiamate al modello, aggregati.
+
+    Parametri opzionali: ``group_by`` (stage, model, doc_type, document,
+    keywords, tenant, priority, day; default stage), ``since``/``until`` (epoch).
+    """
+    try:
+        group_by = request.args.get('group_by', 'stage')
+        rows = USAGE_STORE.summary(group_by, since=request.args.get('since', type=float),
+                                   until=request.args.get('until', type=float))
+        return jsonify({"status": "success", "group_by": group_by, "rows": rows})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+# Riassunti scritti prima dell'indice: allineati una sola volta all'avvio
+sync_index(OUTPUT_FOLDER / "summary")
+
+@app.route('/api/storico', methods=['GET'])
+def get_storico():
+    """Endpoint per lo storico: solo metadati, paginati a cursore.
+
+    Parametri opzionali: ``limit`` (max 200), ``cursor`` (da ``next_cursor``),
+    ``tag``, ``type``, ``q`` (titolo o nome file), ``since``/``until`` (epoch).
+    Il contenuto completo si recupera con /api/documents/<id>.
+    """
+    try:
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+        documents, next_cursor = list_summaries(
+            limit=limit,
+            cursor=request.args.get('cursor') or None,
+            tag=request.args.get('tag') or None,
+            doc_type=request.args.get('type') or None,
+            q=request.args.get('q') or None,
+            since=request.args.get('since', type=float),
+            until=request.args.get('until', type=float)
+        )
 
         return jsonify({
             "status": "success",
             "documents": documents,
-            "total": len(documents)
+            "next_cursor": next_cursor
         })
 
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": f"Errore nel recuperare lo storico: {str(e)}"}), 500
 
+@app.route('/api/search', methods=['GET'])
+def search_archive():
+    """Ricerca full-text su documenti estratti e riassunti.
+
+    Parametri: ``q`` (obbligatorio), ``kind`` (document|summary), ``lang``
+    (it, en, fr, de, es, pt: stemming della lingua e filtro), ``limit``, ``offset``.
+    """
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({"error": "Parametro q mancante"}), 400
+
+        kind = request.args.get('kind') or None
+        if kind and kind not in ("document", "summary"):
+            return jsonify({"error": f"kind non valido: {kind}"}), 400
+
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        results, has_more = search(query, kind=kind, language=request.args.get('lang'),
+                                   limit=limit, offset=offset)
+
+        return jsonify({
+            "status": "success",
+            "results": results,
+            "next_offset": offset + limit if has_more else None
+        })
+
+    except Exception as e:
+        return jsonify({"error": f"Errore nella ricerca: {str(e)}"}), 500
+
+@app.route('/api/ask', methods=['POST'])
+def ask_archive():
+    """Risponde a una domanda usando solo i chunk più pertinenti dell'archivio.
+
+    Body JSON: ``{"question": "...", "k": 8}``.
+    """
+    try:
+        payload = request.get_json(silent=True) or {}
+        question = str(payload.get('question', '')).strip()
+        if not question:
+            return jsonify({"error": "Campo question mancante"}), 400
+        k = min(max(int(payload.get('k', 8)), 1), 30)
+
+        runtime = getRuntime()
+        with jobContext(INTERACTIVE, request_tenant()):
+            result = runtime.run(answer_question(EmbeddingIndex(EMBEDDINGS_FOLDER), question, k=k,
+                                                 client=runtime.client()))
+        return jsonify({"status": "success", **result})
+
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Richiesta non valida: {str(e)}"}), 400
+    except Exception as e:
+        return jsonify({"error": f"Errore nella risposta: {str(e)}"}), 500
+
 @app.route('/api/documents/<document_id>', methods=['GET'])
 def get_document(document_id):
     """Endpoint per recuperare un documento specifico"""
@@ -254,7 +722,13 @@ def delete_document(document_id):
         if not file_path.exists():
             return jsonify({"error": "Documento non trovato"}), 404
 
+        filename = (load_summary(summary_dir, document_id) or {}).get("filename")
         file_path.unlink()
+        remove_summary(document_id)
+        remove_entry("summary", document_id)
+        # I vettori sono del documento d'origine: restano finché un altro riassunto lo usa
+        if filename and not summary_exists_for(filename):
+            EmbeddingIndex(EMBEDDINGS_FOLDER).remove(Path(filename).stem)
 
         return jsonify({
             "status": "success",
@@ -268,17 +742,21 @@ def delete_document(document_id):
 def clear_all():
     """Endpoint per pulire tutti i file di input e output"""
     try:
-        # Pulisci directory input
+        # Pulisci directory input; le cartelle dei job in corso restano a loro
         for file_path in UPLOAD_FOLDER.iterdir():
             if file_path.is_file():
                 file_path.unlink()
 
-        # Pulisci directory output
+        # Pulisci directory output; l'indice embedding si svuota dalle sue
+        # connessioni aperte invece di cancellarne i file
         for subdir in OUTPUT_FOLDER.iterdir():
-            if subdir.is_dir():
+            if subdir.is_dir() and subdir != EMBEDDINGS_FOLDER:
                 for file_path in subdir.iterdir():
                     if file_path.is_file():
                         file_path.unlink()
+        clear_index()
+        clear_search_index()
+        EmbeddingIndex(EMBEDDINGS_FOLDER).clear()
 
         return jsonify({
             "status": "success",
@@ -290,7 +768,7 @@ def clear_all():
 
 @app.errorhandler(413)
 def too_large(e):
-    return jsonify({"error": "File troppo grande. Dimensione massima: 100MB"}), 413
+    return jsonify({"error": "Richiesta troppo grande (massimo 100MB): per file più grandi usa /api/uploads"}), 413
 
 @app.errorhandler(500)
 def internal_error(e):
@@ -306,10 +784,16 @@ if __name__ == '__main__':
     print("Server disponibile su: http://localhost:8000")
     print("Endpoint disponibili:")
     print("  - GET  /api/health - Health check")
+    print("  - GET  /api/metrics - Metriche Prometheus")
     print("  - POST /api/upload - Upload e elaborazione file")
+    print("  - POST /api/uploads, PUT /api/uploads/<id> - Upload a blocchi ripristinabile")
+    print("  - POST /api/uploads/process - Elaborazione di upload completati")
     print("  - GET  /api/storico - Recupera storico documenti")
+    print("  - GET  /api/search?q=... - Ricerca full-text")
+    print("  - POST /api/ask - Domande sull'archivio (recupero semantico)")
     print("  - GET  /api/documents/<id> - Recupera documento specifico")
     print("  - DELETE /api/documents/<id> - Elimina documento")
     print("  - POST /api/clear - Pulisci tutti i file")
 
+    # Solo sviluppo: in produzione usare gunicorn (vedi gunicorn.conf.py)
     app.run(debug=True, host='0.0.0.0', port=8000)
@@ -0,0 +1,258 @@
+"""e2e_benchmark.py – Benchmark end-to-end del pipeline senza API reale
+-----------------------------------------------------------------------
+Genera il corpus sintetico (vedi synthetic_corpus.py), avvia il server
+OpenAI simulato (vedi mock_openai.py) e fa passare i documenti per le fasi
+del pipeline misurando throughput e latenze p50/p95:
+
+- ``extraction``: Ingest, un campione per file (per tipo nel report);
+- ``map`` / ``reduce``: chiamate del Chunker, un campione per chiamata;
+- ``accumulation``: chiamate di scaletta e finale;
+- ``embedding``: chiamate dell'indice di embedding (se numpy è installato);
+- ``summarize_total`` / ``accumulation_total``: durata dell'intera fase.
+
+Con ``--mode batch`` map, reduce e accumulation passano dalla Batch API
+simulata. Il report JSON (``--output``) è il formato di confronto tra run:
+stesso ``--seed`` significa stesso corpus e stessa sequenza di latenze e 429.
+
+Uso:  python bench/e2e_benchmark.py [--per-type 3] [--latency-median 0.3]
+      [--latency-p95 1.2] [--rate-429 0.02] [--mode live|batch]
+      [--types pdf,csv,xlsx] [--output report.json]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "summarize"))
+sys.path.insert(0, str(ROOT / "formatting"))
+
+from mock_openai import MockOpenAI, classify_messages  # noqa: E402
+from synthetic_corpus import build_corpus  # noqa: E402
+
+KEYWORDS = ["costi", "emissioni", "produzione"]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Percentile nearest-rank; 0 se non ci sono campioni"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(q / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize_samples(samples: List[float], seconds: float = None) -> Dict[str, Any]:
+    elapsed = seconds if seconds is not None else sum(samples)
+    return {
+        "count": len(samples),
+        "seconds": round(elapsed, 4),
+        "throughput_per_s": round(len(samples) / elapsed, 3) if elapsed > 0 else None,
+        "p50": round(percentile(samples, 50), 4),
+        "p95": round(percentile(samples, 95), 4),
+        "max": round(max(samples), 4) if samples else 0.0,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Client con misura per chiamata
+# ---------------------------------------------------------------------------
+class _Timed:
+
+    def __init__(self, create, stage_of, samples):
+        self._create = create
+        self._stage_of = stage_of
+        self._samples = samples
+
+    async def create(self, **kwargs):
+        stage = self._stage_of(kwargs)
+        started = time.perf_counter()
+        try:
+            return await self._create(**kwargs)
+        finally:
+            self._samples[stage].append(time.perf_counter() - started)
+
+
+class TimedClient:
+    """Avvolge AsyncOpenAI: latenza lato client di ogni chiamata, per fase"""
+
+    def __init__(self, client, samples: Dict[str, List[float]]):
+        self._client = client
+
+        def chat_stage(kwargs):
+            stage = classify_messages(kwargs.get("messages") or [])
+            return "accumulation" if stage in {"outline", "accumulation", "accumulation-merge"} else stage
+
+        self.chat = type("Chat", (), {})()
+        self.chat.completions = _Timed(client.chat.completions.create, chat_stage, samples)
+        self.embeddings = _Timed(client.embeddings.create, lambda kwargs: "embedding", samples)
+
+    def __getattr__(self, name):
+        # files, batches, close: invariati
+        return getattr(self._client, name)
+
+
+# ---------------------------------------------------------------------------
+# Fasi
+# ---------------------------------------------------------------------------
+def run_extraction(corpus_dir: Path, work: Path, samples: Dict[str, List[float]]) -> List[Dict[str, Any]]:
+    from ingest.extractor import Ingest
+
+    docs = []
+    output_dir = work / "ingest"
+    for path in sorted(corpus_dir.iterdir()):
+        if path.name == "manifest.json":
+            continue
+        # Una cartella per file: il tempo misurato è quello del singolo file
+        single = work / "single"
+        shutil.rmtree(single, ignore_errors=True)
+        single.mkdir()
+        shutil.copy(path, single / path.name)
+        started = time.perf_counter()
+        Ingest(str(single), str(output_dir), config_path=str(ROOT / "config.json"))
+        elapsed = time.perf_counter() - started
+        produced = output_dir / f"{path.stem}.json"
+        if produced.exists():
+            samples["extraction"].append(elapsed)
+            samples[f"extraction:{path.suffix.lstrip('.')}"].append(elapsed)
+            docs.append(json.loads(produced.read_text(encoding="utf-8")))
+        else:
+            samples[f"extraction_failed:{path.suffix.lstrip('.')}"].append(elapsed)
+    return docs
+
+
+async def run_pipeline(docs: List[Dict[str, Any]], client, args, work: Path,
+                       totals: Dict[str, float]) -> Dict[str, Any]:
+    from chunker import Chunker, ChunkerConfig
+    from formatting.accumulation import accumulation_async
+
+    cfg = ChunkerConfig(
+        max_tokens=1024,
+        adaptive_chunking=True,
+        handle_audio_video=True,
+        max_concurrency=args.concurrency,
+        execution_mode=args.mode,
+        batch_dir=str(work / "batch"),
+        batch_poll_interval=0.2,
+    )
+    chunker = Chunker(cfg, client=client)
+    chunker.set_keywords(KEYWORDS)
+
+    started = time.perf_counter()
+    summaries = await chunker.process_documents(docs)
+    totals["summarize_total"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batch_runner = chunker.batch_runner() if args.mode == "batch" else None
+    result = await accumulation_async(summaries, KEYWORDS, client=client, batch_runner=batch_runner,
+                                      max_concurrency=args.concurrency)
+    totals["accumulation_total"] = time.perf_counter() - started
+
+    if not args.skip_embeddings:
+        try:
+            from retrieval import EmbeddingIndex, index_documents
+        except ImportError as e:
+            print(f"Embedding saltati: {e}")
+        else:
+            started = time.perf_counter()
+            index = EmbeddingIndex(work / "embeddings", client=client)
+            await index_documents(index, {Path(d["filename"]).stem: d for d in docs})
+            totals["embedding_total"] = time.perf_counter() - started
+
+    return {"summaries": len(summaries), "accumulation_ok": isinstance(result, dict) and "error" not in result}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end con server OpenAI simulato")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--per-type", type=int, default=3)
+    parser.add_argument("--types", default="pdf,csv,xlsx,png,wav")
+    parser.add_argument("--audio-seconds", type=float, default=20.0)
+    parser.add_argument("--latency-median", type=float, default=0.3)
+    parser.add_argument("--latency-p95", type=float, default=1.2)
+    parser.add_argument("--rate-429", type=float, default=0.02)
+    parser.add_argument("--mode", choices=["live", "batch"], default="live")
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--skip-embeddings", action="store_true")
+    parser.add_argument("--work-dir", help="cartella di lavoro (default: temporanea, poi rimossa)")
+    parser.add_argument("--output", help="report JSON")
+    args = parser.parse_args()
+
+    work = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix="summy-bench-"))
+    work.mkdir(parents=True, exist_ok=True)
+    cwd = os.getcwd()
+    samples: Dict[str, List[float]] = defaultdict(list)
+    totals: Dict[str, float] = {}
+
+    mock = MockOpenAI(latency_median=args.latency_median, latency_p95=args.latency_p95,
+                      rate_429=args.rate_429, seed=args.seed, batch_delay=0.2).start()
+    os.environ["OPENAI_BASE_URL"] = mock.base_url
+    os.environ["OPENAI_API_KEY"] = "mock-key"
+    try:
+        # .chunk_temp, cache dell'ingest e stato batch restano nella cartella di lavoro
+        os.chdir(work)
+        manifest = build_corpus(work / "corpus", args.seed, args.per_type,
+                                audio_seconds=args.audio_seconds, types=args.types.split(","))
+
+        started = time.perf_counter()
+        docs = run_extraction(work / "corpus", work, samples)
+        totals["extraction_total"] = time.perf_counter() - started
+        if not docs:
+            print("Nessun documento estratto: mancano i motori di estrazione?")
+            return 1
+
+        from openai import AsyncOpenAI
+
+        async def run():
+            client = AsyncOpenAI()
+            try:
+                return await run_pipeline(docs, TimedClient(client, samples), args, work, totals)
+            finally:
+                await client.close()
+
+        outcome = asyncio.run(run())
+    finally:
+        os.chdir(cwd)
+        mock.stop()
+        if not args.work_dir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in {"output", "work_dir"}},
+        "corpus": {"files": len(manifest["files"]), "skipped": manifest["skipped"], "documents": len(docs)},
+        "outcome": outcome,
+        "stages": {stage: summarize_samples(values) for stage, values in sorted(samples.items())},
+        "totals": {stage: round(seconds, 4) for stage, seconds in totals.items()},
+        "mock": mock.stats,
+    }
+    # Throughput delle fasi complete: documenti al secondo sull'intera durata
+    for stage in ("summarize_total", "accumulation_total", "embedding_total"):
+        if stage in totals and totals[stage] > 0:
+            report["totals"][f"{stage.replace('_total', '')}_docs_per_s"] = round(len(docs) / totals[stage], 3)
+
+    print(f"{'fase':<26}{'n':>6}{'p50 s':>10}{'p95 s':>10}{'max s':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<26}{stats['count']:>6}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{stats['max']:>10.3f}")
+    for stage, value in report["totals"].items():
+        print(f"{stage:<26}{value:>16}")
+    throttled = sum(s["throttled"] for s in mock.stats.values())
+    print(f"429 simulati: {throttled}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print(f"Report: {args.output}")
+    return 0 if outcome["accumulation_ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+"""hot_paths.py – Micro-benchmark dei percorsi di testo più caldi
+-----------------------------------------------------------------------
+Misura le funzioni che passano su ogni byte di testo estratto:
+
+- ``normalizeWhitespaces`` (utils/ingestHelper.py)
+- ``apply_corporate_corrections`` (ingest/extractor.py, termini di config.json)
+- ``Chunker._split_into_sections``: input con marcatori di pagina, con
+  titoli numerati e senza struttura (il caso peggiore, tutte le regex
+  vengono provate)
+- ``Chunker._clean_transcript``
+- ``Chunker._clean_json_response``: molte risposte piccole e una grande
+
+Gli input sono generati in modo deterministico, di qualche MB, in sette
+lingue (alfabeti latino con diacritici e cirillico). Ogni caso viene
+eseguito ``--rounds`` volte dopo un giro di riscaldamento; il report
+riporta min/mediana/media/deviazione e MB/s, come pytest-benchmark.
+
+Le baseline (``bench/baselines/hot_paths.json``) sono normalizzate con un
+carico di calibrazione misurato nello stesso run, così restano
+confrontabili tra macchine diverse. Il confronto usa il tempo minimo, il
+meno sensibile al rumore della macchina. Un caso più lento della baseline
+oltre ``--tolerance`` (o la tolleranza del caso in ``tolerances`` nel file
+delle baseline, per i casi brevi e più instabili) fa fallire il run (exit
+code 1).
+
+Uso:  python bench/hot_paths.py [--size-mb 2] [--rounds 10] [-k filtro]
+      [--save-baseline] [--tolerance 0.3] [--json report.json]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "summarize"))
+
+BASELINE_FILE = Path(__file__).resolve().parent / "baselines" / "hot_paths.json"
+
+_WORDS = {
+    "it": "il la che di per una sono della produzione costi società energia attività perché già più "
+          "città qualità sostenibilità investimenti raffineria trimestre bilancio ebitda kpi",
+    "en": "the and of to in is that for revenue costs margins forecast budget company energy "
+          "production pipeline quarter balance sheet ebitda roi kpi",
+    "fr": "le la les de des et est pour être très déjà où société énergie coûts marges prévisions "
+          "bénéfice trimestre capex opex kpi",
+    "de": "der die das und ist für mit über größer Straße Gesellschaft Energie Kosten Umsatz "
+          "Prognose Quartal Bilanz ebitda kpi",
+    "es": "el la los de que y en por más también está compañía energía costes márgenes previsión "
+          "beneficio trimestre año ebitda kpi",
+    "pt": "o a os de que e em para não também está empresa energia custos margens previsão "
+          "lucro trimestre ação ebitda kpi",
+    "ru": "и в не на что это как компания энергия затраты выручка прогноз квартал баланс добыча "
+          "газ нефть ebitda kpi",
+}
+
+
+# ---------------------------------------------------------------------------
+# Input deterministici
+# ---------------------------------------------------------------------------
+def _sentences(rng: random.Random, lang: str, size: int) -> str:
+    words = _WORDS[lang].split()
+    out, length = [], 0
+    while length < size:
+        sentence = " ".join(rng.choice(words) for _ in range(rng.randint(6, 18)))
+        # Spazi irregolari e punteggiatura staccata, come nel testo estratto da PDF/OCR
+        sentence = sentence.capitalize() + rng.choice([".", " .", "!", "?", " ,", ";"])
+        sentence += rng.choice([" ", "  ", "\n", " \t ", "\n\n"])
+        out.append(sentence)
+        length += len(sentence)
+    return "".join(out)
+
+
+def text_paged(rng: random.Random, lang: str, size: int, page: int = 3000) -> str:
+    body = _sentences(rng, lang, size)
+    return "".join(f"\n--- Page {i // page + 1} ---\n{body[i:i + page]}" for i in range(0, len(body), page))
+
+
+def text_numbered(rng: random.Random, lang: str, size: int, section: int = 2000) -> str:
+    body = _sentences(rng, lang, size)
+    return "".join(f"\n{i // section + 1}.{rng.randint(1, 9)} {body[i:i + section]}"
+                   for i in range(0, len(body), section))
+
+
+def text_plain(rng: random.Random, lang: str, size: int) -> str:
+    # Nessun marcatore: nessuna delle cinque regex divide il testo
+    return _sentences(rng, lang, size).replace("\n", " ")
+
+
+def transcript(rng: random.Random, size: int) -> str:
+    glitches = ["dazz i", "gi o c o", "portaf o l i o", "gioco-politiche", "prezzoPetrolio",
+                "mercatoGlobale", "costi,energia", "quindi.poi"]
+    base = _sentences(rng, "it", size).split(" ")
+    for i in range(0, len(base), 25):
+        base[i] = rng.choice(glitches)
+    return " ".join(base)
+
+
+def json_responses(rng: random.Random, count: int, content_size: int) -> List[str]:
+    responses = []
+    for i in range(count):
+        content = _sentences(rng, rng.choice(list(_WORDS)), content_size).replace('"', "'")
+        tags = ", ".join(f'"tag{j}"' for j in range(rng.randint(1, 7)))
+        raw = f'{{"file": "doc_{i}.pdf", "chunk_idx": {i}, "total_chunks": {count}, ' \
+              f'"content": "{content}", "tags": [{tags},],}}'
+        responses.append(f"```json\n{raw}\n```" if i % 2 else raw)
+    return responses
+
+
+# ---------------------------------------------------------------------------
+# Casi
+# ---------------------------------------------------------------------------
+def build_cases(size: int, seed: int) -> List[Tuple[str, Callable[[], object], int]]:
+    """(nome, funzione senza argomenti, byte elaborati per chiamata)"""
+    from utils.ingestHelper import normalizeWhitespaces
+    from ingest.extractor import apply_corporate_corrections, loadConfig
+    from chunker import Chunker, ChunkerConfig
+
+    config = loadConfig(str(ROOT / "config.json"))
+    chunker = Chunker(ChunkerConfig())
+    cases = []
+
+    def add(name, fn, arg):
+        cases.append((name, lambda: fn(arg), len(arg.encode("utf-8"))))
+
+    for lang in _WORDS:
+        rng = random.Random(f"{seed}:{lang}")
+        text = _sentences(rng, lang, size)
+        add(f"normalizeWhitespaces[{lang}]", normalizeWhitespaces, text)
+        cases.append((f"apply_corporate_corrections[{lang}]",
+                      lambda text=text, lang=lang: apply_corporate_corrections(text, lang, config),
+                      len(text.encode("utf-8"))))
+
+    rng = random.Random(f"{seed}:sections")
+    add("split_into_sections[paged]", chunker._split_into_sections, text_paged(rng, "it", size))
+    add("split_into_sections[numbered]", chunker._split_into_sections, text_numbered(rng, "de", size))
+    add("split_into_sections[plain]", chunker._split_into_sections, text_plain(rng, "ru", size))
+
+    add("clean_transcript[it]", chunker._clean_transcript, transcript(random.Random(f"{seed}:audio"), size))
+
+    rng = random.Random(f"{seed}:json")
+    small = json_responses(rng, 500, 2_000)
+    cases.append(("clean_json_response[500x2KB]", lambda: [chunker._clean_json_response(r) for r in small],
+                  sum(len(r.encode("utf-8")) for r in small)))
+    add("clean_json_response[large]", chunker._clean_json_response, json_responses(rng, 1, size)[0])
+    return cases
+
+
+def calibrate(rounds: int = 10) -> float:
+    """Tempo di un carico fisso (regex + Python puro): unità di misura delle baseline"""
+    text = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit.  \n" * 20_000)
+
+    def workload():
+        re.sub(r"\s+", " ", text)
+        sum(len(w) for w in text.split())
+
+    return _measure(workload, rounds)["min"]
+
+
+def _measure(fn: Callable[[], object], rounds: int) -> Dict[str, float]:
+    fn()  # riscaldamento: cache delle regex compilate, allocazioni
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "stddev": statistics.stdev(times) if len(times) > 1 else 0.0,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmark dei percorsi di testo")
+    parser.add_argument("--size-mb", type=float, default=2.0, help="dimensione degli input di testo")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-k", dest="filter", help="esegue solo i casi che contengono la stringa")
+    parser.add_argument("--save-baseline", action="store_true", help="sovrascrive le baseline dei casi eseguiti")
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="rallentamento ammesso (0.3 = +30%%) per i casi senza tolleranza propria")
+    parser.add_argument("--json", help="report JSON")
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    cases = [c for c in build_cases(size, args.seed) if not args.filter or args.filter in c[0]]
+    baselines = json.loads(BASELINE_FILE.read_text(encoding="utf-8")) if BASELINE_FILE.exists() else {}
+    saved = baselines.get("cases", {})
+    tolerances = baselines.get("tolerances", {})
+    # Le baseline valgono solo per gli stessi input
+    comparable = baselines.get("size_mb") == args.size_mb and baselines.get("seed") == args.seed
+
+    # Calibrazione prima e dopo i casi: un disturbo su una sola delle due
+    # (GC, frequenza della CPU) non sposta tutti i rapporti insieme
+    unit = calibrate(max(args.rounds, 10))
+    measured = [(name, _measure(fn, args.rounds), nbytes) for name, fn, nbytes in cases]
+    unit = min(unit, calibrate(max(args.rounds, 10)))
+
+    print(f"calibrazione: {unit * 1000:.2f} ms  input: {args.size_mb} MB  round: {args.rounds}")
+    print(f"{'caso':<40}{'min ms':>10}{'med ms':>10}{'MB/s':>9}{'vs base':>9}")
+    results, regressions = {}, []
+    for name, stats, nbytes in measured:
+        relative = stats["min"] / unit
+        ratio = relative / saved[name] if comparable and name in saved else None
+        results[name] = {**{k: round(v, 6) for k, v in stats.items()},
+                         "mb_per_s": round(nbytes / 1024 / 1024 / stats["median"], 2),
+                         "relative": round(relative, 4)}
+        flag = f"{ratio:>8.2f}x" if ratio is not None else f"{'-':>9}"
+        if ratio is not None and ratio > 1 + tolerances.get(name, args.tolerance):
+            regressions.append(name)
+            flag += " !"
+        print(f"{name:<40}{stats['min'] * 1000:>10.1f}{stats['median'] * 1000:>10.1f}"
+              f"{results[name]['mb_per_s']:>9.1f}{flag}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps({"calibration": unit, "cases": results}, indent=2), encoding="utf-8")
+
+    if args.save_baseline:
+        merged = saved if comparable else {}
+        merged.update({name: r["relative"] for name, r in results.items()})
+        BASELINE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        BASELINE_FILE.write_text(json.dumps({"size_mb": args.size_mb, "seed": args.seed,
+                                             "cases": dict(sorted(merged.items())),
+                                             "tolerances": tolerances}, indent=2) + "\n",
+                                 encoding="utf-8")
+        print(f"Baseline salvate in {BASELINE_FILE.relative_to(ROOT)}")
+        return 0
+
+    if regressions:
+        print(f"FAIL: {len(regressions)} casi oltre la tolleranza: {', '.join(regressions)}")
+        return 1
+    print("OK" if comparable else "Nessuna baseline confrontabile (usa --save-baseline)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""import_budget.py – Verifica del tempo di avvio del backend
+-----------------------------------------------------------------------
+Importa ``app`` in un interprete pulito (niente cache di moduli già
+caricati) e fallisce se:
+
+- l'import supera il budget di tempo (``--budget`` secondi, default 2.0
+  o ``SUMMY_IMPORT_BUDGET``), misurato come mediana di ``--runs`` avvii;
+- dopo l'import risultano caricati moduli pesanti che devono restare
+  differiti (torch, whisper, openai, tika, pdfplumber, PIL, pytesseract).
+
+Uso:  python bench/import_budget.py [--budget 2.0] [--runs 5]
+Exit code 0 se entrambi i controlli passano, 1 altrimenti.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Moduli che l'import di app.py non deve caricare
+HEAVY_MODULES = ["torch", "whisper", "openai", "tika", "pdfplumber", "PIL", "pytesseract", "pandas"]
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app  # noqa: F401
+elapsed = time.perf_counter() - started
+heavy = sorted(m for m in {heavy!r} if m in sys.modules)
+print(json.dumps({{"seconds": elapsed, "heavy": heavy, "modules": len(sys.modules)}}))
+"""
+
+
+def probe_once() -> dict:
+    env = dict(os.environ)
+    # L'import non deve dipendere dalla chiave: la si toglie di proposito
+    env.pop("OPENAI_API_KEY", None)
+    proc = subprocess.run(
+        [sys.executable, "-c", PROBE.format(heavy=HEAVY_MODULES)],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=120,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import app fallito:\n{proc.stderr.strip()}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Budget di tempo per l'import di app.py")
+    parser.add_argument("--budget", type=float, default=float(os.getenv("SUMMY_IMPORT_BUDGET", 2.0)))
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    results = [probe_once() for _ in range(args.runs)]
+    median = statistics.median(r["seconds"] for r in results)
+    heavy = sorted({m for r in results for m in r["heavy"]})
+
+    print(f"import app: mediana {median:.3f}s su {args.runs} avvii "
+          f"(budget {args.budget:.3f}s), {results[-1]['modules']} moduli")
+    ok = True
+    if median > args.budget:
+        print(f"FAIL: budget superato di {median - args.budget:.3f}s")
+        ok = False
+    if heavy:
+        print(f"FAIL: moduli pesanti caricati all'import: {', '.join(heavy)}")
+        ok = False
+    if ok:
+        print("OK")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,457 @@
+"""mock_openai.py – Server OpenAI locale e deterministico per i benchmark
+-----------------------------------------------------------------------
+Sostituisce l'API OpenAI nei benchmark e nei run di prova senza chiave:
+basta puntare il client a ``OPENAI_BASE_URL=http://127.0.0.1:<porta>/v1``.
+
+Endpoint simulati:
+
+- ``POST /v1/chat/completions``: risposte JSON valide per ogni fase del
+  pipeline (map, reduce, scalette e accumulation, risposte di /api/ask),
+  riconosciute dal prompt; il contenuto è estratto dal testo in input,
+  quindi la dimensione delle risposte segue quella dei documenti.
+- ``POST /v1/embeddings``: vettori pseudo-casuali derivati dall'hash del
+  testo (stesso testo, stesso vettore).
+- ``POST /v1/files``, ``GET /v1/files/<id>/content``, ``POST /v1/batches``,
+  ``GET /v1/batches/<id>``: Batch API completa, eseguita in un thread.
+- ``GET /_stats``: richieste, 429 e latenza simulata per fase.
+
+La latenza segue una lognormale definita da mediana e p95; gli errori 429
+vengono iniettati con probabilità ``--rate-429``, mai più di
+``--max-429-streak`` volte di fila per la stessa richiesta (così i retry
+del client bastano). Latenze e 429 dipendono solo da ``--seed``, dal
+contenuto della richiesta e dal numero di tentativi: due run con lo stesso
+seed e lo stesso corpus vedono la stessa sequenza.
+
+``--canned file.json`` sostituisce le risposte generate: ``{"map": {...},
+"reduce": {...}}`` (oggetti serializzati in JSON, stringhe restituite così
+come sono).
+
+Uso:  python bench/mock_openai.py [--port 9000] [--latency-median 0.8]
+      [--latency-p95 2.5] [--rate-429 0.05] [--seed 0] [--canned file.json]
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+# Granularità della prompt cache simulata (~1024 token)
+CACHE_BLOCK_CHARS = 4096
+EMBEDDING_DIM = 256
+SUMMARY_WORDS = 120
+
+_FILE_RE = re.compile(r"FILE:\s*([^|\n]+)")
+_CHUNK_RE = re.compile(r"CHUNK:\s*(\d+)\s*/\s*(\d+)")
+_WORD_RE = re.compile(r"[A-Za-zÀ-ÿ][A-Za-zÀ-ÿ'\-]+")
+
+
+# ---------------------------------------------------------------------------
+# Riconoscimento della fase e risposte
+# ---------------------------------------------------------------------------
+def classify_messages(messages: List[Dict[str, Any]]) -> str:
+    """Fase del pipeline a cui appartiene una richiesta chat, dedotta dal prompt"""
+    system = " ".join(str(m.get("content", "")) for m in messages if m.get("role") == "system")
+    user = " ".join(str(m.get("content", "")) for m in messages if m.get("role") != "system")
+    if "PASSAGGI:" in user:
+        return "answer"
+    if "UNISCI I FRAMMENTI" in system:
+        return "reduce"
+    if _CHUNK_RE.search(user) and _FILE_RE.search(user):
+        return "map"
+    if "DOCUMENTO ESISTENTE" in user:
+        return "accumulation-merge"
+    if '"Titolo"' in user:
+        return "accumulation"
+    if '"Sezioni"' in user:
+        return "outline"
+    return "chat"
+
+
+def _words(text: str, limit: int) -> List[str]:
+    return _WORD_RE.findall(text)[:limit]
+
+
+def _sentence(words: List[str]) -> str:
+    return (" ".join(words) + ".") if words else "Nessun contenuto."
+
+
+def _sections(text: str, count: int = 3) -> List[Dict[str, str]]:
+    words = _words(text, SUMMARY_WORDS * count)
+    size = max(1, math.ceil(len(words) / count))
+    parts = [words[i:i + size] for i in range(0, len(words), size)] or [[]]
+    return [{"titolo": " ".join(p[:4]).title() or f"Sezione {i + 1}", "contenuto": _sentence(p)}
+            for i, p in enumerate(parts)]
+
+
+def generate_reply(stage: str, messages: List[Dict[str, Any]]) -> str:
+    """Contenuto deterministico e ben formato per la fase indicata"""
+    user = "\n".join(str(m.get("content", "")) for m in messages if m.get("role") != "system")
+    # Il testo da riassumere sta in fondo al prompt, dopo le istruzioni
+    body = user.split("\n\n")[-1] if stage in {"map", "reduce"} else user
+    words = _words(body, SUMMARY_WORDS)
+    tags = sorted({w.lower() for w in words if len(w) > 6})[:5]
+
+    if stage == "map":
+        file_match, chunk_match = _FILE_RE.search(user), _CHUNK_RE.search(user)
+        return json.dumps({
+            "file": file_match.group(1).strip(),
+            "chunk_idx": int(chunk_match.group(1)) - 1,
+            "total_chunks": int(chunk_match.group(2)),
+            "content": _sentence(words),
+            "tags": tags,
+        }, ensure_ascii=False)
+    if stage == "reduce":
+        return json.dumps({"content": _sentence(words), "tags": tags}, ensure_ascii=False)
+    if stage == "outline":
+        return json.dumps({"Sezioni": _sections(user)}, ensure_ascii=False)
+    if stage in {"accumulation", "accumulation-merge"}:
+        return json.dumps({"Titolo": " ".join(words[:6]).title() or "Documento",
+                           "Sezioni": _sections(user)}, ensure_ascii=False)
+    if stage == "answer":
+        return f"Secondo il passaggio [1]: {_sentence(words[:40])}"
+    return json.dumps({"content": _sentence(words)}, ensure_ascii=False)
+
+
+def embedding_for(text: str, dim: int = EMBEDDING_DIM) -> List[float]:
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    return [rng.gauss(0.0, 1.0) for _ in range(dim)]
+
+
+# ---------------------------------------------------------------------------
+# Stato del server
+# ---------------------------------------------------------------------------
+class MockOpenAI:
+    """Server HTTP in un thread; ``base_url`` va passato a OPENAI_BASE_URL."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_median: float = 0.0,
+                 latency_p95: Optional[float] = None, rate_429: float = 0.0,
+                 max_429_streak: int = 1, seed: int = 0, canned: Optional[Dict[str, Any]] = None,
+                 batch_delay: float = 0.5, embedding_dim: int = EMBEDDING_DIM):
+        self.latency_median = latency_median
+        self.latency_p95 = latency_p95 if latency_p95 is not None else latency_median
+        self.rate_429 = rate_429
+        self.max_429_streak = max_429_streak
+        self.seed = seed
+        self.canned = canned or {}
+        self.batch_delay = batch_delay
+        self.embedding_dim = embedding_dim
+
+        self._lock = threading.Lock()
+        self._attempts: Dict[str, int] = {}
+        self._prefixes: set = set()
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.stats: Dict[str, Dict[str, float]] = {}
+
+        handler = type("Handler", (_Handler,), {"mock": self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockOpenAI":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "MockOpenAI":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    # ------------------------------------------------------------------
+    # Latenza, 429 e statistiche
+    # ------------------------------------------------------------------
+    def _attempt(self, digest: str) -> Tuple[random.Random, int]:
+        with self._lock:
+            attempt = self._attempts.get(digest, 0)
+            self._attempts[digest] = attempt + 1
+        return random.Random(f"{self.seed}:{digest}:{attempt}"), attempt
+
+    def plan(self, digest: str) -> Tuple[float, bool]:
+        """(latenza simulata, True se la richiesta va rifiutata con 429)"""
+        rng, attempt = self._attempt(digest)
+        # Il contatore dei tentativi torna a zero solo dopo una risposta riuscita
+        if attempt < self.max_429_streak and rng.random() < self.rate_429:
+            return 0.0, True
+        with self._lock:
+            self._attempts[digest] = 0
+        if self.latency_median <= 0:
+            return 0.0, False
+        sigma = math.log(max(self.latency_p95, self.latency_median) / self.latency_median) / 1.645
+        return rng.lognormvariate(math.log(self.latency_median), sigma), False
+
+    def record(self, stage: str, latency: float = 0.0, throttled: bool = False) -> None:
+        with self._lock:
+            entry = self.stats.setdefault(stage, {"requests": 0, "throttled": 0, "simulated_seconds": 0.0})
+            entry["requests"] += 1
+            entry["throttled"] += int(throttled)
+            entry["simulated_seconds"] += latency
+
+    def cached_tokens(self, prompt: str) -> int:
+        """Prompt cache simulata: prefissi di blocchi interi già visti"""
+        blocks = len(prompt) // CACHE_BLOCK_CHARS
+        hits = 0
+        with self._lock:
+            for k in range(1, blocks + 1):
+                key = hashlib.sha256(prompt[:k * CACHE_BLOCK_CHARS].encode("utf-8")).hexdigest()
+                if key in self._prefixes:
+                    hits = k
+                self._prefixes.add(key)
+        return hits * CACHE_BLOCK_CHARS // 4
+
+    # ------------------------------------------------------------------
+    # Risposte
+    # ------------------------------------------------------------------
+    def completion(self, body: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        messages = body.get("messages") or []
+        stage = classify_messages(messages)
+        canned = self.canned.get(stage)
+        if canned is None:
+            content = generate_reply(stage, messages)
+        else:
+            content = canned if isinstance(canned, str) else json.dumps(canned, ensure_ascii=False)
+
+        prompt = "".join(str(m.get("content", "")) for m in messages)
+        prompt_tokens = max(1, len(prompt) // 4)
+        completion_tokens = max(1, len(content) // 4)
+        return stage, {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": min(prompt_tokens, self.cached_tokens(prompt))},
+            },
+        }
+
+    def embeddings(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        inputs = body.get("input") or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        tokens = sum(len(str(t)) // 4 for t in inputs)
+        return {
+            "object": "list",
+            "model": body.get("model", "mock"),
+            "data": [{"object": "embedding", "index": i, "embedding": embedding_for(str(t), self.embedding_dim)}
+                     for i, t in enumerate(inputs)],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    # ------------------------------------------------------------------
+    # Batch API
+    # ------------------------------------------------------------------
+    def add_file(self, filename: str, content: bytes, purpose: str) -> Dict[str, Any]:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        meta = {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+        with self._lock:
+            self.files[file_id] = {**meta, "content": content}
+        return meta
+
+    def create_batch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        input_file = self.files.get(body.get("input_file_id"))
+        if input_file is None:
+            raise KeyError(body.get("input_file_id"))
+        lines = [line for line in input_file["content"].decode("utf-8").splitlines() if line.strip()]
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex[:24]}",
+            "object": "batch",
+            "endpoint": body.get("endpoint", "/v1/chat/completions"),
+            "completion_window": body.get("completion_window", "24h"),
+            "input_file_id": input_file["id"],
+            "output_file_id": None,
+            "error_file_id": None,
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "metadata": body.get("metadata") or {},
+            "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+            "errors": None,
+        }
+        with self._lock:
+            self.batches[batch["id"]] = batch
+        threading.Thread(target=self._run_batch, args=(batch["id"], lines), daemon=True).start()
+        return batch
+
+    def _run_batch(self, batch_id: str, lines: List[str]) -> None:
+        time.sleep(self.batch_delay)
+        output = []
+        for line in lines:
+            request = json.loads(line)
+            stage, completion = self.completion(request.get("body") or {})
+            self.record(f"batch:{stage}")
+            output.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                "custom_id": request.get("custom_id"),
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": completion},
+                "error": None,
+            }, ensure_ascii=False))
+        out = self.add_file(f"{batch_id}_output.jsonl", ("\n".join(output) + "\n").encode("utf-8"), "batch_output")
+        with self._lock:
+            batch = self.batches[batch_id]
+            batch["request_counts"]["completed"] = len(lines)
+            batch.update(status="completed", output_file_id=out["id"], completed_at=int(time.time()))
+
+
+# ---------------------------------------------------------------------------
+# HTTP
+# ---------------------------------------------------------------------------
+class _Handler(BaseHTTPRequestHandler):
+
+    mock: MockOpenAI
+    # Keep-alive: il pool di connessioni del client viene riusato come con l'API vera
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # noqa: A002 - firma di BaseHTTPRequestHandler
+        pass
+
+    def _send(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None,
+              raw: Optional[bytes] = None) -> None:
+        data = raw if raw is not None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream" if raw is not None else "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status: int, message: str, kind: str = "invalid_request_error") -> None:
+        self._send(status, {"error": {"message": message, "type": kind, "code": None}})
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        mock = self.mock
+        if path == "/_stats":
+            with mock._lock:
+                return self._send(200, mock.stats)
+        match = re.fullmatch(r"/v1/batches/([\w-]+)", path)
+        if match:
+            batch = mock.batches.get(match.group(1))
+            return self._send(200, batch) if batch else self._error(404, "Batch non trovato")
+        match = re.fullmatch(r"/v1/files/([\w-]+)/content", path)
+        if match:
+            stored = mock.files.get(match.group(1))
+            return self._send(200, None, raw=stored["content"]) if stored else self._error(404, "File non trovato")
+        match = re.fullmatch(r"/v1/files/([\w-]+)", path)
+        if match:
+            stored = mock.files.get(match.group(1))
+            if not stored:
+                return self._error(404, "File non trovato")
+            return self._send(200, {k: v for k, v in stored.items() if k != "content"})
+        self._error(404, f"Endpoint non simulato: GET {path}")
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        raw = self._body()
+        mock = self.mock
+
+        if path == "/v1/files":
+            return self._upload(raw)
+        try:
+            body = json.loads(raw or b"{}")
+        except json.JSONDecodeError:
+            return self._error(400, "JSON non valido")
+
+        if path == "/v1/batches":
+            try:
+                return self._send(200, mock.create_batch(body))
+            except KeyError:
+                return self._error(404, "File di input non trovato")
+
+        if path not in {"/v1/chat/completions", "/v1/embeddings"}:
+            return self._error(404, f"Endpoint non simulato: POST {path}")
+
+        digest = hashlib.sha256(raw).hexdigest()
+        latency, throttled = mock.plan(digest)
+        if path == "/v1/embeddings":
+            stage, respond = "embedding", lambda: mock.embeddings(body)
+        else:
+            stage, respond = classify_messages(body.get("messages") or []), lambda: mock.completion(body)[1]
+
+        mock.record(stage, latency, throttled)
+        if throttled:
+            return self._send(429, {"error": {"message": "Rate limit simulato", "type": "rate_limit_error",
+                                              "code": "rate_limit_exceeded"}},
+                              headers={"retry-after-ms": "50"})
+        time.sleep(latency)
+        self._send(200, respond())
+
+    def _upload(self, raw: bytes) -> None:
+        content_type = self.headers.get("Content-Type", "")
+        message = BytesParser(policy=email_policy).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + raw)
+        fields: Dict[str, Tuple[Optional[str], bytes]] = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = (part.get_filename(), part.get_payload(decode=True) or b"")
+        if "file" not in fields:
+            return self._error(400, "Campo 'file' mancante")
+        filename, content = fields["file"]
+        purpose = fields.get("purpose", (None, b"batch"))[1].decode("utf-8")
+        self._send(200, self.mock.add_file(filename or "upload.jsonl", content, purpose))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Server OpenAI simulato per benchmark offline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-median", type=float, default=0.0, help="secondi")
+    parser.add_argument("--latency-p95", type=float, default=None, help="secondi (default: la mediana)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="probabilità di 429 per tentativo")
+    parser.add_argument("--max-429-streak", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-delay", type=float, default=0.5, help="secondi prima che un batch sia completo")
+    parser.add_argument("--canned", help="JSON {fase: risposta} al posto delle risposte generate")
+    args = parser.parse_args()
+
+    canned = None
+    if args.canned:
+        with open(args.canned, "r", encoding="utf-8") as f:
+            canned = json.load(f)
+
+    mock = MockOpenAI(args.host, args.port, args.latency_median, args.latency_p95, args.rate_429,
+                      args.max_429_streak, args.seed, canned, args.batch_delay)
+    print(f"Mock OpenAI su {mock.base_url} (OPENAI_BASE_URL={mock.base_url})")
+    try:
+        mock.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""synthetic_corpus.py – Corpus sintetico e riproducibile per i benchmark
+-----------------------------------------------------------------------
+Genera documenti di prova per ogni famiglia di formati gestita dall'ingest:
+PDF (testo), CSV, XLSX, immagini con testo (per l'OCR) e audio WAV. Il
+contenuto dipende solo da ``seed`` e dai parametri: stesso seed, stessi
+byte (il manifest riporta lo SHA-256 di ogni file per verificarlo).
+
+PDF, CSV, XLSX e WAV sono scritti con la sola libreria standard. Le
+immagini richiedono Pillow per disegnare il testo; senza Pillow vengono
+saltate e il manifest lo segnala. L'audio è una sequenza di toni, non
+parlato: misura il costo della trascrizione, non la sua qualità.
+
+Uso:  python bench/synthetic_corpus.py <cartella> [--seed 0] [--per-type 3]
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import hashlib
+import json
+import math
+import random
+import struct
+import wave
+import zipfile
+from pathlib import Path
+from typing import Dict, List, Optional
+from xml.sax.saxutils import escape
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+_SUBJECTS = ["Il consiglio di amministrazione", "La divisione upstream", "Il comitato rischi",
+             "Il team di ingegneria", "La funzione acquisti", "Il reparto sostenibilita",
+             "La direzione finanziaria", "Il gruppo di progetto"]
+_VERBS = ["ha approvato", "ha rivisto", "ha analizzato", "ha ridotto", "ha pianificato",
+          "ha confermato", "ha rinviato", "ha esteso"]
+_OBJECTS = ["il budget operativo", "gli investimenti in rinnovabili", "il piano di manutenzione",
+            "i costi di trasporto", "le emissioni di CO2", "il contratto di fornitura",
+            "il margine EBITDA", "la produzione di gas"]
+_TAILS = ["per il prossimo trimestre", "entro fine anno", "nel sito di Ravenna",
+          "rispetto al forecast", "dopo la revisione tecnica", "con un impatto del {pct}%",
+          "per un valore di {amount} milioni di euro", "in linea con gli obiettivi ESG"]
+
+# Data fissa negli zip: nessun timestamp nei file generati
+_ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+def _sentence(rng: random.Random) -> str:
+    tail = rng.choice(_TAILS).format(pct=rng.randint(1, 40), amount=rng.randint(2, 900))
+    return f"{rng.choice(_SUBJECTS)} {rng.choice(_VERBS)} {rng.choice(_OBJECTS)} {tail}."
+
+
+def paragraphs(rng: random.Random, count: int, sentences: int = 6) -> List[str]:
+    return [" ".join(_sentence(rng) for _ in range(sentences)) for _ in range(count)]
+
+
+def _wrap(text: str, width: int) -> List[str]:
+    lines, current = [], ""
+    for word in text.split():
+        if current and len(current) + 1 + len(word) > width:
+            lines.append(current)
+            current = word
+        else:
+            current = f"{current} {word}".strip()
+    if current:
+        lines.append(current)
+    return lines
+
+
+# ---------------------------------------------------------------------------
+# Formati
+# ---------------------------------------------------------------------------
+def write_pdf(path: Path, text_paragraphs: List[str], lines_per_page: int = 48) -> None:
+    """PDF minimale con testo estraibile (Helvetica, solo ASCII)"""
+    lines: List[str] = []
+    for paragraph in text_paragraphs:
+        lines.extend(_wrap(paragraph, 90))
+        lines.append("")
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+
+    def pdf_text(line: str) -> str:
+        line = line.encode("ascii", "replace").decode("ascii")
+        return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    objects: List[bytes] = []
+    page_ids = [3 + 2 * i for i in range(len(pages))]
+    font_id = 3 + 2 * len(pages)
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    kids = " ".join(f"{pid} 0 R" for pid in page_ids)
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode())
+    for pid, page in zip(page_ids, pages):
+        ops = ["BT", "/F1 10 Tf", "14 TL", "50 800 Td"]
+        ops.extend(f"({pdf_text(line)}) Tj T*" for line in page)
+        ops.append("ET")
+        stream = "\n".join(ops).encode("ascii")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {pid + 1} 0 R >>".encode())
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{off:010d} 00000 n \n" for off in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    path.write_bytes(bytes(out))
+
+
+def _table(rng: random.Random, rows: int) -> List[List[str]]:
+    header = ["Sito", "Trimestre", "Produzione (kboe)", "Costi (MEUR)", "Emissioni (kt CO2)", "Note"]
+    sites = ["Ravenna", "Gela", "Sannazzaro", "Taranto", "Livorno", "Porto Marghera"]
+    table = [header]
+    for i in range(rows):
+        table.append([rng.choice(sites), f"Q{i % 4 + 1} {2020 + i // 4}", str(rng.randint(100, 9000)),
+                      f"{rng.uniform(1, 500):.2f}", f"{rng.uniform(0.5, 80):.1f}", _sentence(rng)])
+    return table
+
+
+def write_csv(path: Path, table: List[List[str]]) -> None:
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        csv.writer(f).writerows(table)
+
+
+def write_xlsx(path: Path, table: List[List[str]]) -> None:
+    """XLSX minimale (un foglio, stringhe inline) scritto come zip OOXML"""
+    def cell_ref(row: int, col: int) -> str:
+        letters = ""
+        col += 1
+        while col:
+            col, rem = divmod(col - 1, 26)
+            letters = chr(65 + rem) + letters
+        return f"{letters}{row + 1}"
+
+    rows_xml = []
+    for r, row in enumerate(table):
+        cells = []
+        for c, value in enumerate(row):
+            ref = cell_ref(r, c)
+            try:
+                float(value)
+                cells.append(f'<c r="{ref}"><v>{value}</v></c>')
+            except ValueError:
+                cells.append(f'<c r="{ref}" t="inlineStr"><is><t>{escape(value)}</t></is></c>')
+        rows_xml.append(f'<row r="{r + 1}">{"".join(cells)}</row>')
+
+    files = {
+        "[Content_Types].xml": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'),
+        "_rels/.rels": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+            'relationships/officeDocument" Target="xl/workbook.xml"/></Relationships>'),
+        "xl/workbook.xml": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="Dati" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+        "xl/_rels/workbook.xml.rels": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+            'relationships/worksheet" Target="worksheets/sheet1.xml"/></Relationships>'),
+        "xl/worksheets/sheet1.xml": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            f'<sheetData>{"".join(rows_xml)}</sheetData></worksheet>'),
+    }
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, content in files.items():
+            zf.writestr(zipfile.ZipInfo(name, date_time=_ZIP_DATE), content)
+
+
+def write_image(path: Path, text_paragraphs: List[str]) -> bool:
+    """Pagina bianca con testo nero, leggibile dall'OCR; False senza Pillow"""
+    if Image is None:
+        return False
+    lines = [line for p in text_paragraphs for line in _wrap(p, 60) + [""]]
+    try:
+        font = ImageFont.load_default(size=28)
+    except TypeError:  # Pillow < 10.1: solo il font bitmap
+        font = ImageFont.load_default()
+    image = Image.new("L", (1400, 60 + 40 * len(lines)), 255)
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((40, 30 + 40 * i), line, fill=0, font=font)
+    image.save(path, format="PNG", optimize=False)
+    return True
+
+
+def write_wav(path: Path, rng: random.Random, seconds: float, rate: int = 16_000) -> None:
+    """Sequenza di toni mono a 16 kHz (il formato che Whisper usa internamente)"""
+    frames = bytearray()
+    samples_per_tone = rate // 4
+    total = int(seconds * rate)
+    freq = 440.0
+    for i in range(total):
+        if i % samples_per_tone == 0:
+            freq = rng.choice([220.0, 330.0, 440.0, 550.0, 660.0])
+        frames += struct.pack("<h", int(8000 * math.sin(2 * math.pi * freq * i / rate)))
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(bytes(frames))
+
+
+# ---------------------------------------------------------------------------
+# Corpus
+# ---------------------------------------------------------------------------
+def build_corpus(out_dir: str | Path, seed: int = 0, per_type: int = 3, pdf_paragraphs: int = 40,
+                 table_rows: int = 200, audio_seconds: float = 20.0,
+                 types: Optional[List[str]] = None) -> Dict[str, object]:
+    """Scrive il corpus in ``out_dir`` e restituisce il manifest (salvato anche come manifest.json)"""
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    types = types or ["pdf", "csv", "xlsx", "png", "wav"]
+    files, skipped = [], []
+
+    for kind in types:
+        for i in range(per_type):
+            # Un generatore per file: aggiungere un tipo non cambia gli altri file
+            rng = random.Random(f"{seed}:{kind}:{i}")
+            path = out / f"bench_{kind}_{i:02d}.{kind}"
+            if kind == "pdf":
+                write_pdf(path, paragraphs(rng, pdf_paragraphs))
+            elif kind == "csv":
+                write_csv(path, _table(rng, table_rows))
+            elif kind == "xlsx":
+                write_xlsx(path, _table(rng, table_rows))
+            elif kind == "png":
+                if not write_image(path, paragraphs(rng, 3, sentences=4)):
+                    skipped.append({"file": path.name, "reason": "Pillow non installato"})
+                    continue
+            elif kind == "wav":
+                write_wav(path, rng, audio_seconds)
+            else:
+                raise ValueError(f"Tipo non supportato dal corpus sintetico: {kind}")
+            files.append({"file": path.name, "type": kind, "bytes": path.stat().st_size,
+                          "sha256": hashlib.sha256(path.read_bytes()).hexdigest()})
+
+    manifest = {"seed": seed, "per_type": per_type, "files": files, "skipped": skipped}
+    (out / "manifest.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    return manifest
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Genera il corpus sintetico dei benchmark")
+    parser.add_argument("out_dir")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--per-type", type=int, default=3)
+    parser.add_argument("--types", default="pdf,csv,xlsx,png,wav")
+    args = parser.parse_args()
+
+    manifest = build_corpus(args.out_dir, args.seed, args.per_type, types=args.types.split(","))
+    print(f"{len(manifest['files'])} file scritti in {args.out_dir}")
+    for item in manifest["skipped"]:
+        print(f"  saltato {item['file']}: {item['reason']}")
+
+
+if __name__ == "__main__":
+    main()
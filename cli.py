@@ -0,0 +1,441 @@
+"""cli.py – Elaborazione headless di intere cartelle (backfill)
+-----------------------------------------------------------------------
+Percorre un albero di cartelle ed esegue ingest → chunk → riassunto e,
+su richiesta, l'accumulation finale, senza passare dal server Flask.
+
+- Memoria limitata: i file vengono elaborati a lotti di ``--batch-size``;
+  l'estrazione del lotto successivo procede mentre quello corrente viene
+  riassunto, quindi in memoria ci sono al più due lotti.
+- Estrazione parallela in ``--workers`` processi (OCR, PDF e Whisper sono
+  CPU-bound), chiamate al modello concorrenti nel processo principale.
+- Ripristinabile: ``<output>/state.sqlite`` registra ogni file concluso
+  (percorso, dimensione, data di modifica). Dopo un crash si rilancia lo
+  stesso comando e i file già fatti vengono saltati; un file modificato
+  nel frattempo viene rielaborato.
+- Output JSONL: una riga per file in ``<output>/summaries.jsonl``, scritta
+  e sincronizzata su disco prima di segnare il file come concluso (dopo un
+  crash può comparire una riga ripetuta: vale l'ultima per ``path``).
+- Costi: token e costo di ogni chiamata al modello finiscono in
+  ``<output>/usage.db`` (vedi utils/usage.py); con ``--max-cost`` o
+  ``--max-total-tokens`` il run si ferma al superamento, riprendibile.
+
+Uso:
+    python cli.py run <cartella> --output <cartella_output>
+        [--keywords costi,emissioni] [--workers 4] [--batch-size 32]
+        [--accumulate] [--mode live|batch] [--retry-errors] [--max-cost 25]
+    python cli.py status --output <cartella_output>
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT / "summarize"))
+sys.path.insert(0, str(ROOT / "formatting"))
+sys.path.insert(0, str(ROOT))
+
+from ingest.extractor import (extractDocument, loadConfig, isValidDocument, isValidImage,  # noqa: E402
+                              isValidMedia)
+from formatting.storing import open_database  # noqa: E402
+from formatting.summary_index import summary_id  # noqa: E402
+from utils.metrics import JobTimings  # noqa: E402
+from utils.cancellation import CancelToken, JobCancelled, cancelScope  # noqa: E402
+from utils.usage import UsageLedger, UsageStore, usageScope  # noqa: E402
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    status TEXT NOT NULL,
+    summary_id TEXT,
+    error TEXT,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_files_status ON files(status);
+"""
+
+# Stati che non richiedono altro lavoro (se il file non è cambiato)
+FINAL_STATUSES = ("done", "skipped")
+
+
+# ---------------------------------------------------------------------------
+# Estrazione nei processi worker
+# ---------------------------------------------------------------------------
+_worker_config: Optional[Dict[str, Any]] = None
+_worker_verbose = False
+
+
+def _init_worker(config_path: str, verbose: bool) -> None:
+    global _worker_config, _worker_verbose
+    _worker_config = loadConfig(config_path)
+    _worker_verbose = verbose
+
+
+def _extract_file(path: str, rel_path: str) -> Dict[str, Any]:
+    """Estrae un file nel processo worker; non solleva mai eccezioni"""
+    started = time.perf_counter()
+    sink = contextlib.nullcontext() if _worker_verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with sink:
+            document = extractDocument(path, _worker_config)
+        if document is not None:
+            # Il percorso relativo distingue file omonimi in cartelle diverse
+            document["filename"] = rel_path
+        return {"document": document, "seconds": time.perf_counter() - started}
+    except Exception as e:
+        return {"document": None, "error": f"{type(e).__name__}: {e}", "seconds": time.perf_counter() - started}
+
+
+# ---------------------------------------------------------------------------
+# Stato e input
+# ---------------------------------------------------------------------------
+class RunState:
+    """Avanzamento persistente del backfill, un record per file"""
+
+    def __init__(self, output_dir: Path):
+        self.db_path = output_dir / "state.sqlite"
+
+    def _db(self):
+        return open_database(self.db_path, STATE_SCHEMA)
+
+    def is_done(self, rel_path: str, size: int, mtime: float, retry_errors: bool) -> bool:
+        row = self._db().execute("SELECT size, mtime, status FROM files WHERE path = ?", (rel_path,)).fetchone()
+        if row is None or row["size"] != size or row["mtime"] != mtime:
+            return False
+        return row["status"] in FINAL_STATUSES or (row["status"] == "error" and not retry_errors)
+
+    def mark(self, entries: List[Dict[str, Any]]) -> None:
+        now = datetime.now(timezone.utc).isoformat()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime, status, summary_id, error, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(e["path"], e["size"], e["mtime"], e["status"], e.get("summary_id"), e.get("error"), now)
+                 for e in entries]
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._db().execute("SELECT status, COUNT(*) AS n FROM files GROUP BY status").fetchall()
+        return {r["status"]: r["n"] for r in rows}
+
+    def errors(self, limit: int = 20) -> List[Dict[str, Any]]:
+        rows = self._db().execute(
+            "SELECT path, error FROM files WHERE status = 'error' ORDER BY updated_at DESC LIMIT ?", (limit,))
+        return [dict(r) for r in rows]
+
+
+def iter_files(input_dir: Path) -> Iterator[Path]:
+    """File supportati dell'albero, in ordine stabile, senza caricare l'elenco in memoria"""
+    try:
+        entries = sorted(os.scandir(input_dir), key=lambda e: e.name)
+    except OSError as e:
+        print(f"Cartella non leggibile: {input_dir} ({e})", file=sys.stderr)
+        return
+    for entry in entries:
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_files(Path(entry.path))
+        elif entry.is_file() and (isValidDocument(entry.path) or isValidImage(entry.path)
+                                  or isValidMedia(entry.path)):
+            yield Path(entry.path)
+
+
+def pending_files(input_dir: Path, state: RunState, retry_errors: bool) -> Iterator[Dict[str, Any]]:
+    for path in iter_files(input_dir):
+        stat = path.stat()
+        rel_path = path.relative_to(input_dir).as_posix()
+        if not state.is_done(rel_path, stat.st_size, stat.st_mtime, retry_errors):
+            yield {"abs": str(path), "path": rel_path, "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def batched(items: Iterator[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ---------------------------------------------------------------------------
+# Esecuzione
+# ---------------------------------------------------------------------------
+class Progress:
+
+    def __init__(self, total: int, already_done: int):
+        self.total = total
+        self.already_done = already_done
+        self.done = self.skipped = self.errors = 0
+        self.started = time.perf_counter()
+
+    def update(self, status: str, count: int = 1) -> None:
+        if status == "done":
+            self.done += count
+        elif status == "skipped":
+            self.skipped += count
+        else:
+            self.errors += count
+
+    def report(self) -> str:
+        handled = self.done + self.skipped + self.errors
+        elapsed = time.perf_counter() - self.started
+        rate = handled / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - handled
+        eta = f"{remaining / rate / 60:.1f} min" if rate > 0 else "-"
+        pct = 100 * (handled + self.already_done) / max(1, self.total + self.already_done)
+        return (f"[{pct:5.1f}%] {handled}/{self.total} file | {rate:.2f} file/s | "
+                f"riassunti {self.done} | saltati {self.skipped} | errori {self.errors} | ETA {eta}")
+
+
+async def _extract_batch(loop, pool, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    outputs = await asyncio.gather(*(loop.run_in_executor(pool, _extract_file, item["abs"], item["path"])
+                                     for item in batch))
+    return [{**item, **out} for item, out in zip(batch, outputs)]
+
+
+def _write_jsonl(path: Path, rows: List[Dict[str, Any]]) -> None:
+    if not rows:
+        return
+    with open(path, "a", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+async def run(args) -> int:
+    """Backfill con registro dei token; superato il budget il run si ferma"""
+    output_dir = Path(args.output).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    token = CancelToken()
+    ledger = UsageLedger(f"cli-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{os.getpid()}",
+                         maxTokens=args.max_total_tokens, maxCost=args.max_cost, cancelToken=token)
+    outcome = "error"
+    try:
+        with cancelScope(token), usageScope(ledger):
+            result = await _run(args)
+        outcome = "success" if result == 0 else "error"
+        return result
+    except JobCancelled as e:
+        outcome = "cancelled"
+        print(f"Run interrotto ({e.reason}): rilanciare lo stesso comando per riprendere", file=sys.stderr)
+        return 1
+    finally:
+        totals = ledger.report()["totals"]
+        print(f"Token: {totals['prompt_tokens']} in / {totals['completion_tokens']} out "
+              f"({totals['cached_tokens']} in cache), costo stimato {totals['cost_usd']:.4f}$")
+        UsageStore(str(output_dir / "usage.db")).save(
+            ledger, status=outcome, priority="bulk",
+            keywords=[k.strip() for k in (args.keywords or "").split(",") if k.strip()])
+
+
+async def _run(args) -> int:
+    from chunker import Chunker, ChunkerConfig, init_environment
+
+    init_environment()
+    # Nessun traffico interactive da proteggere: il tetto di chiamate al modello
+    # del processo è quello dei flag (documenti in parallelo × chiamate per documento)
+    os.environ.setdefault("SUMMY_LLM_SLOTS", str(args.parallel_files * args.concurrency))
+    input_dir = Path(args.input_dir).resolve()
+    output_dir = Path(args.output).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    summaries_path = output_dir / "summaries.jsonl"
+    keywords = [k.strip() for k in (args.keywords or "").split(",") if k.strip()]
+
+    state = RunState(output_dir)
+    total = sum(1 for _ in pending_files(input_dir, state, args.retry_errors))
+    already = sum(state.counts().get(s, 0) for s in FINAL_STATUSES)
+    print(f"{total} file da elaborare in {input_dir} ({already} già conclusi in run precedenti)")
+
+    cfg = ChunkerConfig(
+        max_tokens=args.max_tokens,
+        adaptive_chunking=True,
+        handle_audio_video=True,
+        model_map=args.model_map,
+        model_reduce=args.model_reduce,
+        model_escalation=args.model_escalation or None,
+        max_concurrency=args.concurrency,
+        max_parallel_files=args.parallel_files,
+        execution_mode=args.mode,
+        batch_dir=str(output_dir / "batch"),
+        # Un lotto interrotto a metà riparte dalle risposte già ricevute
+        store_partials=True,
+        checkpoint_dir=str(output_dir / "checkpoints"),
+    )
+    chunker = Chunker(cfg)
+    if keywords:
+        chunker.set_keywords(keywords)
+    settings = cfg.output_settings()
+
+    timings = JobTimings()
+    progress = Progress(total, already)
+    loop = asyncio.get_running_loop()
+    pool_kwargs = {"max_workers": args.workers, "mp_context": multiprocessing.get_context("spawn"),
+                   "initializer": _init_worker, "initargs": (str(Path(args.config).resolve()), args.verbose)}
+    if sys.version_info >= (3, 11):
+        # Un worker viene riciclato ogni N file: le perdite di memoria dei motori non si accumulano
+        pool_kwargs["max_tasks_per_child"] = args.max_tasks_per_child
+
+    with ProcessPoolExecutor(**pool_kwargs) as pool:
+        batches = batched(pending_files(input_dir, state, args.retry_errors), args.batch_size)
+        current = next(batches, None)
+        extracting = asyncio.ensure_future(_extract_batch(loop, pool, current)) if current else None
+
+        while extracting is not None:
+            # "ingest_wait": tempo in cui il riassunto resta fermo ad aspettare l'estrazione
+            with timings.stage("ingest_wait"):
+                extracted = await extracting
+            timings.stages["extraction_cpu"] = (timings.stages.get("extraction_cpu", 0.0)
+                                                + sum(item["seconds"] for item in extracted))
+
+            # Il lotto successivo si estrae mentre questo viene riassunto
+            upcoming = next(batches, None)
+            extracting = asyncio.ensure_future(_extract_batch(loop, pool, upcoming)) if upcoming else None
+
+            marks = []
+            docs = [item for item in extracted if item.get("document")]
+            for item in extracted:
+                if item.get("error"):
+                    marks.append({**item, "status": "error"})
+                elif not item.get("document"):
+                    marks.append({**item, "status": "skipped"})
+
+            rows = []
+            if docs:
+                try:
+                    with timings.stage("summarize"):
+                        summaries = await chunker.process_documents([item["document"] for item in docs])
+                except Exception as e:
+                    # Un lotto fallito non ferma il backfill: i suoi file restano da rifare
+                    print(f"Errore nel riassunto del lotto: {e}", file=sys.stderr)
+                    marks.extend({**item, "status": "error", "error": f"summarize: {e}"} for item in docs)
+                    summaries = []
+                for item, summary in zip(docs, summaries):
+                    sid = summary_id(item["document"], settings, keywords)
+                    rows.append({"path": item["path"], "summary_id": sid, **summary})
+                    if summary.get("fallback"):
+                        # Riassunto degradato: la riga resta nel JSONL, --retry-errors lo rifà
+                        marks.append({**item, "status": "error", "summary_id": sid,
+                                      "error": "summarize: risposta del modello mancante, usato il testo grezzo"})
+                    else:
+                        marks.append({**item, "status": "done", "summary_id": sid})
+
+            _write_jsonl(summaries_path, rows)
+            state.mark(marks)
+            for mark in marks:
+                progress.update(mark["status"])
+            print(progress.report(), flush=True)
+
+    result = 0
+    if args.accumulate:
+        result = await accumulate(output_dir, summaries_path, keywords, chunker, timings)
+
+    print("\n=== BACKFILL ===")
+    print(progress.report())
+    print(f"Tempi per fase (s): {timings.report()}")
+    print(f"Output: {summaries_path}")
+    for err in state.errors(limit=10):
+        print(f"  errore: {err['path']}: {err['error']}")
+    return result if progress.errors == 0 else 1
+
+
+async def accumulate(output_dir: Path, summaries_path: Path, keywords: List[str], chunker, timings) -> int:
+    """Accumulation di tutti i riassunti del JSONL (l'ultima riga per file vince)"""
+    from formatting.accumulation import accumulation_async
+    from checkpoint import CheckpointStore, job_key
+
+    if not summaries_path.exists():
+        print("Nessun riassunto da accumulare")
+        return 0
+    by_path: Dict[str, Dict[str, Any]] = {}
+    with open(summaries_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                by_path[row["path"]] = {"filename": row["path"], "content": row.get("content", "")}
+
+    batch_runner = chunker.batch_runner() if chunker.cfg.execution_mode == "batch" else None
+    docs = list(by_path.values())
+    checkpoint = None
+    if batch_runner is None:
+        checkpoint = CheckpointStore(chunker.cfg.checkpoint_dir, job_key("accumulation", docs, keywords))
+    with timings.stage("accumulation"):
+        result = await accumulation_async(docs, keywords, client=chunker.client,
+                                          batch_runner=batch_runner, checkpoint=checkpoint)
+    out = output_dir / "accumulated.json"
+    out.write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"Accumulation di {len(by_path)} riassunti: {out}")
+    ok = isinstance(result, dict) and "error" not in result
+    if ok and checkpoint is not None:
+        checkpoint.clear()
+    return 0 if ok else 1
+
+
+def status(args) -> int:
+    state = RunState(Path(args.output).resolve())
+    print(json.dumps(state.counts(), indent=2))
+    for err in state.errors():
+        print(f"  errore: {err['path']}: {err['error']}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Ingest e riassunto headless di interi alberi di cartelle")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="elabora (o riprende) un backfill")
+    run_parser.add_argument("input_dir")
+    run_parser.add_argument("--output", required=True, help="cartella di output (JSONL e stato)")
+    run_parser.add_argument("--keywords", help="keywords separate da virgola")
+    run_parser.add_argument("--config", default=str(ROOT / "config.json"))
+    run_parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                            help="processi di estrazione")
+    run_parser.add_argument("--max-tasks-per-child", type=int, default=200)
+    run_parser.add_argument("--batch-size", type=int, default=32, help="file per lotto")
+    run_parser.add_argument("--parallel-files", type=int, default=8, help="documenti riassunti in parallelo")
+    run_parser.add_argument("--concurrency", type=int, default=5, help="chiamate in parallelo per documento")
+    run_parser.add_argument("--max-tokens", type=int, default=1024)
+    run_parser.add_argument("--mode", choices=["live", "batch"], default="live")
+    run_parser.add_argument("--accumulate", action="store_true", help="accumulation finale dei riassunti")
+    run_parser.add_argument("--retry-errors", action="store_true", help="riprova i file falliti in precedenza")
+    run_parser.add_argument("--verbose", action="store_true", help="mostra i log dell'estrazione")
+    run_parser.add_argument("--model-map", default="gpt-4o-mini", help="modello delle map (vedi summarize/routing.py)")
+    run_parser.add_argument("--model-reduce", default="gpt-4o", help="modello di reduce, tabelle e chunk lunghi")
+    run_parser.add_argument("--model-escalation", default="gpt-4o",
+                            help="modello per le risposte non valide ('' per disattivare)")
+    run_parser.add_argument("--max-cost", type=float, help="budget in dollari: oltre, il run si ferma")
+    run_parser.add_argument("--max-total-tokens", type=int, help="budget in token (prompt + output)")
+
+    status_parser = sub.add_parser("status", help="avanzamento di un backfill")
+    status_parser.add_argument("--output", required=True)
+
+    args = parser.parse_args()
+    if args.command == "status":
+        return status(args)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
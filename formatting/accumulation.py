@@ -1,22 +1,251 @@
 import os
 import json
+import asyncio
 import logging
-from openai import OpenAI
 from formatting.flushing import flush
+from utils.metrics import llmCall, recordUsage
+from utils.scheduler import llmScheduler
+from utils.cancellation import currentToken
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def accumulation(json_data, keywords=None):
+# Scrive la struttura finale: resta sul modello forte (SUMMY_MODEL_ACCUMULATION per cambiarlo)
+ACCUMULATION_MODEL = os.getenv("SUMMY_MODEL_ACCUMULATION", "gpt-4o")
+# Token di input massimi per singola chiamata (riassunti + istruzioni)
+TOKEN_BUDGET = 60_000
+MAX_CONCURRENCY = 5
+REQUEST_TIMEOUT = 120
+# Livelli massimi di fusione delle scalette prima della chiamata finale
+MAX_LEVELS = 4
+
+SYSTEM_PROMPT = "Sei un assistente specializzato nella creazione di documenti ben strutturati e armoniosi. Organizzi il contenuto in sezioni logiche e naturali, mantenendo un flusso narrativo chiaro e professionale. Crei titoli descrittivi e naturali per le sezioni."
+
+_encoder = None
+
+def count_tokens(text):
+    """Conta i token con tiktoken se disponibile, altrimenti stima ~4 caratteri/token"""
+    global _encoder
+    if tiktoken is None:
+        return len(text) // 4
+    if _encoder is None:
+        try:
+            _encoder = tiktoken.encoding_for_model(ACCUMULATION_MODEL)
+        except KeyError:
+            _encoder = tiktoken.get_encoding("cl100k_base")
+    return len(_encoder.encode(text, disallowed_special=()))
+
+def _split_by_tokens(text, budget):
+    """Spezza un testo in parti di al massimo ``budget`` token misurati con count_tokens"""
+    if tiktoken is None:
+        # La stima è len // 4: tagliare a 4 caratteri per token è esatto
+        step = max(budget, 1) * 4
+        return [text[i:i + step] for i in range(0, len(text), step)]
+    count_tokens("")  # inizializza l'encoder
+    tokens = _encoder.encode(text, disallowed_special=())
+    pieces = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + max(budget, 1), len(tokens))
+        piece = _encoder.decode(tokens[start:end])
+        # Decodificare e ricodificare può cambiare il conteggio di qualche token
+        while end - start > 1 and count_tokens(piece) > budget:
+            end -= max(1, (end - start) // 20)
+            piece = _encoder.decode(tokens[start:end])
+        pieces.append(piece)
+        start = end
+    return pieces
+
+def _messages_tokens(messages):
+    return sum(count_tokens(m["content"]) for m in messages)
+
+def _new_client():
+    # Import differito: openai serve solo quando parte davvero una chiamata
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+def accumulation(json_data, keywords=None, batch_runner=None):
+    """Unisce i riassunti in un documento Titolo/Sezioni.
+
+    Wrapper sincrono di ``accumulation_async``. Se viene passato un
+    ``batch_runner`` (vedi summarize/batching.py) le richieste vengono
+    eseguite tramite Batch API invece che in tempo reale.
+    """
+    return asyncio.run(accumulation_async(json_data, keywords, batch_runner=batch_runner))
+
+async def accumulation_async(json_data, keywords=None, client=None, batch_runner=None,
+                             token_budget=TOKEN_BUDGET, max_concurrency=MAX_CONCURRENCY,
+                             checkpoint=None, cancel_token=None, model=None):
+    """Map-reduce dei riassunti con budget di token.
+
+    Se tutti i riassunti stanno nel budget basta una chiamata. Altrimenti
+    vengono divisi in gruppi entro il budget, per ogni gruppo si costruisce
+    in parallelo una scaletta di sezioni e le scalette vengono fuse (anche
+    su più livelli) fino alla struttura finale Titolo/Sezioni.
+
+    Con ``checkpoint`` (un ``CheckpointStore``, vedi summarize/checkpoint.py)
+    ogni risposta viene salvata appena arriva: rilanciare lo stesso lavoro
+    dopo un errore ripete solo le chiamate mancanti.
+
+    Con ``cancel_token`` (o il token del job corrente) l'annullamento
+    cancella le chiamate in attesa e solleva JobCancelled. ``model`` sostituisce
+    ACCUMULATION_MODEL.
+    """
     logger.info(f"Accumulation chiamata con keywords: {keywords}")
 
-    # Inizializza il client OpenAI
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    if not os.getenv("OPENAI_API_KEY"):
+        raise EnvironmentError("OPENAI_API_KEY non trovata nelle variabili d'ambiente.")
+
+    contents = _extract_contents(json_data)
+    if contents is None:
+        return None
+
+    if not "".join(contents).strip():
+        print("Non sono stati trovati contenuti rilevanti")
+        return None
+
+    owns_client = client is None and batch_runner is None
+    if owns_client:
+        client = _new_client()
+
+    executor = _executor(client, batch_runner, max_concurrency, checkpoint, cancel_token, model)
+
+    try:
+        # Spazio riservato a istruzioni e focus tematico
+        budget = token_budget - count_tokens(_final_prompt("", keywords)) - count_tokens(SYSTEM_PROMPT)
+
+        contents = await _reduce_to_budget(contents, budget, executor, keywords)
+
+        contenuto_completo = "".join(f"\n\n{c}" for c in contents)
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": _final_prompt(contenuto_completo, keywords)}
+        ]
+        if _messages_tokens(messages) > token_budget:
+            return _over_budget_error(messages, token_budget)
+
+        logger.info("Invio richiesta a OpenAI per accumulation...")
+        result = (await executor.call("accumulation", [messages]))[0]
+        if result is None:
+            return {"error": "Nessuna risposta dal modello per l'accumulation"}
+
+        logger.info("Risposta ricevuta da OpenAI")
+        return _parse_result(result)
+
+    except Exception as e:
+        print(f"Errore nella chiamata a OpenAI: {str(e)}")
+        return {"error": f"Errore nel server: {str(e)}"}
+    finally:
+        if owns_client:
+            await client.close()
+
+def accumulation_incremental(existing_result, json_data, keywords=None, batch_runner=None,
+                             existing_documents=None):
+    """Wrapper sincrono di ``accumulation_incremental_async``"""
+    return asyncio.run(accumulation_incremental_async(existing_result, json_data, keywords,
+                                                      batch_runner=batch_runner,
+                                                      existing_documents=existing_documents))
+
+async def accumulation_incremental_async(existing_result, json_data, keywords=None, client=None,
+                                         batch_runner=None, token_budget=TOKEN_BUDGET,
+                                         max_concurrency=MAX_CONCURRENCY, checkpoint=None,
+                                         cancel_token=None, model=None, existing_documents=None):
+    """Unisce nuovi riassunti in una struttura Titolo/Sezioni già esistente.
+
+    Il costo dipende solo dai nuovi documenti: la struttura esistente viene
+    passata così com'è e il modello integra i contenuti nuovi nelle sezioni
+    pertinenti o ne aggiunge di nuove.
+
+    Se la struttura da sola lascia ai nuovi contenuti meno di un quarto del
+    budget si rifà un'accumulation completa: sui riassunti originali
+    (``existing_documents``) se disponibili, altrimenti sul testo delle
+    sezioni esistenti, che il map-reduce condensa come qualsiasi altro testo.
+    """
+    logger.info(f"Accumulation incrementale con keywords: {keywords}")
+
+    if not isinstance(existing_result, dict) or "Sezioni" not in existing_result:
+        # Nessuna struttura valida da estendere: si riparte da zero
+        return await accumulation_async(json_data, keywords, client=client, batch_runner=batch_runner,
+                                        token_budget=token_budget, max_concurrency=max_concurrency,
+                                        checkpoint=checkpoint, cancel_token=cancel_token, model=model)
 
     if not os.getenv("OPENAI_API_KEY"):
         raise EnvironmentError("OPENAI_API_KEY non trovata nelle variabili d'ambiente.")
 
+    contents = _extract_contents(json_data)
+    if not contents or not "".join(contents).strip():
+        return existing_result
+
+    owns_client = client is None and batch_runner is None
+    if owns_client:
+        client = _new_client()
+
+    executor = _executor(client, batch_runner, max_concurrency, checkpoint, cancel_token, model)
+
+    try:
+        struttura = json.dumps(existing_result, ensure_ascii=False, indent=2)
+        budget = (token_budget - count_tokens(_merge_prompt(struttura, "", keywords))
+                  - count_tokens(SYSTEM_PROMPT))
+        if budget < token_budget // 4:
+            logger.info("Struttura esistente troppo grande per l'unione incrementale: accumulation completa")
+            previous = existing_documents if existing_documents else [_structure_text(existing_result)]
+            return await accumulation_async(list(previous) + contents, keywords, client=client,
+                                            batch_runner=batch_runner, token_budget=token_budget,
+                                            max_concurrency=max_concurrency, checkpoint=checkpoint,
+                                            cancel_token=cancel_token, model=model)
+        contents = await _reduce_to_budget(contents, budget, executor, keywords)
+
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": _merge_prompt(struttura, "\n\n".join(contents), keywords)}
+        ]
+        if _messages_tokens(messages) > token_budget:
+            return _over_budget_error(messages, token_budget)
+
+        result = (await executor.call("accumulation-merge", [messages]))[0]
+        if result is None:
+            return {"error": "Nessuna risposta dal modello per l'accumulation incrementale"}
+        return _parse_result(result)
+
+    except Exception as e:
+        print(f"Errore nella chiamata a OpenAI: {str(e)}")
+        return {"error": f"Errore nel server: {str(e)}"}
+    finally:
+        if owns_client:
+            await client.close()
+
+async def _reduce_to_budget(contents, budget, executor, keywords):
+    """Condensa i testi in scalette, livello dopo livello, finché stanno nel budget"""
+    level = 0
+    total_tokens = sum(count_tokens(c) for c in contents)
+    while total_tokens > budget and level < MAX_LEVELS:
+        groups = _group_by_budget(contents, budget)
+        logger.info(f"Accumulation livello {level}: {len(contents)} testi in {len(groups)} gruppi")
+        messages = [_outline_messages("\n\n".join(g), keywords) for g in groups]
+        outputs = await executor.call(f"accumulation-outline-{level}", messages)
+        contents = [_outline_to_text(raw, "\n\n".join(g)) for raw, g in zip(outputs, groups)]
+        level += 1
+
+        new_total = sum(count_tokens(c) for c in contents)
+        if new_total >= total_tokens:
+            # Le scalette non riducono più il testo: inutile un altro livello
+            break
+        total_tokens = new_total
+    return contents
+
+def _over_budget_error(messages, token_budget):
+    """Le scalette non sono bastate (o sono fallite): meglio un errore che una chiamata oltre il budget"""
+    tokens = _messages_tokens(messages)
+    logger.error(f"Accumulation oltre il budget dopo la riduzione: {tokens} > {token_budget} token")
+    return {"error": f"Contenuto troppo lungo per l'accumulation: {tokens} token, oltre il budget di {token_budget}"}
+
+def _extract_contents(json_data):
     # Gestione di diversi formati di input
     if isinstance(json_data, list):
         # Se è già una lista, usala direttamente
@@ -38,8 +267,9 @@ def accumulation(json_data, keywords=None):
         print(f"Formato dati non supportato: {type(json_data)}")
         return None
 
-    # Estrai e combina i contenuti
-    contenuto_completo = ""
+    # Estrai i contenuti
+    contents = []
+    visti = set()
     for doc in documents:
         # Gestione di diversi formati di documento
         if isinstance(doc, dict):
@@ -49,17 +279,42 @@ def accumulation(json_data, keywords=None):
         else:
             content = str(doc)
 
-        contenuto_completo += f"\n\n{content}"
+        # I quasi duplicati ricevono dal Chunker la stessa sintesi: basta includerla una volta
+        if content in visti:
+            continue
+        visti.add(content)
+        contents.append(content)
 
-    if not contenuto_completo.strip():
-        print("Non sono stati trovati contenuti rilevanti")
-        return None
+    return contents
+
+def _group_by_budget(contents, budget):
+    """Raggruppa i testi in ordine senza superare il budget; i testi troppo lunghi vengono spezzati"""
+    groups = []
+    current, current_tokens = [], 0
+    for content in contents:
+        pieces = [content]
+        tokens = count_tokens(content)
+        if tokens > budget:
+            pieces = _split_by_tokens(content, budget)
 
+        for piece in pieces:
+            piece_tokens = tokens if len(pieces) == 1 else count_tokens(piece)
+            if current and current_tokens + piece_tokens > budget:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+
+    if current:
+        groups.append(current)
+    return groups
+
+def _keywords_context(keywords):
     # Costruisci il contesto delle keywords
-    keywords_context = ""
-    if keywords and len(keywords) > 0:
-        keywords_text = ", ".join(keywords)
-        keywords_context = f"""
+    if not keywords:
+        return ""
+    keywords_text = ", ".join(keywords)
+    return f"""
 ## FOCUS TEMATICO ##
 TEMI DI INTERESSE: {keywords_text}
 
@@ -70,6 +325,45 @@ ISTRUZIONI:
 - Mantieni il flusso narrativo e la coerenza del documento
 - Assicurati che i temi richiesti siano ben rappresentati nel documento finale"""
 
+def _outline_messages(testo, keywords):
+    prompt = (
+        "## ISTRUZIONI ##\n"
+        "1. Il testo seguente è una parte di un insieme più ampio di documenti\n"
+        "2. Organizzalo in sezioni logiche con titoli naturali e descrittivi\n"
+        "3. Conserva fatti, dati, nomi e terminologia tecnica\n"
+        "4. Elimina ripetizioni e ridondanze"
+        + _keywords_context(keywords) +
+        "\n\n## FORMATO RICHIESTO ##\n"
+        "Devi restituire SOLO un oggetto JSON con questa struttura:\n"
+        "{\n"
+        "  \"Sezioni\": [\n"
+        "    {\"titolo\": \"Titolo sezione\", \"contenuto\": \"Contenuto dettagliato della sezione\"}\n"
+        "  ]\n"
+        "}\n\n"
+        "## TESTO DA ANALIZZARE ##\n"
+        f"{testo}"
+    )
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+def _structure_text(result):
+    """Testo delle sezioni di una struttura Titolo/Sezioni"""
+    sezioni = result.get("Sezioni", []) if isinstance(result, dict) else []
+    parti = [f"### {s.get('titolo', '')}\n{s.get('contenuto', '')}" for s in sezioni if isinstance(s, dict)]
+    return "\n\n".join(parti)
+
+def _outline_to_text(raw, fallback):
+    """Converte una scaletta JSON in testo per il livello successivo"""
+    if raw is None:
+        return fallback
+    try:
+        return _structure_text(json.loads(raw)) or fallback
+    except (json.JSONDecodeError, AttributeError):
+        return fallback
+
+def _final_prompt(contenuto_completo, keywords):
     # Prompt migliorato con istruzioni chiare
     prompt_base = """## ISTRUZIONI PRINCIPALI ##
 1. Analizza il seguente testo combinato da più documenti
@@ -95,10 +389,10 @@ ISTRUZIONI:
 - Mantieni una struttura chiara e organizzata
 - Crea titoli di sezione naturali e descrittivi"""
 
-    prompt = (
+    return (
         prompt_base +
         prompt_instructions +
-        keywords_context +
+        _keywords_context(keywords) +
         "\n\n## FORMATO RICHIESTO ##\n"
         "Devi restituire SOLO un oggetto JSON con questa struttura:\n"
         "{\n"
@@ -113,35 +407,109 @@ ISTRUZIONI:
         f"{contenuto_completo}"
     )
 
-    logger.info("Invio richiesta a OpenAI per accumulation...")
+def _merge_prompt(struttura, nuovi_contenuti, keywords):
+    return (
+        "## ISTRUZIONI PRINCIPALI ##\n"
+        "1. Ricevi un documento già strutturato (Titolo/Sezioni) e nuovi contenuti\n"
+        "2. Integra i nuovi contenuti nelle sezioni pertinenti del documento\n"
+        "3. Crea nuove sezioni solo per argomenti non ancora trattati\n"
+        "4. Non eliminare informazioni già presenti, salvo ripetizioni\n"
+        "5. Aggiorna il titolo solo se il nuovo materiale ne cambia l'argomento\n"
+        "6. Mantieni il flusso narrativo e la coerenza del testo"
+        + _keywords_context(keywords) +
+        "\n\n## FORMATO RICHIESTO ##\n"
+        "Devi restituire SOLO il documento aggiornato come oggetto JSON con la stessa struttura:\n"
+        "{\n"
+        "  \"Titolo\": \"Titolo professionale\",\n"
+        "  \"Sezioni\": [\n"
+        "    {\"titolo\": \"Titolo sezione\", \"contenuto\": \"Contenuto dettagliato della sezione\"}\n"
+        "  ]\n"
+        "}\n\n"
+        "## DOCUMENTO ESISTENTE ##\n"
+        f"{struttura}\n\n"
+        "## NUOVI CONTENUTI ##\n"
+        f"{nuovi_contenuti}"
+    )
+
+def _parse_result(result):
+    # Validazione del risultato
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Sei un assistente specializzato nella creazione di documenti ben strutturati e armoniosi. Organizzi il contenuto in sezioni logiche e naturali, mantenendo un flusso narrativo chiaro e professionale. Crei titoli descrittivi e naturali per le sezioni."
-                },
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"},
-            timeout=60  # Timeout di 60 secondi
-        )
+        parsed_result = json.loads(result)
+        if "Titolo" not in parsed_result or "Sezioni" not in parsed_result:
+            print("Struttura JSON non valida nel risultato")
+            return result  # Restituisci comunque il risultato grezzo
+        return parsed_result
+    except json.JSONDecodeError:
+        print("Il modello non ha restituito JSON valido")
+        return result
 
-        logger.info("Risposta ricevuta da OpenAI")
-        result = response.choices[0].message.content
+def _executor(client, batch_runner, max_concurrency, checkpoint, cancel_token, model):
+    token = cancel_token or currentToken()
+    model = model or ACCUMULATION_MODEL
+    if batch_runner is not None:
+        return _BatchExecutor(batch_runner, token, model)
+    return _LiveExecutor(client, max_concurrency, checkpoint, token, model)
 
-        # Validazione del risultato
-        try:
-            parsed_result = json.loads(result)
-            if "Titolo" not in parsed_result or "Sezioni" not in parsed_result:
-                print("Struttura JSON non valida nel risultato")
-                return result  # Restituisci comunque il risultato grezzo
-            return parsed_result
-        except json.JSONDecodeError:
-            print("Il modello non ha restituito JSON valido")
-            return result
+class _LiveExecutor:
+    """Chiamate chat.completions in parallelo, limitate da un semaforo.
 
-    except Exception as e:
-        print(f"Errore nella chiamata a OpenAI: {str(e)}")
-        return {"error": f"Errore nel server: {str(e)}"}
+    Con un ``checkpoint`` le risposte già salvate non vengono richieste di
+    nuovo; ogni livello di scaletta è quindi un punto di ripresa.
+    """
+
+    def __init__(self, client, max_concurrency, checkpoint=None, token=None, model=ACCUMULATION_MODEL):
+        self.client = client
+        self.sem = asyncio.Semaphore(max_concurrency)
+        self.checkpoint = checkpoint
+        self.token = token
+        self.model = model
+
+    async def _one(self, stage, messages):
+        key = None
+        if self.checkpoint is not None:
+            key = self.checkpoint.key(stage, self.model, messages)
+            cached = self.checkpoint.get(stage, key)
+            if cached is not None:
+                return cached
+        async with self.sem, llmScheduler().asyncSlot():
+            try:
+                with llmCall("accumulation", self.model) as call:
+                    response = await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        response_format={"type": "json_object"},
+                        timeout=REQUEST_TIMEOUT
+                    )
+                recordUsage("accumulation", response, call)
+                content = response.choices[0].message.content
+            except Exception as e:
+                logger.error(f"Errore nella chiamata di accumulation: {str(e)}")
+                return None
+        if key is not None and content is not None:
+            self.checkpoint.put(stage, key, content)
+        return content
+
+    async def call(self, stage, messages_list):
+        calls = asyncio.gather(*(self._one(stage, m) for m in messages_list))
+        return await (self.token.run(calls) if self.token is not None else calls)
+
+class _BatchExecutor:
+    """Ogni round di chiamate diventa un job della Batch API."""
+
+    def __init__(self, batch_runner, token=None, model=ACCUMULATION_MODEL):
+        self.runner = batch_runner
+        self.token = token
+        self.model = model
+
+    async def call(self, stage, messages_list):
+        requests = [
+            self.runner.build_request(f"{stage}-{i}", {
+                "model": self.model,
+                "messages": messages,
+                "response_format": {"type": "json_object"},
+            })
+            for i, messages in enumerate(messages_list)
+        ]
+        run = self.runner.run(stage, requests)
+        outputs = await (self.token.run(run) if self.token is not None else run)
+        return [outputs.get(f"{stage}-{i}") for i in range(len(messages_list))]
@@ -0,0 +1,55 @@
+import json
+import os
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+RESULTS_DIR = Path(__file__).parent.parent / "output" / "results"
+
+def _result_path(result_id, results_dir=RESULTS_DIR):
+    # L'id arriva dal client: niente separatori di percorso
+    if not result_id or "/" in result_id or "\\" in result_id or result_id.startswith("."):
+        raise ValueError(f"ID risultato non valido: {result_id}")
+    return Path(results_dir) / f"{result_id}.json"
+
+def new_result_id():
+    return uuid.uuid4().hex
+
+def load_result(result_id, results_dir=RESULTS_DIR):
+    """Carica un risultato di accumulation salvato, None se non esiste"""
+    try:
+        path = _result_path(result_id, results_dir)
+    except ValueError:
+        return None
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_result(result_id, accumulated, documents, keywords=None, results_dir=RESULTS_DIR):
+    """Salva il risultato insieme ai riassunti per documento che lo hanno prodotto.
+
+    ``documents`` contiene i riassunti del Chunker (filename, content,
+    summary_id, ...): servono per unire nuovi file in seguito senza
+    ricalcolare tutto e per riconoscere quelli già inclusi.
+    """
+    path = _result_path(result_id, results_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    now = datetime.now().isoformat()
+    previous = load_result(result_id, results_dir)
+    record = {
+        "id": result_id,
+        "created_at": previous["created_at"] if previous else now,
+        "updated_at": now,
+        "keywords": keywords or [],
+        "documents": documents,
+        "result": accumulated,
+    }
+
+    # Scrittura atomica: un lettore concorrente non vede mai un file a metà
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(record, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+    return record
@@ -0,0 +1,158 @@
+import re
+import html
+from pathlib import Path
+
+from formatting.storing import open_database
+from summarize.relevance import analyze, SNOWBALL_LANGUAGES
+
+# Indice full-text (FTS5) su documenti estratti dall'ingest e riassunti
+SEARCH_DB = Path(__file__).parent.parent / "output" / "search_index.sqlite"
+
+# "body" conserva il testo originale (snippet e match esatti), "stems" il
+# testo analizzato per lingua (stopword rimosse, stemming Snowball) così
+# che "costi" trovi anche "costo" nei documenti italiani.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_docs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    filename TEXT,
+    language TEXT,
+    UNIQUE (kind, ref)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+    body, stems, tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+KINDS = ("document", "summary")
+SNIPPET_TOKENS = 16
+# Delimitatori provvisori dei match (uso privato Unicode): lo snippet viene
+# prima escapato come HTML e solo dopo riceve i tag <mark>
+_MARK_OPEN, _MARK_CLOSE = "\ue000", "\ue001"
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+def _connect(db_path=SEARCH_DB):
+    return open_database(db_path, SCHEMA)
+
+def _language(language):
+    language = (language or "").lower()[:2]
+    return language if language in SNOWBALL_LANGUAGES else None
+
+def index_text(kind, ref, text, filename=None, language=None, db_path=SEARCH_DB):
+    """Inserisce o sostituisce il testo di un documento o riassunto"""
+    if kind not in KINDS:
+        raise ValueError(f"Tipo non indicizzabile: {kind}")
+    language = _language(language)
+    stems = " ".join(analyze(text or "", language or "en"))
+
+    conn = _connect(db_path)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT id FROM search_docs WHERE kind = ? AND ref = ?", (kind, ref)).fetchone()
+        if row:
+            doc_id = row["id"]
+            conn.execute("UPDATE search_docs SET filename = ?, language = ? WHERE id = ?",
+                         (filename, language, doc_id))
+            conn.execute("DELETE FROM search_fts WHERE rowid = ?", (doc_id,))
+        else:
+            doc_id = conn.execute(
+                "INSERT INTO search_docs (kind, ref, filename, language) VALUES (?, ?, ?, ?)",
+                (kind, ref, filename, language)
+            ).lastrowid
+        conn.execute("INSERT INTO search_fts (rowid, body, stems) VALUES (?, ?, ?)",
+                     (doc_id, text or "", stems))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def index_document(kind, ref, doc, db_path=SEARCH_DB):
+    """Indicizza un JSON prodotto dall'ingest o dal Chunker"""
+    index_text(kind, ref, doc.get("content", ""), doc.get("filename"), doc.get("language"), db_path)
+
+def remove_entry(kind, ref, db_path=SEARCH_DB):
+    conn = _connect(db_path)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT id FROM search_docs WHERE kind = ? AND ref = ?", (kind, ref)).fetchone()
+        if row:
+            conn.execute("DELETE FROM search_fts WHERE rowid = ?", (row["id"],))
+            conn.execute("DELETE FROM search_docs WHERE id = ?", (row["id"],))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def clear_search_index(db_path=SEARCH_DB):
+    conn = _connect(db_path)
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("DELETE FROM search_fts")
+    conn.execute("DELETE FROM search_docs")
+    conn.execute("COMMIT")
+
+def _quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+def build_query(text, language=None):
+    """Traduce il testo dell'utente in una query FTS5 sicura.
+
+    Ogni parola deve comparire (AND), come prefisso nel testo originale
+    oppure come radice nella lingua richiesta; senza lingua si provano le
+    radici di tutte le lingue supportate. Gli operatori FTS5 digitati
+    dall'utente vengono trattati come testo.
+    """
+    languages = [language] if _language(language) else list(SNOWBALL_LANGUAGES)
+    clauses = []
+    for term in _TERM_RE.findall(text.lower()):
+        alternatives = {f"body : {_quote(term)} *"}
+        for lang in languages:
+            for stem in analyze(term, lang):
+                alternatives.add(f"stems : {_quote(stem)}")
+        clauses.append("(" + " OR ".join(sorted(alternatives)) + ")")
+    return " AND ".join(clauses)
+
+def _highlight(snippet):
+    """Snippet come HTML sicuro: testo del documento escapato, match in <mark>"""
+    escaped = html.escape(snippet or "")
+    return escaped.replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>")
+
+def search(text, kind=None, language=None, limit=20, offset=0, db_path=SEARCH_DB):
+    """Risultati ordinati per BM25 con snippet evidenziato.
+
+    Restituisce ``(results, has_more)``.
+    """
+    match = build_query(text, language)
+    if not match:
+        return [], False
+
+    clauses, params = ["search_fts MATCH ?"], [match]
+    if kind:
+        clauses.append("d.kind = ?")
+        params.append(kind)
+    if _language(language):
+        clauses.append("d.language = ?")
+        params.append(_language(language))
+
+    rows = _connect(db_path).execute(
+        "SELECT d.kind, d.ref, d.filename, d.language, "
+        f"snippet(search_fts, 0, '{_MARK_OPEN}', '{_MARK_CLOSE}', '…', {SNIPPET_TOKENS}) AS snippet, "
+        "bm25(search_fts, 1.0, 0.5) AS score "
+        "FROM search_fts JOIN search_docs d ON d.id = search_fts.rowid "
+        f"WHERE {' AND '.join(clauses)} ORDER BY score LIMIT ? OFFSET ?",
+        params + [limit + 1, offset]
+    ).fetchall()
+
+    results = [
+        {
+            "kind": row["kind"],
+            "id": row["ref"],
+            "filename": row["filename"],
+            "language": row["language"],
+            "snippet": _highlight(row["snippet"]),
+            # bm25() è negativo: più piccolo = più rilevante
+            "score": -row["score"],
+        }
+        for row in rows[:limit]
+    ]
+    return results, len(rows) > limit
@@ -1,33 +1,163 @@
 import json
 import os
+import sqlite3
+import threading
 from datetime import datetime
 
+# Archivio storico su SQLite in modalità WAL: append O(1), letture indicizzate
+# per ID, data e keyword, sicuro con più worker concorrenti.
+STORAGE_DB = "storico.sqlite"
+# Vecchio formato: viene importato una sola volta alla prima apertura
 STORAGE_FILE = "storico.json"
 
-def store_answer(toStore):
-    storico = []
-
-    # Carica file se esiste
-    if os.path.exists(STORAGE_FILE):
-        with open(STORAGE_FILE, "r") as f:
-            try:
-                storico = json.load(f)
-            except json.JSONDecodeError:
-                storico = []
-
-    # Aggiungi la nuova richiesta
-    storico.append(toStore)
-
-    # Salva aggiornato
-    with open(STORAGE_FILE, "w") as f:
-        json.dump(storico, f, indent=4)
-
-def get_stored_documents():
-    """Recupera tutti i documenti salvati nel file storico"""
-    if os.path.exists(STORAGE_FILE):
-        try:
-            with open(STORAGE_FILE, "r") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            return []
+_local = threading.local()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_answers_created_at ON answers(created_at);
+CREATE TABLE IF NOT EXISTS answer_keywords (
+    keyword TEXT NOT NULL,
+    answer_id INTEGER NOT NULL REFERENCES answers(id) ON DELETE CASCADE,
+    PRIMARY KEY (keyword, answer_id)
+) WITHOUT ROWID;
+"""
+
+def open_database(path, schema=None, journal_mode="WAL"):
+    """Connessione SQLite per thread, in WAL e con attesa sui lock.
+
+    Usata da tutti gli archivi locali del progetto: una connessione per
+    thread evita di condividere cursori, il WAL permette letture mentre un
+    altro processo scrive. Il WAL richiede memoria condivisa tra i processi:
+    per un file su filesystem di rete usato da più macchine serve
+    ``journal_mode="DELETE"``.
+    """
+    path = os.fspath(path)
+    cache = getattr(_local, "connections", None)
+    if cache is None:
+        cache = _local.connections = {}
+
+    conn = cache.get(path)
+    if conn is None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        cache[path] = conn
+
+    # Lo schema si applica una volta per connessione, non a ogni chiamata
+    applied = _local.__dict__.setdefault("schemas", set())
+    if schema and (path, schema) not in applied:
+        conn.executescript(schema)
+        applied.add((path, schema))
+    return conn
+
+def _connect(db_path=STORAGE_DB):
+    conn = open_database(db_path, SCHEMA)
+    _migrate_legacy(conn)
+    return conn
+
+def _migrate_legacy(conn, legacy_file=STORAGE_FILE):
+    if not os.path.exists(legacy_file):
+        return
+
+    try:
+        with open(legacy_file, "r") as f:
+            storico = json.load(f)
+    except json.JSONDecodeError:
+        storico = []
+
+    # BEGIN IMMEDIATE: se due worker partono insieme solo uno importa
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        empty = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0] == 0
+        if empty and os.path.exists(legacy_file):
+            for item in storico if isinstance(storico, list) else []:
+                _insert(conn, item, _keywords_of(item))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    try:
+        os.replace(legacy_file, legacy_file + ".migrated")
+    except FileNotFoundError:
+        pass  # già rinominato da un altro worker
+
+def _keywords_of(item):
+    if isinstance(item, dict):
+        keywords = item.get("keywords") or item.get("keywords_used") or []
+        return [k for k in keywords if isinstance(k, str)]
     return []
+
+def _insert(conn, toStore, keywords):
+    cur = conn.execute(
+        "INSERT INTO answers (created_at, payload) VALUES (?, ?)",
+        (datetime.now().isoformat(), json.dumps(toStore, ensure_ascii=False))
+    )
+    answer_id = cur.lastrowid
+    conn.executemany(
+        "INSERT OR IGNORE INTO answer_keywords (keyword, answer_id) VALUES (?, ?)",
+        [(kw.strip().lower(), answer_id) for kw in keywords if kw.strip()]
+    )
+    return answer_id
+
+def store_answer(toStore, keywords=None, db_path=STORAGE_DB):
+    """Aggiunge una risposta allo storico e ne restituisce l'ID"""
+    conn = _connect(db_path)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        answer_id = _insert(conn, toStore, keywords if keywords is not None else _keywords_of(toStore))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return answer_id
+
+def _rows_to_documents(rows):
+    return [
+        {"id": row["id"], "created_at": row["created_at"], "data": json.loads(row["payload"])}
+        for row in rows
+    ]
+
+def get_stored_documents(limit=None, offset=0, db_path=STORAGE_DB):
+    """Recupera i documenti salvati nello storico, in ordine di inserimento"""
+    conn = _connect(db_path)
+    rows = conn.execute(
+        "SELECT payload FROM answers ORDER BY id LIMIT ? OFFSET ?",
+        (-1 if limit is None else limit, offset)
+    ).fetchall()
+    return [json.loads(row["payload"]) for row in rows]
+
+def get_stored_document(answer_id, db_path=STORAGE_DB):
+    """Recupera una singola risposta per ID, None se non esiste"""
+    conn = _connect(db_path)
+    row = conn.execute("SELECT id, created_at, payload FROM answers WHERE id = ?", (answer_id,)).fetchone()
+    return _rows_to_documents([row])[0] if row else None
+
+def find_by_date(start=None, end=None, limit=100, db_path=STORAGE_DB):
+    """Risposte con created_at nell'intervallo [start, end) (stringhe ISO)"""
+    conn = _connect(db_path)
+    rows = conn.execute(
+        "SELECT id, created_at, payload FROM answers "
+        "WHERE created_at >= ? AND created_at < ? ORDER BY created_at DESC LIMIT ?",
+        (start or "", end or "9999-12-31", limit)
+    ).fetchall()
+    return _rows_to_documents(rows)
+
+def find_by_keyword(keyword, limit=100, db_path=STORAGE_DB):
+    """Risposte associate a una keyword (confronto case-insensitive)"""
+    conn = _connect(db_path)
+    rows = conn.execute(
+        "SELECT a.id, a.created_at, a.payload FROM answer_keywords k "
+        "JOIN answers a ON a.id = k.answer_id "
+        "WHERE k.keyword = ? ORDER BY a.id DESC LIMIT ?",
+        (keyword.strip().lower(), limit)
+    ).fetchall()
+    return _rows_to_documents(rows)
@@ -0,0 +1,208 @@
+import base64
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from formatting.storing import open_database
+
+# Indice dei riassunti in output/summary: solo metadati, il contenuto resta nei file
+INDEX_DB = Path(__file__).parent.parent / "output" / "summary_index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS summaries (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    title TEXT,
+    type TEXT,
+    language TEXT,
+    tags TEXT NOT NULL DEFAULT '[]',
+    size INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_summaries_created ON summaries(created_at DESC, id DESC);
+CREATE TABLE IF NOT EXISTS summary_tags (
+    tag TEXT NOT NULL,
+    summary_id TEXT NOT NULL REFERENCES summaries(id) ON DELETE CASCADE,
+    PRIMARY KEY (tag, summary_id)
+) WITHOUT ROWID;
+"""
+
+# Campi del documento che entrano nel prompt del Chunker
+_SUMMARY_INPUT_FIELDS = ("filename", "type", "tags", "language", "content")
+
+def summary_id(doc_json, settings, keywords=None):
+    """ID stabile di un riassunto: hash di input, configurazione e keywords.
+
+    Lo stesso documento riassunto con gli stessi parametri ha sempre lo
+    stesso ID, quindi il risultato salvato può essere riusato così com'è.
+    """
+    payload = {
+        "doc": {k: doc_json.get(k) for k in _SUMMARY_INPUT_FIELDS},
+        "settings": settings,
+        "keywords": sorted({k.strip().lower() for k in keywords or [] if k.strip()}),
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+def load_summary(summary_dir, summary_id):
+    """Riassunto salvato con questo ID, None se non esiste o è illeggibile"""
+    path = Path(summary_dir) / f"{summary_id}.json"
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def write_summary(summary_dir, summary_id, doc, db_path=INDEX_DB):
+    """Salva un riassunto in modo atomico e lo registra nell'indice"""
+    path = Path(summary_dir) / f"{summary_id}.json"
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(doc, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+    index_summary(summary_id, path, doc, db_path)
+    return path
+
+def _connect(db_path=INDEX_DB):
+    return open_database(db_path, SCHEMA)
+
+def _title_of(doc, fallback):
+    if isinstance(doc, dict):
+        return doc.get("title") or doc.get("Titolo") or doc.get("filename") or fallback
+    return fallback
+
+def index_summary(summary_id, file_path, doc, db_path=INDEX_DB):
+    """Inserisce o aggiorna i metadati di un riassunto appena scritto"""
+    file_path = Path(file_path)
+    stat = file_path.stat()
+    tags = [t for t in (doc.get("tags") or []) if isinstance(t, str)] if isinstance(doc, dict) else []
+
+    conn = _connect(db_path)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO summaries (id, filename, title, type, language, tags, size, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                summary_id,
+                file_path.name,
+                _title_of(doc, file_path.stem),
+                doc.get("type") if isinstance(doc, dict) else None,
+                doc.get("language") if isinstance(doc, dict) else None,
+                json.dumps(tags, ensure_ascii=False),
+                stat.st_size,
+                stat.st_mtime,
+            )
+        )
+        conn.execute("DELETE FROM summary_tags WHERE summary_id = ?", (summary_id,))
+        conn.executemany(
+            "INSERT OR IGNORE INTO summary_tags (tag, summary_id) VALUES (?, ?)",
+            [(t.lower(), summary_id) for t in tags]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def remove_summary(summary_id, db_path=INDEX_DB):
+    _connect(db_path).execute("DELETE FROM summaries WHERE id = ?", (summary_id,))
+
+def summary_exists_for(filename, db_path=INDEX_DB):
+    """True se almeno un riassunto indicizzato viene dal file ``filename``"""
+    row = _connect(db_path).execute("SELECT 1 FROM summaries WHERE filename = ? LIMIT 1", (filename,)).fetchone()
+    return row is not None
+
+def clear_index(db_path=INDEX_DB):
+    _connect(db_path).execute("DELETE FROM summaries")
+
+def sync_index(summary_dir, db_path=INDEX_DB):
+    """Allinea l'indice ai file presenti (file scritti prima dell'indice o rimossi a mano).
+
+    Confronta solo i nomi dei file: i JSON vengono letti soltanto per i
+    riassunti non ancora indicizzati.
+    """
+    summary_dir = Path(summary_dir)
+    conn = _connect(db_path)
+    indexed = {row["id"] for row in conn.execute("SELECT id FROM summaries")}
+    on_disk = {p.stem: p for p in summary_dir.glob("*.json")}
+
+    for summary_id in indexed - on_disk.keys():
+        remove_summary(summary_id, db_path)
+
+    for summary_id in on_disk.keys() - indexed:
+        path = on_disk[summary_id]
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                doc = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Errore nell'indicizzare {path}: {e}")
+            continue
+        index_summary(summary_id, path, doc, db_path)
+
+def _encode_cursor(created_at, summary_id):
+    raw = json.dumps([created_at, summary_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def _decode_cursor(cursor):
+    try:
+        created_at, summary_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return float(created_at), str(summary_id)
+    except (ValueError, TypeError):
+        raise ValueError("Cursor non valido")
+
+def list_summaries(limit=50, cursor=None, tag=None, doc_type=None, q=None,
+                   since=None, until=None, db_path=INDEX_DB):
+    """Pagina di metadati in ordine dal più recente, con paginazione a cursore.
+
+    Restituisce ``(items, next_cursor)``; ``next_cursor`` è None sull'ultima
+    pagina. Il cursore codifica (created_at, id) dell'ultimo elemento, quindi
+    le pagine restano stabili anche se nel frattempo arrivano nuovi riassunti.
+    """
+    clauses, params = [], []
+    if cursor:
+        created_at, summary_id = _decode_cursor(cursor)
+        clauses.append("(s.created_at < ? OR (s.created_at = ? AND s.id < ?))")
+        params += [created_at, created_at, summary_id]
+    if tag:
+        clauses.append("s.id IN (SELECT summary_id FROM summary_tags WHERE tag = ?)")
+        params.append(tag.lower())
+    if doc_type:
+        clauses.append("s.type = ?")
+        params.append(doc_type)
+    if q:
+        clauses.append("(s.title LIKE ? OR s.filename LIKE ?)")
+        params += [f"%{q}%", f"%{q}%"]
+    if since is not None:
+        clauses.append("s.created_at >= ?")
+        params.append(float(since))
+    if until is not None:
+        clauses.append("s.created_at < ?")
+        params.append(float(until))
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = _connect(db_path).execute(
+        f"SELECT s.* FROM summaries s {where} ORDER BY s.created_at DESC, s.id DESC LIMIT ?",
+        params + [limit + 1]
+    ).fetchall()
+
+    items = [
+        {
+            "id": row["id"],
+            "filename": row["filename"],
+            "title": row["title"],
+            "type": row["type"],
+            "language": row["language"],
+            "tags": json.loads(row["tags"]),
+            "size": row["size"],
+            "created_at": row["created_at"],
+        }
+        for row in rows[:limit]
+    ]
+    next_cursor = None
+    if len(rows) > limit and items:
+        next_cursor = _encode_cursor(items[-1]["created_at"], items[-1]["id"])
+    return items, next_cursor
+
+def count_summaries(db_path=INDEX_DB):
+    return _connect(db_path).execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
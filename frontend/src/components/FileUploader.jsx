@@ -8,6 +8,9 @@ export default function FileUploader({ onUploaded }) {
   const [loading, setLoading] = useState(false);
   const [progress, setProgress] = useState(0);
   const [currentTask, setCurrentTask] = useState("");
+  // Risultato corrente: i file aggiunti dopo vengono uniti in modo incrementale
+  const [resultId, setResultId] = useState(null);
+  const [processedNames, setProcessedNames] = useState(new Set());
   const inputRef = useRef(null);
 
   const handleFileChange = (e) => {
@@ -23,8 +26,21 @@ export default function FileUploader({ onUploaded }) {
     inputRef.current.click();
   };
 
+  // Si riparte da un risultato nuovo: i prossimi file non vengono uniti al precedente
+  const resetResult = () => {
+    setResultId(null);
+    setProcessedNames(new Set());
+  };
+
+  const startNewResult = () => {
+    setFiles([]);
+    resetResult();
+  };
+
   const removeFile = (index) => {
-    setFiles((currFiles) => currFiles.filter((_, i) => i !== index));
+    const remaining = files.filter((_, i) => i !== index);
+    setFiles(remaining);
+    if (remaining.length === 0) resetResult();
   };
 
   const addKeyword = () => {
@@ -32,12 +48,15 @@ export default function FileUploader({ onUploaded }) {
     if (trimmed && !keywords.includes(trimmed)) {
       setKeywords((prev) => [...prev, trimmed]);
       setKeywordError("");
+      // Il risultato esistente è stato costruito con le keyword precedenti
+      resetResult();
     }
     setKeyword("");
   };
 
   const removeKeyword = (index) => {
     setKeywords((prev) => prev.filter((_, i) => i !== index));
+    resetResult();
   };
 
   const handleKeyDown = (e) => {
@@ -53,24 +72,45 @@ export default function FileUploader({ onUploaded }) {
       return;
     }
 
+    const filesToSend = resultId ? files.filter(f => !processedNames.has(f.name)) : files;
+    if (filesToSend.length === 0) {
+      alert("Nessun nuovo file da aggiungere");
+      return;
+    }
+
     setLoading(true);
     setProgress(0);
     setCurrentTask("Inizializzazione...");
 
     const stopProgress = simulateProgress();
+    let jobId = null;
+    let cancelOnLeave = null;
 
     try {
-      const formData = new FormData();
-      files.forEach(file => formData.append("files", file));
-      keywords.forEach(kw => formData.append("keywords", kw));
+      // I file viaggiano a blocchi ripristinabili; poi si avvia l'elaborazione
+      setCurrentTask("Caricamento file...");
+      const uploadIds = [];
+      for (const file of filesToSend) {
+        uploadIds.push(await uploadResumable(file));
+      }
 
-      console.log("Inizio upload con timeout di 10 minuti...");
+      console.log("Inizio elaborazione con timeout di 10 minuti...");
       const controller = new AbortController();
       const timeoutId = setTimeout(() => controller.abort(), 600000); // 10 minuti
 
-      const res = await fetch("/api/upload", {
+      // Con la pagina chiusa (o il timeout) il server annulla il job invece di
+      // continuare a trascrivere e a pagare chiamate al modello
+      jobId = crypto.randomUUID();
+      cancelOnLeave = () => cancelJob(jobId);
+      window.addEventListener("pagehide", cancelOnLeave);
+
+      const res = await fetch("/api/uploads/process", {
         method: "POST",
-        body: formData,
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+          upload_ids: uploadIds, keywords, result_id: resultId,
+          job_id: jobId, deadline: 600
+        }),
         signal: controller.signal
       });
 
@@ -88,6 +128,11 @@ export default function FileUploader({ onUploaded }) {
       setProgress(100);
       setCurrentTask("Completato!");
 
+      if (data.processing_result && data.processing_result.result_id) {
+        setResultId(data.processing_result.result_id);
+        setProcessedNames(new Set(files.map(f => f.name)));
+      }
+
       onUploaded(data);
       setKeywordError("");
     } catch (err) {
@@ -97,11 +142,15 @@ export default function FileUploader({ onUploaded }) {
       setCurrentTask("");
 
       if (err.name === 'AbortError') {
+        cancelJob(jobId);
         alert("Timeout: L'elaborazione sta richiedendo troppo tempo. Riprova con file più piccoli.");
       } else {
         alert(`Errore durante l'upload: ${err.message}`);
       }
     } finally {
+      if (cancelOnLeave) {
+        window.removeEventListener("pagehide", cancelOnLeave);
+      }
       setLoading(false);
       setTimeout(() => {
         setProgress(0);
@@ -110,6 +159,67 @@ export default function FileUploader({ onUploaded }) {
     }
   };
 
+  // sendBeacon parte anche mentre la pagina si chiude, a differenza di fetch
+  const cancelJob = (jobId) => {
+    if (jobId) {
+      navigator.sendBeacon(`/api/jobs/${jobId}/cancel`);
+    }
+  };
+
+  // Upload a blocchi: l'ID della sessione resta in localStorage, quindi dopo
+  // una caduta di rete (o un ricaricamento della pagina) si riparte dall'offset
+  // già ricevuto dal server invece che da zero.
+  const uploadResumable = async (file) => {
+    const storageKey = `summy-upload:${file.name}:${file.size}:${file.lastModified}`;
+    let session = null;
+
+    const savedId = localStorage.getItem(storageKey);
+    if (savedId) {
+      const res = await fetch(`/api/uploads/${savedId}`);
+      if (res.ok) session = await res.json();
+    }
+    if (!session) {
+      const res = await fetch("/api/uploads", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ filename: file.name, size: file.size })
+      });
+      if (!res.ok) {
+        const errorData = await res.json().catch(() => ({}));
+        throw new Error(errorData.error || `Errore HTTP ${res.status}`);
+      }
+      session = await res.json();
+      localStorage.setItem(storageKey, session.upload_id);
+    }
+
+    const chunkSize = session.chunk_size || 8 * 1024 * 1024;
+    let offset = session.offset;
+    let failures = 0;
+    while (offset < file.size) {
+      try {
+        const res = await fetch(`/api/uploads/${session.upload_id}`, {
+          method: "PUT",
+          headers: { "Upload-Offset": String(offset), "Content-Type": "application/octet-stream" },
+          body: file.slice(offset, offset + chunkSize)
+        });
+        const data = await res.json().catch(() => ({}));
+        if (res.status === 409 && typeof data.offset === "number") {
+          offset = data.offset;
+          continue;
+        }
+        if (!res.ok) throw new Error(data.error || `Errore HTTP ${res.status}`);
+        offset = data.offset;
+        failures = 0;
+      } catch (err) {
+        if (++failures > 5) throw err;
+        await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** failures));
+      }
+    }
+
+    localStorage.removeItem(storageKey);
+    return session.upload_id;
+  };
+
   // Funzione per simulare il progresso dell'elaborazione
   const simulateProgress = () => {
     const progressSteps = [
@@ -171,8 +281,17 @@ export default function FileUploader({ onUploaded }) {
           className="upload-btn"
           disabled={loading}
         >
-          {loading ? "Elaborazione in corso..." : "Riassumi"}
+          {loading ? "Elaborazione in corso..." : resultId ? "Aggiungi al risultato" : "Riassumi"}
         </button>
+        {resultId && !loading && (
+          <button
+            type="button"
+            onClick={startNewResult}
+            className="select-file-btn"
+          >
+            Nuovo risultato
+          </button>
+        )}
         {loading && (
           <div className="spinner" aria-label="Caricamento in corso"></div>
         )}
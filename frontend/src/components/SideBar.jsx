@@ -5,21 +5,43 @@ export default function SideBar({ onSelect }) {
   const [storico, setStorico] = useState([]);
   const [loading, setLoading] = useState(true);
   const [errore, setErrore] = useState(false);
+  const [nextCursor, setNextCursor] = useState(null);
 
-  useEffect(() => {
-    fetch("/api/storico")
+  // Lo storico contiene solo metadati: le pagine successive arrivano col cursore
+  const loadPage = (cursor) => {
+    const url = cursor
+      ? `/api/storico?cursor=${encodeURIComponent(cursor)}`
+      : "/api/storico";
+    setLoading(true);
+    fetch(url)
       .then(res => {
         if (!res.ok) throw new Error();
         return res.json();
       })
       .then(data => {
-        if (Array.isArray(data)) setStorico(data);
-        else setErrore(true);
+        if (!Array.isArray(data.documents)) throw new Error();
+        setStorico(prev => (cursor ? [...prev, ...data.documents] : data.documents));
+        setNextCursor(data.next_cursor);
       })
       .catch(() => setErrore(true))
       .finally(() => setLoading(false));
+  };
+
+  useEffect(() => {
+    loadPage(null);
   }, []);
 
+  // Il contenuto completo si scarica solo quando l'elemento viene aperto
+  const handleSelect = (item) => {
+    fetch(`/api/documents/${encodeURIComponent(item.id)}`)
+      .then(res => {
+        if (!res.ok) throw new Error();
+        return res.json();
+      })
+      .then(data => onSelect({ ...item, document: data.document }))
+      .catch(() => setErrore(true));
+  };
+
   return (
     <aside className="sidebar">
       <img
@@ -37,11 +59,16 @@ export default function SideBar({ onSelect }) {
 
       <ul>
         {storico.map((item, idx) => (
-          <li key={idx} onClick={() => onSelect(item)}>
-            {item.Titolo ?? `Elemento ${idx + 1}`}
+          <li key={item.id} onClick={() => handleSelect(item)}>
+            {item.title ?? item.filename ?? `Elemento ${idx + 1}`}
           </li>
         ))}
       </ul>
+      {!loading && nextCursor && (
+        <button className="sidebar-more" onClick={() => loadPage(nextCursor)}>
+          Carica altri
+        </button>
+      )}
     </aside>
   );
 }
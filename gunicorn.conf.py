@@ -0,0 +1,120 @@
+"""Configurazione gunicorn per il backend in produzione.
+
+Avvio:  gunicorn -c gunicorn.conf.py app:app
+
+Ogni worker è un processo con thread (gthread) che condividono un event
+loop persistente e un solo client AsyncOpenAI (utils/asyncRuntime.py).
+Su SIGTERM il worker entra subito in drenaggio (``/api/health`` risponde
+503, nuovi job rifiutati) ma continua a servire per ``SUMMY_DRAIN_NOTICE``
+secondi, così il bilanciatore lo vede e smette di inviargli traffico. Poi
+gunicorn smette di accettare connessioni, attende le richieste in corso fino
+a ``graceful_timeout`` e il worker chiude loop e client.
+
+Le metriche dei worker si sommano attraverso ``SUMMY_METRICS_DIR`` (default
+una cartella temporanea per istanza del master): ogni scrape di
+``/api/metrics`` descrive l'intero server, qualunque worker risponda.
+"""
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import multiprocessing
+
+bind = os.getenv("SUMMY_BIND", "0.0.0.0:8000")
+
+# Il lavoro è quasi tutto attesa di rete (OpenAI): pochi processi, più thread
+workers = int(os.getenv("SUMMY_WORKERS", min(4, multiprocessing.cpu_count())))
+worker_class = "gthread"
+threads = int(os.getenv("SUMMY_THREADS", 8))
+
+# Un upload con molti file può elaborare per minuti
+timeout = int(os.getenv("SUMMY_REQUEST_TIMEOUT", 900))
+graceful_timeout = int(os.getenv("SUMMY_GRACEFUL_TIMEOUT", 600))
+# Secondi di 503 su /api/health prima di smettere di accettare connessioni:
+# almeno un intervallo di health check del bilanciatore
+drain_notice = float(os.getenv("SUMMY_DRAIN_NOTICE", 10))
+keepalive = 5
+
+# Riciclo periodico dei worker contro la crescita di memoria (whisper, torch)
+max_requests = int(os.getenv("SUMMY_MAX_REQUESTS", 500))
+max_requests_jitter = 50
+
+# Niente preload: loop e client vanno creati dopo il fork, dentro ogni worker
+preload_app = False
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("SUMMY_LOG_LEVEL", "info")
+
+metrics_dir = os.getenv("SUMMY_METRICS_DIR") or os.path.join(tempfile.gettempdir(), f"summy-metrics-{os.getpid()}")
+
+
+def on_starting(server):
+    # Snapshot di un avvio precedente: i contatori ripartono da zero
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def on_exit(server):
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def child_exit(server, worker):
+    from utils.metrics import archiveSnapshot
+
+    archiveSnapshot(metrics_dir, worker.pid)
+
+
+def post_worker_init(worker):
+    from utils.metrics import REGISTRY
+
+    REGISTRY.shareWith(metrics_dir)
+
+    # Al posto dell'handler di gunicorn, che fermerebbe subito l'accept loop
+    signal.signal(signal.SIGTERM, lambda sig, frame: _begin_drain(worker, sig, frame))
+    signal.siginterrupt(signal.SIGTERM, False)
+
+    # Motori di ingest da precaricare (es. "whisper,pdf"): di default nessuno,
+    # così i worker sono pronti subito e caricano tutto al primo uso
+    engines = [e.strip() for e in os.getenv("SUMMY_WARMUP", "").split(",") if e.strip()]
+    if engines:
+        from ingest.extractor import warmup
+        worker.log.info(f"Precaricamento motori di ingest: {', '.join(engines)}")
+        warmup(engines=engines)
+
+
+def _begin_drain(worker, sig, frame):
+    from utils.asyncRuntime import getRuntime
+
+    # timeout=0: segna il runtime come in chiusura senza attendere i job
+    getRuntime().drain(0)
+    worker.log.info(f"SIGTERM: drenaggio, stop dell'accept loop tra {drain_notice:g}s")
+    if drain_notice > 0:
+        timer = threading.Timer(drain_notice, worker.handle_exit, (sig, frame))
+        timer.daemon = True
+        timer.start()
+    else:
+        worker.handle_exit(sig, frame)
+
+
+def worker_int(worker):
+    worker.log.info("Worker interrotto, chiusura del runtime asincrono")
+    _shutdown_runtime(worker, timeout=5)
+
+
+def worker_exit(server, worker):
+    from utils.metrics import REGISTRY
+
+    _shutdown_runtime(worker, timeout=graceful_timeout)
+    # Ultimo stato del worker, che il master sposta nell'archivio (child_exit)
+    REGISTRY.flush()
+
+
+def _shutdown_runtime(worker, timeout):
+    from utils.asyncRuntime import getRuntime
+
+    runtime = getRuntime()
+    if not runtime.drain(timeout):
+        worker.log.warning(f"{runtime.inflight()} job ancora in corso alla chiusura del worker")
+    runtime.shutdown(timeout=0)
@@ -4,44 +4,30 @@ import tempfile
 import re
 import json
 import csv
+import importlib
+import time
+import threading
 from pathlib import Path
-from typing import Set, List, Dict, Optional
+from typing import Set, List, Dict, Optional, Callable
 from utils.ingestHelper import Document, buildDocument, saveDocumentJson, normalizeWhitespaces, getFileHash, getCachePath, getCachedContent, saveToCache, clearCache
+from utils.metrics import EXTRACTION_SECONDS
+from utils.scheduler import ingestScheduler
+from utils.cancellation import CancelToken, cancelScope, currentToken, checkCancelled, runProcess
 
 
-try:
-	from langdetect import detect, LangDetectException
-except ImportError:
-	detect = None
-	LangDetectException = None
-
-try:
-	import pdfplumber
-except ImportError:
-	pdfplumber = None
-
-try:
-	from tika import parser
-except ImportError:
-	parser = None
-
-try:
-	import whisper
-except ImportError:
-	whisper = None
-
-try:
-	from pydub import AudioSegment
-	from pydub.effects import normalize
-except ImportError:
-	AudioSegment = None
-
-try:
-	from PIL import Image
-	import pytesseract
-except ImportError:
-	Image = None
-	pytesseract = None
+# Motori di estrazione (whisper/torch, tika, pdfplumber, PIL, tesseract)
+# importati al primo file che li richiede: importare questo modulo resta
+# leggero e un worker che non vede mai un video non carica mai torch.
+_optionalModules: Dict[str, object] = {}
+
+def loadOptional(moduleName: str):
+	"""Importa un modulo opzionale al primo uso; None se non è installato"""
+	if moduleName not in _optionalModules:
+		try:
+			_optionalModules[moduleName] = importlib.import_module(moduleName)
+		except ImportError:
+			_optionalModules[moduleName] = None
+	return _optionalModules[moduleName]
 
 DOCUMENT_EXTENSIONS: Set[str] = {
 	'.pdf', '.txt', '.doc', '.docx', '.odt', '.rtf',
@@ -66,8 +52,44 @@ WHISPER_MODEL = "base"
 CHUNK_DURATION = 30
 
 whisperModel = None
+whisperModelName = None
+whisperLock = threading.Lock()
 configData = None
 
+def getWhisperModel(modelName: str = WHISPER_MODEL):
+	"""Modello Whisper caricato alla prima trascrizione e poi riusato.
+
+	I thread di ingest che arrivano insieme caricano il modello una volta sola.
+	"""
+	global whisperModel, whisperModelName
+	model, name = whisperModel, whisperModelName
+	if model is not None and name == modelName:
+		return model
+	with whisperLock:
+		if whisperModel is None or whisperModelName != modelName:
+			whisper = loadOptional("whisper")
+			if whisper is None:
+				raise RuntimeError("Whisper not found.")
+			model = whisper.load_model(modelName)
+			whisperModel, whisperModelName = model, modelName
+		return whisperModel
+
+def warmup(config_path: str = "config.json", engines: Optional[List[str]] = None) -> None:
+	"""Hook di inizializzazione esplicita: precarica i motori indicati.
+
+	Utile all'avvio di un worker dedicato all'ingest per non pagare il
+	caricamento alla prima richiesta; ``engines`` tra "whisper", "pdf",
+	"tika", "ocr", "langdetect" (default: tutti).
+	"""
+	engines = engines or ["whisper", "pdf", "tika", "ocr", "langdetect"]
+	modules = {"pdf": ["pdfplumber"], "tika": ["tika.parser"], "ocr": ["PIL.Image", "pytesseract"],
+		"langdetect": ["langdetect"], "whisper": ["whisper"]}
+	for engine in engines:
+		for moduleName in modules.get(engine, []):
+			loadOptional(moduleName)
+	if "whisper" in engines and loadOptional("whisper") is not None:
+		getWhisperModel(loadConfig(config_path).get("whisperModel", WHISPER_MODEL))
+
 def loadConfig(config_path: str = "config.json") -> Dict:
 	global configData
 	if configData is None:
@@ -91,12 +113,13 @@ def loadConfig(config_path: str = "config.json") -> Dict:
 	return configData
 
 def detectLanguage(text: str, fallback: str = "en") -> str:
-	if not detect or not text or len(text.strip()) < 20:
+	langdetect = loadOptional("langdetect")
+	if not langdetect or not text or len(text.strip()) < 20:
 		return fallback
 
 	try:
 		sample = text[:1000] if len(text) > 1000 else text
-		detectedLang = detect(sample)
+		detectedLang = langdetect.detect(sample)
 
 		langMapping = {
 			"it": "it", "en": "en", "fr": "fr", "de": "de",
@@ -105,7 +128,7 @@ def detectLanguage(text: str, fallback: str = "en") -> str:
 
 		return langMapping.get(detectedLang, fallback)
 
-	except (LangDetectException, Exception):
+	except Exception:
 		return fallback
 
 def convert_to_tika_codes(langs: List[str]) -> str:
@@ -290,6 +313,7 @@ def extractTextFromFile(filepath: str, ocr_langs: Optional[List[str]] = None) ->
 		return ""
 
 	if file_ext == '.pdf':
+		pdfplumber = loadOptional("pdfplumber")
 		if pdfplumber is None:
 			print("Warning: pdfplumber not available, skipping PDF extraction")
 			return ""
@@ -322,14 +346,20 @@ def extractTextFromFile(filepath: str, ocr_langs: Optional[List[str]] = None) ->
 			pass
 
 	# Fallback to Tika for other document types with dynamic language support
+	parser = loadOptional("tika.parser")
 	if parser is None:
 		return ""
 
 	try:
 		tikaLangs = convert_to_tika_codes(ocr_langs)
 
+		checkCancelled()
+		token = currentToken()
+		remaining = token.remaining() if token is not None else None
+
 		parsed = parser.from_file(filepath, requestOptions={
-			'timeout': 300,
+			# requests rifiuta un timeout 0: almeno un secondo, la scadenza si ricontrolla dopo
+			'timeout': max(1, min(300, remaining)) if remaining is not None else 300,
 			'headers': {
 				'X-Tika-OCRLanguage': tikaLangs,
 				'X-Tika-OCREngine': 'tesseract',
@@ -369,7 +399,8 @@ def extractAudioFromVideo(videoPath: str, audioPath: str) -> bool:
 			'-y',
 			audioPath
 		]
-		result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+		# ffmpeg viene ucciso se il job si annulla (vedi utils/cancellation.py)
+		result = runProcess(cmd)
 
 		if os.path.exists(audioPath) and os.path.getsize(audioPath) > 0:
 			return True
@@ -384,9 +415,9 @@ def extractAudioFromVideo(videoPath: str, audioPath: str) -> bool:
 				'-ar', '16000', '-ac', '1',
 				'-preset', 'ultrafast', '-y', audioPath
 			]
-			subprocess.run(simpleCmd, capture_output=True, text=True, check=True)
+			runProcess(simpleCmd)
 			return os.path.exists(audioPath) and os.path.getsize(audioPath) > 0
-		except:
+		except Exception:
 			return False
 
 	except FileNotFoundError:
@@ -395,7 +426,7 @@ def extractAudioFromVideo(videoPath: str, audioPath: str) -> bool:
 # Transcribes audio files with dynamic language support and caching
 def transcribeAudio(filepath: str, language: Optional[str] = None, initial_prompt: Optional[str] = None) -> str:
 
-	if whisper is None:
+	if loadOptional("whisper") is None:
 		raise RuntimeError("Whisper not found.")
 
 	cached_transcription = getCachedContent(filepath, "transcription")
@@ -405,12 +436,7 @@ def transcribeAudio(filepath: str, language: Optional[str] = None, initial_promp
 	config = loadConfig()
 
 	try:
-		global whisperModel
-		if whisperModel is not None:
-			model = whisperModel
-		else:
-			modelName = config.get("whisperModel", "base")
-			model = whisper.load_model(modelName)
+		model = getWhisperModel(config.get("whisperModel", "base"))
 
 		whisperLanguage = None if language == "auto" or language is None else language
 
@@ -420,6 +446,9 @@ def transcribeAudio(filepath: str, language: Optional[str] = None, initial_promp
 				"Professional transcription."
 			)
 
+		# Whisper gira nel processo e non si può interrompere a metà: il token
+		# si controlla prima di partire
+		checkCancelled()
 		result = model.transcribe(
 			filepath,
 			language=whisperLanguage,
@@ -453,6 +482,8 @@ def transcribeAudio(filepath: str, language: Optional[str] = None, initial_promp
 		text = apply_corporate_corrections(text, detectedLang, config)
 
 		saveToCache(filepath, text, "transcription")
+		# Trascrizione già pagata e in cache; il job però non prosegue
+		checkCancelled()
 
 		return text
 
@@ -462,7 +493,14 @@ def transcribeAudio(filepath: str, language: Optional[str] = None, initial_promp
 
 
 # Processes media files (audio/video) and returns transcribed content with language support
-def ProcessMediaFile(filepath: str, language: Optional[str] = None, initial_prompt: Optional[str] = None) -> str:
+def ProcessMediaFile(filepath: str, language: Optional[str] = None, initial_prompt: Optional[str] = None,
+		cancel_token: Optional[CancelToken] = None) -> str:
+	"""Con ``cancel_token`` (o il token del job corrente) ffmpeg viene ucciso
+	all'annullamento e la trascrizione non parte"""
+	with cancelScope(cancel_token or currentToken()):
+		return _processMedia(filepath, language, initial_prompt)
+
+def _processMedia(filepath: str, language: Optional[str], initial_prompt: Optional[str]) -> str:
 
 	fileExt = Path(filepath).suffix.lower()
 
@@ -485,7 +523,77 @@ def ProcessMediaFile(filepath: str, language: Optional[str] = None, initial_prom
 	return ""
 
 # Processes all files in input directory with multilingual support
-def Ingest(input_dir: str, output_json_dir: str, config_path: str = "config.json") -> None:
+def extractDocument(filepath: str, config: Dict) -> Optional[Document]:
+	"""Estrae un singolo file; None se il tipo non è supportato o non c'è contenuto"""
+	checkCancelled()
+	file_extension = Path(filepath).suffix.lower().lstrip('.')
+
+	content = ""
+	languageDetected = config.get("default_language", "auto")
+
+	if isValidDocument(filepath):
+		content = extractTextFromFile(filepath, ocr_langs=config.get("ocr_languages"))
+
+		if content.strip() and config.get("default_language") == "auto":
+			languageDetected = detectLanguage(content, "en")
+			print(f"Detected language: {languageDetected}")
+
+	elif isValidImage(filepath):
+		content = extractTextFromImage(filepath, ocr_langs=config.get("ocr_languages"))
+
+		if content.strip() and config.get("default_language") == "auto":
+			languageDetected = detectLanguage(content, "en")
+			print(f"Detected language: {languageDetected}")
+
+	elif isValidMedia(filepath):
+		if config.get("default_language") == "auto":
+			languageDetected = None
+		else:
+			languageDetected = config.get("default_language")
+
+		initial_prompt = None
+		if languageDetected:
+			initial_prompt = config.get("whisper_initial_prompts", {}).get(languageDetected)
+
+		content = ProcessMediaFile(
+			filepath,
+			language=languageDetected,
+			initial_prompt=initial_prompt
+		)
+
+		if content.strip() and languageDetected is None:
+			languageDetected = detectLanguage(content, "en")
+			print(f"Detected language: {languageDetected}")
+
+	else:
+		print(f"Error: unsupported file type")
+		return None
+
+	if not content.strip():
+		print(f"Error: no content extracted")
+		return None
+
+	if isValidDocument(filepath) or isValidImage(filepath):
+		content = apply_corporate_corrections(content, languageDetected, config)
+
+	return buildDocument(
+		filepath=filepath,
+		doc_type=file_extension,
+		content=content,
+		language=languageDetected or "unknown"
+	)
+
+def Ingest(input_dir: str, output_json_dir: str, config_path: str = "config.json",
+		on_document_saved: Optional[Callable[[Document], None]] = None,
+		cancel_token: Optional[CancelToken] = None) -> None:
+	"""Estrae tutti i file della cartella; con ``cancel_token`` (o il token del
+	job corrente) si ferma al primo controllo dopo l'annullamento, sollevando
+	JobCancelled"""
+	with cancelScope(cancel_token or currentToken()):
+		_ingest(input_dir, output_json_dir, config_path, on_document_saved)
+
+def _ingest(input_dir: str, output_json_dir: str, config_path: str,
+		on_document_saved: Optional[Callable[[Document], None]]) -> None:
 
 	if not os.path.exists(input_dir):
 		raise FileNotFoundError(f"Error: input directory not found: {input_dir}")
@@ -499,17 +607,6 @@ def Ingest(input_dir: str, output_json_dir: str, config_path: str = "config.json
 	skippedCnt = 0
 	errorCnt = 0
 
-	global whisperModel
-	if whisper is not None:
-		try:
-			modelName = config.get("whisperModel", "base")
-			whisperModel = whisper.load_model(modelName)
-		except Exception as e:
-			print(f"Failed to load Whisper model: {e}")
-			whisperModel = None
-	else:
-		whisperModel = None
-
 	files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
 	total_files = len(files)
 
@@ -517,70 +614,28 @@ def Ingest(input_dir: str, output_json_dir: str, config_path: str = "config.json
 	for i, filename in enumerate(files):
 		filepath = os.path.join(input_dir, filename)
 
+		checkCancelled()
 		print(f"[{i+1}/{total_files}] Processing: {filename}")
 
 		try:
-			file_extension = Path(filepath).suffix.lower().lstrip('.')
-
-			content = ""
-			languageDetected = config.get("default_language", "auto")
-
-			if isValidDocument(filepath):
-				content = extractTextFromFile(filepath, ocr_langs=config.get("ocr_languages"))
-
-				if content.strip() and config.get("default_language") == "auto":
-					languageDetected = detectLanguage(content, "en")
-					print(f"Detected language: {languageDetected}")
-
-			elif isValidImage(filepath):
-				content = extractTextFromImage(filepath, ocr_langs=config.get("ocr_languages"))
-
-				if content.strip() and config.get("default_language") == "auto":
-					languageDetected = detectLanguage(content, "en")
-					print(f"Detected language: {languageDetected}")
-
-			elif isValidMedia(filepath):
-				if config.get("default_language") == "auto":
-					languageDetected = None
-				else:
-					languageDetected = config.get("default_language")
-
-				initial_prompt = None
-				if languageDetected:
-					initial_prompt = config.get("whisper_initial_prompts", {}).get(languageDetected)
-
-				content = ProcessMediaFile(
-					filepath,
-					language=languageDetected,
-					initial_prompt=initial_prompt
-				)
-
-				if content.strip() and languageDetected is None:
-					languageDetected = detectLanguage(content, "en")
-					print(f"Detected language: {languageDetected}")
-
-			else:
-				print(f"Error: unsupported file type")
+			# Uno slot per file: tra un file e l'altro un job bulk cede il passo a quelli interactive
+			with ingestScheduler().slot():
+				started = time.perf_counter()
+				document = extractDocument(filepath, config)
+			if document is None:
 				skippedCnt += 1
 				continue
 
-			if not content.strip():
-				print(f"Error: no content extracted")
-				skippedCnt += 1
-				continue
-
-			if isValidDocument(filepath) or isValidImage(filepath):
-				content = apply_corporate_corrections(content, languageDetected, config)
-
-			document = buildDocument(
-				filepath=filepath,
-				doc_type=file_extension,
-				content=content,
-				language=languageDetected or "unknown"
-			)
-
 			saveDocumentJson(document, output_json_dir)
 			processedCnt += 1
+			EXTRACTION_SECONDS.observe(time.perf_counter() - started, type=document["type"])
+
+			# Es. aggiornamento dell'indice di ricerca: un errore qui non invalida il documento salvato
+			if on_document_saved is not None:
+				try:
+					on_document_saved(document)
+				except Exception as e:
+					print(f"Error: post-save hook failed for {filename}: {str(e)}")
 
 
 		except Exception as e:
@@ -604,6 +659,8 @@ def postProcessNamingForCorporate(text: str) -> str:
 # Extracts text from images using OCR with language detection support and caching
 def extractTextFromImage(filepath: str, ocr_langs: Optional[List[str]] = None) -> str:
 
+	Image = loadOptional("PIL.Image")
+	pytesseract = loadOptional("pytesseract")
 	if Image is None or pytesseract is None:
 		return ""
 
@@ -616,26 +673,39 @@ def extractTextFromImage(filepath: str, ocr_langs: Optional[List[str]] = None) -
 	if cached_text:
 		return cached_text
 
+	checkCancelled()
+	# tesseract gira con runProcess: annullamento o scadenza del job lo uccidono
+	# subito (pytesseract non espone il processo, solo un timeout)
+	with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmpImage:
+		tmpImagePath = tmpImage.name
+
 	try:
 		with Image.open(filepath) as img:
 			if img.mode != 'RGB':
 				img = img.convert('RGB')
+			img.save(tmpImagePath, format='PNG')
 
-			lang_codes = '+'.join(ocr_langs)
+		lang_codes = '+'.join(ocr_langs)
 
-			custom_config = f'--oem 3 --psm 6 -l {lang_codes}'
+		cmd = [pytesseract.pytesseract.tesseract_cmd, tmpImagePath, 'stdout',
+			'--oem', '3', '--psm', '6', '-l', lang_codes]
 
-			extracted_text = pytesseract.image_to_string(img, config=custom_config)
+		extracted_text = runProcess(cmd, encoding='utf-8', errors='replace').stdout
 
-			if not extracted_text.strip():
-				return ""
+		if not extracted_text.strip():
+			return ""
 
-			extracted_text = normalizeWhitespaces(extracted_text)
-			result_text = extracted_text.strip()
+		extracted_text = normalizeWhitespaces(extracted_text)
+		result_text = extracted_text.strip()
 
-			saveToCache(filepath, result_text, "extraction")
+		saveToCache(filepath, result_text, "extraction")
 
-			return result_text
+		return result_text
 
 	except Exception as e:
+		# JobCancelled non è un Exception: l'annullamento arriva fino al chiamante
+		print(f"Error: OCR failed for {filepath}: {e}")
 		return ""
+	finally:
+		if os.path.exists(tmpImagePath):
+			os.unlink(tmpImagePath)
@@ -0,0 +1,225 @@
+"""batching.py – Esecuzione offline tramite OpenAI Batch API
+-----------------------------------------------------------------------
+Scrive le richieste chat.completions in JSONL, le invia come batch, esegue
+il polling fino al completamento e restituisce le risposte per custom_id.
+
+Ogni esecuzione di una fase (map, reduce, accumulation) ha una propria
+cartella ``<work_dir>/<fase>-<digest>/``, dove il digest è calcolato sulle
+richieste: stato (``state.json``), input e output di un job non si mescolano
+con quelli di un altro. Un processo riavviato con le stesse richieste ritrova
+la cartella e riprende il polling del batch già inviato invece di pagarlo una
+seconda volta. La cartella si cancella appena le risposte sono raccolte;
+quelle di run abbandonati scadono come i checkpoint (``prune_checkpoints``). Il client usa
+``OPENAI_BASE_URL`` se impostata, quindi funziona anche contro un server
+batch sostitutivo locale.
+"""
+from __future__ import annotations
+
+import json
+import shutil
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple
+
+from checkpoint import prune_checkpoints
+from utils.usage import currentLedger
+
+# Stati terminali restituiti da batches.retrieve
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# Limite della Batch API per singolo file di input
+MAX_REQUESTS_PER_BATCH = 50_000
+
+
+class BatchRunner:
+    """Invia gruppi di richieste alla Batch API con stato ripristinabile."""
+
+    def __init__(self, work_dir: str | Path = ".batch_jobs", client=None,
+                 poll_interval: float = 30.0, completion_window: str = "24h",
+                 max_requests_per_batch: int = MAX_REQUESTS_PER_BATCH):
+        self.work_dir = Path(work_dir)
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.client = client
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.max_requests_per_batch = max_requests_per_batch
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    @staticmethod
+    def build_request(custom_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Riga JSONL nel formato atteso dall'endpoint /v1/chat/completions"""
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body,
+        }
+
+    # ------------------------------------------------------------------
+    # Stato persistente
+    # ------------------------------------------------------------------
+    def _run_dir(self, stage: str, digest: str) -> Path:
+        """Cartella di una singola esecuzione: stato e file non condivisi tra job"""
+        run_dir = self.work_dir / f"{stage}-{digest[:32]}"
+        run_dir.mkdir(parents=True, exist_ok=True)
+        return run_dir
+
+    def _load_state(self, run_dir: Path, digest: str) -> Dict[str, Any]:
+        state_file = run_dir / "state.json"
+        if state_file.exists():
+            try:
+                state = json.loads(state_file.read_text(encoding="utf-8"))
+                if state.get("digest") == digest:
+                    return state
+            except json.JSONDecodeError:
+                self.log.warning(f"Stato batch corrotto in {state_file}, ripartenza da zero")
+        return {"digest": digest, "parts": []}
+
+    @staticmethod
+    def _save_state(run_dir: Path, state: Dict[str, Any]) -> None:
+        state_file = run_dir / "state.json"
+        tmp = state_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state, indent=2, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(state_file)
+
+    @staticmethod
+    def _digest(requests: List[Dict[str, Any]]) -> str:
+        payload = json.dumps(requests, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    # ------------------------------------------------------------------
+    # Esecuzione
+    # ------------------------------------------------------------------
+    async def run(self, stage: str, requests: List[Dict[str, Any]],
+                  documents: Optional[Dict[str, Tuple[str, str]]] = None) -> Dict[str, Optional[str]]:
+        """Esegue una fase e restituisce {custom_id: contenuto del messaggio o None}.
+
+        ``documents`` ({custom_id: (nome file, tipo)}) attribuisce i token delle
+        risposte ai documenti nel registro del job, se presente (utils/usage.py).
+        """
+        if not requests:
+            return {}
+
+        client = self.client
+        owns_client = client is None
+        if owns_client:
+            from openai import AsyncOpenAI
+            client = AsyncOpenAI()
+
+        try:
+            prune_checkpoints(self.work_dir)
+            digest = self._digest(requests)
+            run_dir = self._run_dir(stage, digest)
+            state = self._load_state(run_dir, digest)
+            self._save_state(run_dir, state)
+
+            size = self.max_requests_per_batch
+            groups = [requests[i:i + size] for i in range(0, len(requests), size)]
+
+            results: Dict[str, Optional[str]] = {r["custom_id"]: None for r in requests}
+            collected = True
+            for part_idx, group in enumerate(groups):
+                output_path = await self._run_part(client, run_dir, state, stage, part_idx, group)
+                if output_path is not None:
+                    results.update(self._read_output(output_path, stage, documents or {}))
+                else:
+                    collected = False
+
+            if collected:
+                # Risposte in memoria: stato e JSONL non servono più a nessuna ripresa
+                shutil.rmtree(run_dir, ignore_errors=True)
+
+            missing = sum(1 for v in results.values() if v is None)
+            if missing:
+                self.log.warning(f"Batch '{stage}': {missing}/{len(results)} richieste senza risposta")
+            return results
+        finally:
+            if owns_client:
+                await client.close()
+
+    async def _run_part(self, client, run_dir: Path, state: Dict[str, Any], stage: str,
+                        part_idx: int, group: List[Dict[str, Any]]) -> Optional[Path]:
+        parts = state["parts"]
+        while len(parts) <= part_idx:
+            parts.append({})
+        part = parts[part_idx]
+
+        output_path = run_dir / f"{part_idx}_output.jsonl"
+        if part.get("status") == "completed" and output_path.exists():
+            self.log.info(f"Batch '{stage}' parte {part_idx} già completato, riuso output locale")
+            return output_path
+
+        if not part.get("batch_id"):
+            input_path = run_dir / f"{part_idx}_input.jsonl"
+            with open(input_path, "w", encoding="utf-8") as f:
+                for req in group:
+                    f.write(json.dumps(req, ensure_ascii=False) + "\n")
+
+            with open(input_path, "rb") as f:
+                uploaded = await client.files.create(file=f, purpose="batch")
+            batch = await client.batches.create(
+                input_file_id=uploaded.id,
+                endpoint="/v1/chat/completions",
+                completion_window=self.completion_window,
+                metadata={"stage": stage, "part": str(part_idx)},
+            )
+            part.update({"batch_id": batch.id, "input_file_id": uploaded.id, "status": batch.status})
+            self._save_state(run_dir, state)
+            self.log.info(f"Batch '{stage}' parte {part_idx} inviato: {batch.id} ({len(group)} richieste)")
+        else:
+            self.log.info(f"Ripresa batch '{stage}' parte {part_idx}: {part['batch_id']}")
+
+        batch = await self._poll(client, part["batch_id"])
+        part["status"] = batch.status
+        self._save_state(run_dir, state)
+
+        if batch.status not in {"completed", "expired", "cancelled"} or not batch.output_file_id:
+            self.log.error(f"Batch {batch.id} terminato con stato {batch.status}")
+            # Senza output da riusare il batch va dimenticato: il prossimo run lo reinvia
+            # invece di ritrovare lo stesso batch fallito a ogni ripresa
+            for key in ("batch_id", "input_file_id", "status"):
+                part.pop(key, None)
+            self._save_state(run_dir, state)
+            return None
+
+        content = await client.files.content(batch.output_file_id)
+        output_path.write_text(content.text, encoding="utf-8")
+        # Un batch scaduto o annullato conserva comunque le risposte già completate
+        part["status"] = "completed"
+        self._save_state(run_dir, state)
+        return output_path
+
+    async def _poll(self, client, batch_id: str):
+        while True:
+            batch = await client.batches.retrieve(batch_id)
+            if batch.status in TERMINAL_STATUSES:
+                return batch
+            counts = getattr(batch, "request_counts", None)
+            if counts is not None:
+                self.log.info(f"Batch {batch_id}: {batch.status} ({counts.completed}/{counts.total})")
+            await asyncio.sleep(self.poll_interval)
+
+    def _read_output(self, output_path: Path, stage: str,
+                     documents: Dict[str, Tuple[str, str]]) -> Dict[str, Optional[str]]:
+        results: Dict[str, Optional[str]] = {}
+        ledger = currentLedger()
+        with open(output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    response = item.get("response") or {}
+                    if response.get("status_code") != 200:
+                        results[item["custom_id"]] = None
+                        continue
+                    body = response.get("body") or {}
+                    results[item["custom_id"]] = body["choices"][0]["message"]["content"]
+                    if ledger is not None and body.get("usage"):
+                        ledger.record(stage, body.get("model"), body["usage"],
+                                      document=documents.get(item["custom_id"]), batch=True)
+                except (json.JSONDecodeError, KeyError, IndexError, TypeError) as e:
+                    self.log.warning(f"Riga di output batch non valida: {e}")
+        return results
@@ -0,0 +1,110 @@
+"""checkpoint.py – Checkpoint durevoli delle chiamate al modello
+-----------------------------------------------------------------------
+Ogni risposta del modello (map di un chunk, reduce di un documento, ogni
+livello di scaletta dell'accumulation) viene salvata appena arriva in
+``<root>/<job_id>/<fase>/<hash>.json``, dove l'hash è calcolato sulla
+richiesta completa (modello, parametri, messaggi). Un job riavviato dopo
+un crash o un errore ricostruisce le stesse richieste, trova le risposte
+già pagate e chiama il modello solo per quelle mancanti. Con il chunking
+adattivo si salva anche la dimensione dei chunk scelta per ogni documento
+(fase ``sizing``), così la ripresa taglia gli stessi chunk del primo run.
+
+Si salva il testo grezzo della risposta, non il risultato interpretato:
+il parsing viene rifatto (costa nulla) e resta identico al primo run.
+Il ``job_id`` deriva da input e configurazione (vedi ``job_key``), quindi
+rilanciare lo stesso lavoro ritrova la stessa cartella. Un job concluso
+cancella i propri checkpoint; quelli di job abbandonati scadono dopo
+``ttl_days``.
+"""
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import hashlib
+import logging
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from utils.metrics import CACHE_LOOKUPS
+
+DEFAULT_ROOT = ".chunk_temp"
+DEFAULT_TTL_DAYS = 7
+
+log = logging.getLogger(__name__)
+
+
+def _digest(*parts: Any) -> str:
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def job_key(*parts: Any) -> str:
+    """ID di job stabile a partire da input e configurazione"""
+    return _digest(*parts)[:32]
+
+
+def prune_checkpoints(root: str | Path = DEFAULT_ROOT, ttl_days: float = DEFAULT_TTL_DAYS) -> int:
+    """Rimuove i job non toccati da più di ``ttl_days``; restituisce quanti"""
+    root = Path(root)
+    if not root.is_dir():
+        return 0
+    limit = time.time() - ttl_days * 86400
+    removed = 0
+    for job_dir in root.iterdir():
+        try:
+            if job_dir.is_dir() and job_dir.stat().st_mtime < limit:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+class CheckpointStore:
+    """Risposte grezze del modello di un job, una per richiesta."""
+
+    def __init__(self, root: str | Path, job_id: str):
+        self.root = Path(root)
+        self.job_id = job_id
+        self.dir = self.root / job_id
+        self.stats = {"hits": 0, "writes": 0}
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        """Hash della richiesta: stesse richieste, stesso checkpoint"""
+        return _digest(*parts)
+
+    def _path(self, stage: str, key: str) -> Path:
+        return self.dir / stage / f"{key}.json"
+
+    def get(self, stage: str, key: str) -> Optional[str]:
+        try:
+            with open(self._path(stage, key), "r", encoding="utf-8") as f:
+                raw = json.load(f)["raw"]
+        except (OSError, json.JSONDecodeError, KeyError, TypeError):
+            CACHE_LOOKUPS.inc(cache="checkpoint", result="miss")
+            return None
+        self.stats["hits"] += 1
+        CACHE_LOOKUPS.inc(cache="checkpoint", result="hit")
+        return raw
+
+    def put(self, stage: str, key: str, raw: str) -> None:
+        """Scrittura atomica: un crash a metà non lascia checkpoint troncati"""
+        path = self._path(stage, key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"raw": raw, "saved_at": time.time()}, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            self.stats["writes"] += 1
+        except OSError as e:
+            # Il checkpoint è un'ottimizzazione: il job prosegue anche senza
+            log.warning(f"Checkpoint non salvato ({stage}/{key[:12]}): {e}")
+
+    def clear(self) -> None:
+        shutil.rmtree(self.dir, ignore_errors=True)
@@ -0,0 +1,121 @@
+"""dedup.py – Rilevamento di quasi-duplicati con MinHash + LSH
+-----------------------------------------------------------------------
+Usato dal Chunker per elaborare una sola volta documenti e chunk quasi
+identici (lo stesso deck in PPTX e PDF, pagine di disclaimer ripetute) e
+riassegnare poi il risultato a ogni originale.
+"""
+from __future__ import annotations
+
+import re
+import zlib
+import random
+from typing import List, Dict, Hashable, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+# Shingle elaborati per blocco nella versione numpy (limita la memoria)
+NUMPY_BLOCK = 8192
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def shingles(text: str, size: int = 5) -> set:
+    """Insieme di n-grammi di parole sul testo normalizzato"""
+    words = WORD_RE.findall(text.lower())
+    if len(words) < size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    """Firme MinHash con permutazioni universali deterministiche."""
+
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.params = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+                       for _ in range(num_perm)]
+        if np is not None:
+            self._a = np.array([a for a, _ in self.params], dtype=np.uint64)[:, None]
+            self._b = np.array([b for _, b in self.params], dtype=np.uint64)[:, None]
+
+    def signature(self, features: set) -> Tuple[int, ...]:
+        if not features:
+            return tuple([MAX_HASH] * self.num_perm)
+        hashes = [zlib.crc32(f.encode("utf-8")) for f in features]
+        if np is not None:
+            return self._signature_numpy(hashes)
+        return tuple(
+            min(((a * h + b) % MERSENNE_PRIME) & MAX_HASH for h in hashes)
+            for a, b in self.params
+        )
+
+    def _signature_numpy(self, hashes: List[int]) -> Tuple[int, ...]:
+        # Il prodotto in uint64 va in overflow (modulo 2^64): resta un hash universale valido
+        sig = np.full(self.num_perm, MAX_HASH, dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            for start in range(0, len(hashes), NUMPY_BLOCK):
+                hv = np.array(hashes[start:start + NUMPY_BLOCK], dtype=np.uint64)[None, :]
+                block = ((self._a * hv + self._b) % np.uint64(MERSENNE_PRIME)) & np.uint64(MAX_HASH)
+                np.minimum(sig, block.min(axis=1), out=sig)
+        return tuple(int(x) for x in sig)
+
+    @staticmethod
+    def similarity(sig_a: Tuple[int, ...], sig_b: Tuple[int, ...]) -> float:
+        """Stima della similarità di Jaccard tra due firme"""
+        return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+
+class NearDuplicateIndex:
+    """Indice LSH: ``add`` restituisce la chiave del rappresentante del gruppo.
+
+    La prima occorrenza di un testo diventa il rappresentante; le successive
+    con similarità stimata >= ``threshold`` vengono collassate su di essa.
+    """
+
+    def __init__(self, threshold: float = 0.9, num_perm: int = 64, bands: int = 16,
+                 shingle_size: int = 5):
+        if num_perm % bands:
+            raise ValueError("num_perm deve essere multiplo di bands")
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.buckets: List[Dict[Tuple[int, ...], List[Hashable]]] = [{} for _ in range(bands)]
+        self.signatures: Dict[Hashable, Tuple[int, ...]] = {}
+        self.representative: Dict[Hashable, Hashable] = {}
+
+    def _find(self, sig: Tuple[int, ...]) -> Optional[Hashable]:
+        best_key, best_sim = None, 0.0
+        for band, table in enumerate(self.buckets):
+            band_key = sig[band * self.rows:(band + 1) * self.rows]
+            for key in table.get(band_key, ()):
+                sim = self.hasher.similarity(sig, self.signatures[key])
+                if sim >= self.threshold and sim > best_sim:
+                    best_key, best_sim = key, sim
+        return best_key
+
+    def add(self, key: Hashable, text: str) -> Hashable:
+        sig = self.hasher.signature(shingles(text, self.shingle_size))
+        match = self._find(sig)
+        if match is not None:
+            self.representative[key] = match
+            return match
+
+        self.signatures[key] = sig
+        self.representative[key] = key
+        for band, table in enumerate(self.buckets):
+            band_key = sig[band * self.rows:(band + 1) * self.rows]
+            table.setdefault(band_key, []).append(key)
+        return key
+
+
+def group_near_duplicates(texts: List[str], threshold: float = 0.9) -> List[int]:
+    """Per ogni testo, l'indice del suo rappresentante (se stesso se unico)"""
+    index = NearDuplicateIndex(threshold=threshold)
+    return [index.add(i, text) for i, text in enumerate(texts)]
@@ -0,0 +1,175 @@
+"""relevance.py – Ranking lessicale locale dei chunk rispetto alle keywords
+-----------------------------------------------------------------------
+BM25 su token normalizzati (minuscolo, senza accenti, senza stopword,
+con stemming per lingua) per decidere quali chunk meritano una chiamata
+LLM quando l'utente fornisce delle keywords. I chunk esclusi vengono
+compressi con un riassunto estrattivo a costo zero.
+"""
+from __future__ import annotations
+
+import re
+import math
+import unicodedata
+from collections import Counter
+from typing import List, Dict, Set, Iterable, Optional
+
+try:
+    import snowballstemmer  # type: ignore
+except ImportError:  # pragma: no cover
+    snowballstemmer = None
+
+SNOWBALL_LANGUAGES = {
+    "it": "italian", "en": "english", "fr": "french",
+    "de": "german", "es": "spanish", "pt": "portuguese",
+}
+
+STOPWORDS: Dict[str, Set[str]] = {
+    "it": {"il", "lo", "la", "i", "gli", "le", "un", "una", "uno", "di", "a", "da", "in", "con", "su",
+           "per", "tra", "fra", "e", "o", "che", "non", "del", "della", "dei", "delle", "al", "alla",
+           "nel", "nella", "sono", "come", "anche", "piu", "questo", "questa", "essere", "ha"},
+    "en": {"the", "a", "an", "of", "to", "in", "on", "for", "and", "or", "is", "are", "was", "were",
+           "be", "by", "with", "as", "at", "that", "this", "it", "from", "not", "have", "has"},
+    "fr": {"le", "la", "les", "un", "une", "des", "de", "du", "et", "ou", "en", "dans", "sur", "pour",
+           "par", "avec", "que", "qui", "est", "sont", "ne", "pas", "au", "aux", "ce", "cette"},
+    "de": {"der", "die", "das", "ein", "eine", "und", "oder", "in", "im", "auf", "fur", "mit", "von",
+           "zu", "ist", "sind", "nicht", "den", "dem", "des", "als", "auch", "bei", "aus"},
+    "es": {"el", "la", "los", "las", "un", "una", "de", "del", "y", "o", "en", "con", "por", "para",
+           "que", "no", "es", "son", "al", "se", "su", "sus", "como", "mas"},
+    "pt": {"o", "a", "os", "as", "um", "uma", "de", "do", "da", "dos", "das", "e", "ou", "em", "no",
+           "na", "com", "por", "para", "que", "nao", "se", "ao", "como", "mais"},
+}
+
+# Suffissi rimossi dallo stemmer di riserva (dal più lungo al più corto)
+FALLBACK_SUFFIXES: Dict[str, List[str]] = {
+    "it": ["azioni", "azione", "amente", "mente", "ista", "iste", "isti", "ando", "endo",
+           "ità", "ita", "ici", "ico", "ica", "iche", "are", "ere", "ire", "i", "e", "o", "a"],
+    "en": ["ational", "ization", "ations", "ation", "ness", "ment", "ings", "ing", "ies",
+           "ied", "ers", "er", "ly", "ed", "es", "s"],
+    "fr": ["ations", "ation", "ements", "ement", "ments", "ment", "ités", "ité", "euses",
+           "euse", "eux", "ives", "ive", "ifs", "if", "es", "s", "e"],
+    "de": ["ungen", "ung", "heiten", "heit", "keiten", "keit", "lich", "isch", "ern",
+           "em", "en", "er", "es", "e", "s"],
+    "es": ["aciones", "ación", "acion", "amente", "mente", "idades", "idad", "ismo",
+           "ista", "ando", "iendo", "ar", "er", "ir", "os", "as", "es", "o", "a", "s"],
+    "pt": ["ações", "acoes", "ação", "acao", "amente", "mente", "idades", "idade", "ismo",
+           "ista", "ando", "endo", "ar", "er", "ir", "os", "as", "es", "o", "a", "s"],
+}
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+_stemmers: Dict[str, object] = {}
+
+
+def strip_accents(text: str) -> str:
+    normalized = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in normalized if not unicodedata.combining(c))
+
+
+def _snowball(language: str):
+    if snowballstemmer is None or language not in SNOWBALL_LANGUAGES:
+        return None
+    if language not in _stemmers:
+        _stemmers[language] = snowballstemmer.stemmer(SNOWBALL_LANGUAGES[language])
+    return _stemmers[language]
+
+
+def stem(token: str, language: str) -> str:
+    stemmer = _snowball(language)
+    if stemmer is not None:
+        return stemmer.stemWord(token)
+
+    for suffix in FALLBACK_SUFFIXES.get(language, FALLBACK_SUFFIXES["en"]):
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[:-len(suffix)]
+    return token
+
+
+def analyze(text: str, language: str = "en") -> List[str]:
+    """Tokenizza, rimuove stopword e applica lo stemming per la lingua data"""
+    language = (language or "en").lower()[:2]
+    stopwords = STOPWORDS.get(language, set())
+    tokens = []
+    for tok in TOKEN_RE.findall(text.lower()):
+        if tok.isdigit() or len(tok) < 2:
+            continue
+        # Lo stemmer Snowball lavora meglio sugli accenti originali
+        plain = strip_accents(tok)
+        if plain in stopwords:
+            continue
+        tokens.append(strip_accents(stem(tok, language)))
+    return tokens
+
+
+class BM25:
+    """Okapi BM25 su una collezione di documenti già analizzati."""
+
+    def __init__(self, corpus: List[List[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_freqs = [Counter(doc) for doc in corpus]
+        self.doc_lens = [len(doc) for doc in corpus]
+        self.avgdl = (sum(self.doc_lens) / len(corpus)) if corpus else 0.0
+
+        df: Counter = Counter()
+        for freqs in self.doc_freqs:
+            df.update(freqs.keys())
+        n = len(corpus)
+        self.idf = {term: math.log(1 + (n - f + 0.5) / (f + 0.5)) for term, f in df.items()}
+
+    def scores(self, query: Iterable[str]) -> List[float]:
+        query = list(dict.fromkeys(query))
+        result = []
+        for freqs, dl in zip(self.doc_freqs, self.doc_lens):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * dl / self.avgdl) if self.avgdl else self.k1
+            for term in query:
+                tf = freqs.get(term)
+                if tf:
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            result.append(score)
+        return result
+
+
+def rank_chunks(texts: List[str], keywords: List[str], language: str = "en") -> List[float]:
+    """Punteggio BM25 di ogni chunk rispetto all'insieme delle keywords"""
+    query = [tok for kw in keywords for tok in analyze(kw, language)]
+    if not texts or not query:
+        return [0.0] * len(texts)
+    return BM25([analyze(t, language) for t in texts]).scores(query)
+
+
+def select_relevant(scores: List[float], top_ratio: float = 0.25, min_keep: int = 2,
+                    neighbors: int = 1) -> Set[int]:
+    """Indici dei chunk da mandare all'LLM: i migliori per punteggio più i vicini.
+
+    Se nessun chunk contiene le keywords si tengono i primi ``min_keep``
+    chunk, così il documento ottiene comunque una sintesi generale.
+    """
+    n = len(scores)
+    if n == 0:
+        return set()
+
+    keep = max(min_keep, math.ceil(n * top_ratio))
+    ranked = [i for i in sorted(range(n), key=lambda i: scores[i], reverse=True) if scores[i] > 0]
+    core = ranked[:keep] or list(range(min(min_keep, n)))
+
+    selected = set()
+    for i in core:
+        for j in range(i - neighbors, i + neighbors + 1):
+            if 0 <= j < n:
+                selected.add(j)
+    return selected
+
+
+def extractive_summary(text: str, keywords: Optional[List[str]] = None, language: str = "en",
+                       max_sentences: int = 3) -> str:
+    """Frasi più rilevanti (o iniziali) del testo, nell'ordine originale"""
+    sentences = [s.strip() for s in SENTENCE_RE.split(text) if s.strip()]
+    if len(sentences) <= max_sentences:
+        return " ".join(sentences)
+
+    scores = rank_chunks(sentences, keywords or [], language)
+    # A parità di punteggio vincono le frasi iniziali
+    ranked = sorted(range(len(sentences)), key=lambda i: (-scores[i], i))[:max_sentences]
+    return " ".join(sentences[i] for i in sorted(ranked))
@@ -0,0 +1,365 @@
+"""retrieval.py – Indice locale di embedding per il recupero semantico
+-----------------------------------------------------------------------
+I chunk prodotti dal Chunker vengono trasformati in embedding e salvati
+come float16 normalizzati in un file memory-mapped (``vectors.f16``),
+riga per riga; i metadati (hash, documento, testo) stanno in SQLite. La
+ricerca è brute-force a blocchi sul memmap: per qualche centinaio di
+migliaia di chunk resta sotto i 100 ms senza strutture aggiuntive.
+
+Gli embedding sono indicizzati per hash del testo del chunk: reingerire
+un documento già visto non costa nessuna chiamata. Una domanda recupera
+solo i chunk più vicini dall'archivio e il modello risponde su quelli,
+senza rielaborare i file interi.
+"""
+from __future__ import annotations
+
+import os
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+from formatting.storing import open_database
+from utils.metrics import llmCall, recordUsage, CACHE_LOOKUPS
+from utils.scheduler import llmScheduler
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+ANSWER_MODEL = "gpt-4o"
+# Testi per singola chiamata embeddings
+EMBED_BATCH = 128
+# Righe del memmap lette per volta durante la ricerca
+SEARCH_BLOCK = 65_536
+# Chunk più piccoli di quelli usati per riassumere: risultati più mirati
+RETRIEVAL_CHUNK_TOKENS = 400
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vectors (
+    row INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunk_refs (
+    hash TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    filename TEXT,
+    chunk_idx INTEGER NOT NULL,
+    PRIMARY KEY (hash, ref, chunk_idx)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_chunk_refs_ref ON chunk_refs(ref);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+log = logging.getLogger(__name__)
+
+
+def _new_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+def chunk_hash(text: str, model: str = EMBEDDING_MODEL) -> str:
+    normalized = " ".join(text.split())
+    return hashlib.sha256(f"{model}\n{normalized}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingIndex:
+    """Vettori float16 in memmap + metadati SQLite, una cartella per modello."""
+
+    def __init__(self, root: str | Path, model: str = EMBEDDING_MODEL, client=None):
+        self.model = model
+        self.dir = Path(root) / model.replace("/", "_")
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.dir / "vectors.f16"
+        self.db_path = self.dir / "index.sqlite"
+        self.client = client
+
+    def _db(self):
+        return open_database(self.db_path, SCHEMA)
+
+    # ------------------------------------------------------------------
+    # Stato
+    # ------------------------------------------------------------------
+    def dimension(self) -> Optional[int]:
+        row = self._db().execute("SELECT value FROM settings WHERE key = 'dim'").fetchone()
+        return int(row["value"]) if row else None
+
+    def __len__(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def missing(self, hashes: List[str]) -> List[str]:
+        """Hash non ancora presenti nell'indice, in ordine e senza ripetizioni"""
+        db = self._db()
+        unique = list(dict.fromkeys(hashes))
+        known = set()
+        for i in range(0, len(unique), 500):
+            part = unique[i:i + 500]
+            marks = ",".join("?" * len(part))
+            known.update(r["hash"] for r in db.execute(f"SELECT hash FROM vectors WHERE hash IN ({marks})", part))
+        return [h for h in unique if h not in known]
+
+    def _matrix(self, rows: int, dim: int) -> np.ndarray:
+        return np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(rows, dim))
+
+    # ------------------------------------------------------------------
+    # Embedding
+    # ------------------------------------------------------------------
+    async def embed(self, texts: List[str], client=None) -> np.ndarray:
+        """Embedding normalizzati (float32), a gruppi di EMBED_BATCH testi"""
+        client = client or self.client
+        owns_client = client is None
+        if owns_client:
+            client = _new_client()
+        try:
+            batches = [texts[i:i + EMBED_BATCH] for i in range(0, len(texts), EMBED_BATCH)]
+            responses = await asyncio.gather(*(self._embed_batch(client, batch) for batch in batches))
+        finally:
+            if owns_client:
+                await client.close()
+
+        vectors = np.array([item.embedding for resp in responses for item in resp.data], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    async def _embed_batch(self, client, batch: List[str]):
+        async with llmScheduler().asyncSlot():
+            with llmCall("embedding", self.model) as call:
+                resp = await client.embeddings.create(model=self.model, input=batch)
+        recordUsage("embedding", resp, call)
+        return resp
+
+    async def add_chunks(self, items: List[Dict[str, Any]]) -> int:
+        """Registra i chunk ``{text, ref, filename, chunk_idx}``; calcola solo gli embedding nuovi.
+
+        Restituisce il numero di vettori aggiunti.
+        """
+        if not items:
+            return 0
+        for item in items:
+            item["hash"] = chunk_hash(item["text"], self.model)
+
+        new_hashes = self.missing([item["hash"] for item in items])
+        unique = len({item["hash"] for item in items})
+        CACHE_LOOKUPS.inc(unique - len(new_hashes), cache="embedding", result="hit")
+        CACHE_LOOKUPS.inc(len(new_hashes), cache="embedding", result="miss")
+        texts = {item["hash"]: item["text"] for item in items}
+        vectors = await self.embed([texts[h] for h in new_hashes]) if new_hashes else None
+
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            added = 0
+            if vectors is not None:
+                # Un altro processo può averli aggiunti mentre aspettavamo gli embedding
+                still_missing = set(self.missing(new_hashes))
+                keep = [i for i, h in enumerate(new_hashes) if h in still_missing]
+                added = self._append(db, [new_hashes[i] for i in keep], vectors[keep], texts)
+            db.executemany(
+                "INSERT OR IGNORE INTO chunk_refs (hash, ref, filename, chunk_idx) VALUES (?, ?, ?, ?)",
+                [(item["hash"], item["ref"], item.get("filename"), item.get("chunk_idx", 0)) for item in items]
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return added
+
+    def _append(self, db, hashes: List[str], vectors: np.ndarray, texts: Dict[str, str]) -> int:
+        """Aggiunge righe al memmap; va chiamata dentro una transazione di scrittura"""
+        if not hashes:
+            return 0
+        dim = self.dimension()
+        if dim is None:
+            dim = vectors.shape[1]
+            db.execute("INSERT INTO settings (key, value) VALUES ('dim', ?)", (str(dim),))
+        elif dim != vectors.shape[1]:
+            raise ValueError(f"Dimensione embedding {vectors.shape[1]} diversa da quella dell'indice ({dim})")
+
+        start = db.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+        # Le righe oltre il conteggio sono residui di una scrittura interrotta: si sovrascrivono
+        with open(self.vectors_path, "r+b" if self.vectors_path.exists() else "w+b") as f:
+            f.seek(start * dim * 2)
+            f.write(vectors.astype(np.float16).tobytes())
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+
+        db.executemany(
+            "INSERT INTO vectors (row, hash, text) VALUES (?, ?, ?)",
+            [(start + i, h, texts[h]) for i, h in enumerate(hashes)]
+        )
+        return len(hashes)
+
+    # ------------------------------------------------------------------
+    # Rimozione
+    # ------------------------------------------------------------------
+    # Le connessioni SQLite restano aperte (una per thread, vedi
+    # formatting/storing.py): si svuotano le tabelle invece di cancellare i file.
+    def clear(self) -> None:
+        """Svuota l'indice: metadati, dimensione e vettori"""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM chunk_refs")
+            db.execute("DELETE FROM vectors")
+            db.execute("DELETE FROM settings")
+            if self.vectors_path.exists():
+                with open(self.vectors_path, "r+b") as f:
+                    f.truncate(0)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def remove(self, ref: str) -> int:
+        """Toglie i chunk di ``ref``; i vettori non più citati da nessun documento
+        vengono eliminati e il memmap compattato. Restituisce i vettori rimossi."""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM chunk_refs WHERE ref = ?", (ref,))
+            orphans = [r["row"] for r in db.execute(
+                "SELECT row FROM vectors WHERE hash NOT IN (SELECT hash FROM chunk_refs)")]
+            if orphans:
+                self._compact(db, set(orphans))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return len(orphans)
+
+    def _compact(self, db, dropped: set) -> None:
+        """Riscrive il memmap senza le righe ``dropped``; va chiamata dentro una transazione"""
+        rows, dim = len(self), self.dimension()
+        kept = [row for row in range(rows) if row not in dropped]
+        tmp = self.vectors_path.with_suffix(".tmp")
+        matrix = self._matrix(rows, dim)
+        with open(tmp, "wb") as f:
+            for start in range(0, len(kept), SEARCH_BLOCK):
+                f.write(np.asarray(matrix[kept[start:start + SEARCH_BLOCK]], dtype=np.float16).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        del matrix
+        os.replace(tmp, self.vectors_path)
+
+        db.executemany("DELETE FROM vectors WHERE row = ?", [(row,) for row in dropped])
+        # In ordine crescente la nuova posizione è sempre libera
+        db.executemany("UPDATE vectors SET row = ? WHERE row = ?",
+                       [(new, old) for new, old in enumerate(kept) if new != old])
+
+    # ------------------------------------------------------------------
+    # Ricerca
+    # ------------------------------------------------------------------
+    def search(self, query: np.ndarray, k: int = 8) -> List[Dict[str, Any]]:
+        """I ``k`` chunk più simili (coseno) al vettore normalizzato ``query``"""
+        rows, dim = len(self), self.dimension()
+        if not rows or dim is None:
+            return []
+        matrix = self._matrix(rows, dim)
+        query = query.astype(np.float32).reshape(-1)
+
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, rows, SEARCH_BLOCK):
+            block = np.asarray(matrix[start:start + SEARCH_BLOCK], dtype=np.float32)
+            scores = block @ query
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+            if len(best_rows) > k:
+                keep = np.argpartition(-best_scores, k - 1)[:k]
+                best_rows, best_scores = best_rows[keep], best_scores[keep]
+
+        order = np.argsort(-best_scores)
+        return self._describe([int(best_rows[i]) for i in order], [float(best_scores[i]) for i in order])
+
+    def _describe(self, rows: List[int], scores: List[float]) -> List[Dict[str, Any]]:
+        db = self._db()
+        results = []
+        for row, score in zip(rows, scores):
+            meta = db.execute("SELECT hash, text FROM vectors WHERE row = ?", (row,)).fetchone()
+            if meta is None:
+                continue
+            refs = db.execute(
+                "SELECT ref, filename, chunk_idx FROM chunk_refs WHERE hash = ? ORDER BY ref, chunk_idx",
+                (meta["hash"],)
+            ).fetchall()
+            results.append({
+                "score": score,
+                "text": meta["text"],
+                "sources": [dict(r) for r in refs],
+            })
+        return results
+
+
+# ---------------------------------------------------------------------------
+# Indicizzazione e domande
+# ---------------------------------------------------------------------------
+def retrieval_chunks(doc_json: Dict[str, Any], ref: str) -> List[Dict[str, Any]]:
+    """Chunk del documento con la stessa logica del Chunker, a dimensione fissa"""
+    from chunker import Chunker, ChunkerConfig
+
+    chunker = Chunker(ChunkerConfig(max_tokens=RETRIEVAL_CHUNK_TOKENS, overlap_tokens=0))
+    return [
+        {"text": ch.text, "ref": ref, "filename": doc_json.get("filename"), "chunk_idx": ch.idx}
+        for ch in chunker.chunk(doc_json)
+        if ch.text.strip()
+    ]
+
+
+async def index_documents(index: EmbeddingIndex, docs: Dict[str, Dict[str, Any]]) -> int:
+    """Indicizza ``{ref: doc_json}``; restituisce quanti embedding sono stati calcolati"""
+    items = []
+    for ref, doc_json in docs.items():
+        items.extend(retrieval_chunks(doc_json, ref))
+    added = await index.add_chunks(items)
+    log.info(f"Indice embedding: {len(items)} chunk, {added} nuovi vettori")
+    return added
+
+
+def _answer_messages(question: str, passages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    context = "\n\n".join(
+        f"[{i + 1}] ({', '.join(sorted({s['filename'] or s['ref'] for s in p['sources']}))})\n{p['text']}"
+        for i, p in enumerate(passages)
+    )
+    return [
+        {
+            "role": "system",
+            "content": (
+                "Rispondi alla domanda usando SOLO i passaggi forniti. Cita i passaggi con "
+                "il loro numero tra parentesi quadre. Se i passaggi non contengono la "
+                "risposta, dillo esplicitamente. Rispondi nella lingua della domanda."
+            ),
+        },
+        {"role": "user", "content": f"PASSAGGI:\n{context}\n\nDOMANDA: {question}"},
+    ]
+
+
+async def answer_question(index: EmbeddingIndex, question: str, k: int = 8,
+                          model: str = ANSWER_MODEL, client=None) -> Dict[str, Any]:
+    """Recupera i ``k`` chunk più vicini alla domanda e risponde su quelli"""
+    owns_client = client is None and index.client is None
+    client = client or index.client or _new_client()
+    try:
+        query = (await index.embed([question], client))[0]
+        passages = index.search(query, k)
+        if not passages:
+            return {"answer": None, "passages": []}
+
+        async with llmScheduler().asyncSlot():
+            with llmCall("answer", model) as call:
+                resp = await client.chat.completions.create(
+                    model=model,
+                    messages=_answer_messages(question, passages),
+                    temperature=0.1,
+                )
+        recordUsage("answer", resp, call)
+        return {"answer": resp.choices[0].message.content.strip(), "passages": passages}
+    finally:
+        if owns_client:
+            await client.close()
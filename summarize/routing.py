@@ -0,0 +1,100 @@
+"""routing.py – Scelta del modello per fase, tipo di documento e chunk
+-----------------------------------------------------------------------
+Le map sono tante e per lo più estrattive: bastano un modello economico e
+veloce. La reduce scrive il testo finale del documento e resta sul modello
+forte. Le regole si valutano in ordine e vince la prima che combacia su
+fase, tipo di documento e token del chunk; se nessuna combacia vale il
+modello predefinito della fase.
+
+Escalation: se la risposta non è JSON valido o non ha la struttura attesa
+(vedi ``Chunker._validate_and_fix_response``) la stessa richiesta passa,
+una sola volta, al modello di escalation. Il modello forte si paga solo
+sui chunk che ne hanno davvero bisogno.
+
+Le regole si possono passare come lista di dict, es.::
+
+    [{"stage": "map", "model": "gpt-4o", "doc_types": ["pdf"], "min_tokens": 4000}]
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+STAGES = ("map", "reduce")
+
+# Tabelle e fogli di calcolo: nelle map contano cifre e intestazioni, che il
+# modello economico riassume male
+TABULAR_TYPES = ("xlsx", "xls", "ods", "csv")
+# Oltre questa soglia un chunk è lungo e denso: comprimerlo bene chiede il modello forte
+LARGE_CHUNK_TOKENS = 6000
+
+
+@dataclass(frozen=True)
+class Route:
+    stage: str
+    model: str
+    doc_types: Optional[Tuple[str, ...]] = None
+    min_tokens: int = 0
+    max_tokens: Optional[int] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Route":
+        if data.get("stage") not in STAGES:
+            raise ValueError(f"Fase non valida nella regola {data}: ammesse {', '.join(STAGES)}")
+        if not data.get("model"):
+            raise ValueError(f"Modello mancante nella regola {data}")
+        doc_types = data.get("doc_types")
+        return cls(
+            stage=data["stage"],
+            model=data["model"],
+            doc_types=tuple(t.lower() for t in doc_types) if doc_types else None,
+            min_tokens=int(data.get("min_tokens") or 0),
+            max_tokens=int(data["max_tokens"]) if data.get("max_tokens") is not None else None,
+        )
+
+    def matches(self, stage: str, doc_type: Optional[str], tokens: int) -> bool:
+        if stage != self.stage:
+            return False
+        if self.doc_types is not None and (doc_type or "").lower() not in self.doc_types:
+            return False
+        if tokens < self.min_tokens:
+            return False
+        return self.max_tokens is None or tokens <= self.max_tokens
+
+
+def default_routes(strong_model: str) -> List[Route]:
+    """Map sul modello forte solo per tabelle e chunk molto lunghi"""
+    return [
+        Route("map", strong_model, doc_types=TABULAR_TYPES),
+        Route("map", strong_model, min_tokens=LARGE_CHUNK_TOKENS),
+    ]
+
+
+class ModelRouter:
+    """Modello per ogni richiesta, con eventuale modello di escalation"""
+
+    def __init__(self, defaults: Dict[str, str], routes: Iterable[Route] = (),
+                 escalation: Optional[str] = None):
+        self.defaults = dict(defaults)
+        self.routes = list(routes)
+        self.escalation = escalation or None
+
+    def model(self, stage: str, doc_type: Optional[str] = None, tokens: int = 0) -> str:
+        for route in self.routes:
+            if route.matches(stage, doc_type, tokens):
+                return route.model
+        return self.defaults[stage]
+
+    def candidates(self, stage: str, doc_type: Optional[str] = None, tokens: int = 0) -> List[str]:
+        """Modello scelto e, se diverso, quello di escalation da provare dopo"""
+        model = self.model(stage, doc_type, tokens)
+        if self.escalation and self.escalation != model:
+            return [model, self.escalation]
+        return [model]
+
+
+def router_for(cfg) -> ModelRouter:
+    """Router dai campi ``model_*`` di una ChunkerConfig"""
+    routes = ([Route.from_dict(r) for r in cfg.model_routes] if cfg.model_routes is not None
+              else default_routes(cfg.model_reduce))
+    return ModelRouter({"map": cfg.model_map, "reduce": cfg.model_reduce}, routes, cfg.model_escalation)
@@ -0,0 +1,129 @@
+"""sizing.py – Dimensione adattiva dei chunk
+-----------------------------------------------------------------------
+Sceglie i token per chunk in base alla finestra di contesto del modello,
+alla lunghezza del documento e a un obiettivo latenza/costo:
+
+    obiettivo(size) = ondate * latenza(size) + latenza(reduce)
+                      + peso_costo * chiamate * overhead
+
+dove ``ondate = ceil(chiamate / concorrenza)`` e ``latenza(size)`` è un
+modello lineare (a + b * token) stimato dalle chiamate osservate; la
+reduce si paga solo se il documento produce più di un chunk. Chunk
+piccoli sfruttano il parallelismo ma pagano più volte il system prompt e
+l'overhead per richiesta; chunk grandi fanno il contrario.
+"""
+from __future__ import annotations
+
+import math
+from typing import Dict, List
+
+# Finestre di contesto note (token); si usa il prefisso più lungo che combacia
+MODEL_CONTEXT: Dict[str, int] = {
+    "gpt-4o-mini": 128_000,
+    "gpt-4o": 128_000,
+    "gpt-4.1": 1_047_576,
+    "gpt-4-turbo": 128_000,
+    "gpt-4": 8_192,
+    "gpt-3.5-turbo": 16_385,
+}
+DEFAULT_CONTEXT = 8_192
+
+# Stime iniziali finché non ci sono osservazioni reali
+PRIOR_BASE_SECONDS = 2.0
+PRIOR_SECONDS_PER_TOKEN = 0.002
+PRIOR_WEIGHT = 3
+# Token medi prodotti da una map, usati per stimare l'input della reduce
+MAP_SUMMARY_TOKENS = 300
+
+
+def context_window(model: str) -> int:
+    matches = [name for name in MODEL_CONTEXT if model.startswith(name)]
+    if not matches:
+        return DEFAULT_CONTEXT
+    return MODEL_CONTEXT[max(matches, key=len)]
+
+
+class LatencyModel:
+    """Regressione lineare latenza ~ a + b * token_in, con prior."""
+
+    def __init__(self):
+        self.n = 0
+        self.sx = self.sy = self.sxx = self.sxy = 0.0
+        # Punti fittizi che ancorano la stima finché i dati sono pochi
+        for tokens in (500, 4000):
+            for _ in range(PRIOR_WEIGHT):
+                self.observe(tokens, PRIOR_BASE_SECONDS + PRIOR_SECONDS_PER_TOKEN * tokens)
+
+    def observe(self, tokens: int, seconds: float) -> None:
+        self.n += 1
+        self.sx += tokens
+        self.sy += seconds
+        self.sxx += tokens * tokens
+        self.sxy += tokens * seconds
+
+    def coefficients(self) -> tuple:
+        denom = self.n * self.sxx - self.sx * self.sx
+        if denom <= 0:
+            return PRIOR_BASE_SECONDS, PRIOR_SECONDS_PER_TOKEN
+        b = (self.n * self.sxy - self.sx * self.sy) / denom
+        a = (self.sy - b * self.sx) / self.n
+        # Un fit rumoroso non deve produrre latenze negative o decrescenti
+        return max(a, 0.1), max(b, 1e-5)
+
+    def predict(self, tokens: int) -> float:
+        a, b = self.coefficients()
+        return a + b * tokens
+
+
+class ChunkSizer:
+    """Politica di dimensionamento condivisa da tutti i Chunker dello stesso modello."""
+
+    def __init__(self, model: str, output_tokens: int = 1024, prompt_overhead: int = 400):
+        self.model = model
+        self.output_tokens = output_tokens
+        self.prompt_overhead = prompt_overhead
+        self.latency = LatencyModel()
+
+    def observe(self, chunk_tokens: int, seconds: float) -> None:
+        self.latency.observe(chunk_tokens + self.prompt_overhead, seconds)
+
+    def choose(self, doc_tokens: int, max_concurrency: int, min_tokens: int = 512,
+               max_tokens: int = 8000, cost_weight: float = 1.0) -> int:
+        """Token per chunk che minimizzano l'obiettivo per un documento di ``doc_tokens``"""
+        cap = min(max_tokens, context_window(self.model) - self.output_tokens - self.prompt_overhead)
+        cap = max(cap, min_tokens)
+        # Oltre la dimensione del documento non si guadagna nulla
+        cap = min(cap, max(min_tokens, doc_tokens))
+
+        best_size, best_score = cap, math.inf
+        for size in self._candidates(min_tokens, cap):
+            calls = math.ceil(doc_tokens / size)
+            waves = math.ceil(calls / max(1, max_concurrency))
+            makespan = waves * self.latency.predict(size + self.prompt_overhead)
+            if calls > 1:
+                makespan += self.latency.predict(calls * MAP_SUMMARY_TOKENS + self.prompt_overhead)
+            overhead_cost = calls * self.prompt_overhead / 1000
+            score = makespan + cost_weight * overhead_cost
+            if score < best_score:
+                best_size, best_score = size, score
+        return best_size
+
+    @staticmethod
+    def _candidates(low: int, high: int) -> List[int]:
+        sizes = []
+        size = low
+        while size < high:
+            sizes.append(size)
+            size = int(size * 1.5)
+        sizes.append(high)
+        return sizes
+
+
+_sizers: Dict[str, ChunkSizer] = {}
+
+
+def get_sizer(model: str) -> ChunkSizer:
+    """Sizer per modello; le osservazioni sopravvivono tra una richiesta e l'altra"""
+    if model not in _sizers:
+        _sizers[model] = ChunkSizer(model)
+    return _sizers[model]
@@ -0,0 +1,111 @@
+import os
+import asyncio
+import threading
+from typing import Any, Coroutine, Optional
+
+
+# Event loop persistente in un thread dedicato, uno per processo worker.
+# Gli handler Flask (sincroni) vi inviano le coroutine invece di creare un
+# nuovo loop con asyncio.run a ogni richiesta: il client AsyncOpenAI e il
+# suo pool di connessioni HTTP restano vivi e condivisi tra le richieste.
+class AsyncRuntime:
+
+	def __init__(self):
+		self._loop: Optional[asyncio.AbstractEventLoop] = None
+		self._thread: Optional[threading.Thread] = None
+		self._client = None
+		self._lock = threading.Lock()
+		self._inflight = 0
+		self._idle = threading.Condition(self._lock)
+		self._closing = False
+
+	# ------------------------------------------------------------------
+	# Ciclo di vita
+	# ------------------------------------------------------------------
+	def start(self) -> None:
+		with self._lock:
+			if self._loop is not None:
+				return
+			ready = threading.Event()
+
+			def runLoop():
+				self._loop = asyncio.new_event_loop()
+				asyncio.set_event_loop(self._loop)
+				ready.set()
+				self._loop.run_forever()
+
+			self._thread = threading.Thread(target=runLoop, name="async-runtime", daemon=True)
+			self._thread.start()
+			ready.wait()
+
+	def run(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+		"""Esegue la coroutine sul loop condiviso e ne attende il risultato"""
+		with self._lock:
+			if self._closing:
+				coro.close()
+				raise RuntimeError("Runtime in chiusura: nuovi job non accettati")
+			self._inflight += 1
+		try:
+			self.start()
+			return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+		finally:
+			with self._lock:
+				self._inflight -= 1
+				if self._inflight == 0:
+					self._idle.notify_all()
+
+	def inflight(self) -> int:
+		return self._inflight
+
+	def closing(self) -> bool:
+		return self._closing
+
+	def drain(self, timeout: Optional[float] = None) -> bool:
+		"""Smette di accettare job e attende quelli in corso; False se scade il timeout"""
+		with self._lock:
+			self._closing = True
+			return self._idle.wait_for(lambda: self._inflight == 0, timeout)
+
+	def shutdown(self, timeout: Optional[float] = 30) -> None:
+		"""Drena i job, chiude il client condiviso e ferma il loop"""
+		self.drain(timeout)
+		if self._loop is None:
+			return
+		if self._client is not None:
+			try:
+				asyncio.run_coroutine_threadsafe(self._client.close(), self._loop).result(10)
+			except Exception as e:
+				print(f"Error: closing the shared client failed: {e}")
+			self._client = None
+		self._loop.call_soon_threadsafe(self._loop.stop)
+		self._thread.join(timeout=10)
+		self._loop = None
+		self._thread = None
+
+	# ------------------------------------------------------------------
+	# Risorse condivise
+	# ------------------------------------------------------------------
+	def client(self):
+		"""Client AsyncOpenAI unico per processo (pool di connessioni riusato)"""
+		if self._client is None:
+			with self._lock:
+				if self._client is None:
+					from openai import AsyncOpenAI
+					self._client = AsyncOpenAI(
+						api_key=os.getenv("OPENAI_API_KEY"),
+						max_retries=int(os.getenv("SUMMY_OPENAI_MAX_RETRIES", 2))
+					)
+		return self._client
+
+
+_runtime: Optional[AsyncRuntime] = None
+_runtimeLock = threading.Lock()
+
+def getRuntime() -> AsyncRuntime:
+	"""Runtime del processo corrente, creato al primo uso (quindi dopo il fork dei worker)"""
+	global _runtime
+	if _runtime is None:
+		with _runtimeLock:
+			if _runtime is None:
+				_runtime = AsyncRuntime()
+	return _runtime
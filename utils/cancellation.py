@@ -0,0 +1,237 @@
+import os
+import re
+import time
+import asyncio
+import threading
+import subprocess
+import contextvars
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+# Annullamento cooperativo e scadenze dei job.
+#
+# Un CancelToken accompagna un job dall'ingest all'accumulation: chi lo
+# annulla (l'utente, o il timer della scadenza) fa partire le callback
+# registrate, che cancellano i task asyncio in attesa (chiamate al modello
+# non ancora partite, attese di slot) e uccidono i sottoprocessi (ffmpeg).
+# Il codice sincrono controlla il token tra un passo e l'altro.
+#
+# JobCancelled deriva da BaseException, come asyncio.CancelledError: i tanti
+# ``except Exception`` che trasformano un errore in un fallback (chunk non
+# riassunto, file saltato) non devono trasformare anche l'annullamento.
+#
+# Come per la priorità (vedi scheduler.py) il token corrente viaggia in un
+# ContextVar, così arriva ai punti profondi senza cambiare ogni firma.
+
+_JOB_ID = re.compile(r"^[0-9A-Za-z_-]{8,64}$")
+
+
+class JobCancelled(BaseException):
+
+	def __init__(self, reason: str = "cancelled"):
+		super().__init__(f"Job annullato ({reason})")
+		self.reason = reason
+
+
+class CancelToken:
+
+	def __init__(self, timeout: Optional[float] = None, jobId: Optional[str] = None):
+		self.jobId = jobId
+		self.deadline = time.monotonic() + timeout if timeout else None
+		self._reason: Optional[str] = None
+		self._lock = threading.Lock()
+		self._callbacks: List[Callable[[], None]] = []
+		self._timer = None
+		if timeout:
+			# Alla scadenza il token si annulla da solo, anche se nessuno lo controlla
+			self._timer = threading.Timer(timeout, self.cancel, args=("deadline",))
+			self._timer.daemon = True
+			self._timer.start()
+
+	@property
+	def cancelled(self) -> bool:
+		return self._reason is not None
+
+	@property
+	def reason(self) -> Optional[str]:
+		return self._reason
+
+	def remaining(self) -> Optional[float]:
+		"""Secondi alla scadenza (None se non c'è)"""
+		if self.deadline is None:
+			return None
+		return max(0.0, self.deadline - time.monotonic())
+
+	def cancel(self, reason: str = "cancelled") -> bool:
+		"""Annulla il job; False se era già annullato"""
+		with self._lock:
+			if self._reason is not None:
+				return False
+			self._reason = reason
+			callbacks, self._callbacks = self._callbacks, []
+		for callback in callbacks:
+			try:
+				callback()
+			except Exception as e:
+				print(f"Error: cancellation callback failed: {e}")
+		return True
+
+	def check(self) -> None:
+		if self._reason is not None:
+			raise JobCancelled(self._reason)
+
+	def onCancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+		"""Registra una callback; restituisce la funzione per rimuoverla"""
+		with self._lock:
+			if self._reason is None:
+				self._callbacks.append(callback)
+				registered = True
+			else:
+				registered = False
+		if not registered:
+			callback()
+			return lambda: None
+
+		def remove():
+			with self._lock:
+				if callback in self._callbacks:
+					self._callbacks.remove(callback)
+		return remove
+
+	def close(self) -> None:
+		"""Job concluso: ferma il timer della scadenza"""
+		if self._timer is not None:
+			self._timer.cancel()
+
+	async def run(self, coro):
+		"""Esegue la coroutine (o il future); all'annullamento la cancella e solleva JobCancelled"""
+		if self.cancelled:
+			# Mai partita: niente avviso "coroutine was never awaited"
+			if asyncio.iscoroutine(coro):
+				coro.close()
+			else:
+				coro.cancel()
+			raise JobCancelled(self._reason)
+		loop = asyncio.get_running_loop()
+		task = asyncio.ensure_future(coro)
+		remove = self.onCancel(lambda: loop.call_soon_threadsafe(task.cancel))
+		try:
+			return await task
+		except asyncio.CancelledError:
+			if self.cancelled:
+				raise JobCancelled(self._reason) from None
+			raise
+		finally:
+			remove()
+
+
+_currentToken: contextvars.ContextVar = contextvars.ContextVar("summyCancelToken", default=None)
+
+@contextmanager
+def cancelScope(token: Optional[CancelToken]):
+	"""Rende ``token`` il token corrente per tutto il lavoro svolto nel blocco"""
+	reset = _currentToken.set(token)
+	try:
+		yield token
+	finally:
+		_currentToken.reset(reset)
+
+def currentToken() -> Optional[CancelToken]:
+	return _currentToken.get()
+
+def checkCancelled(token: Optional[CancelToken] = None) -> None:
+	token = token or currentToken()
+	if token is not None:
+		token.check()
+
+
+def runProcess(cmd: List[str], token: Optional[CancelToken] = None, **kwargs) -> subprocess.CompletedProcess:
+	"""Come ``subprocess.run(cmd, capture_output=True, text=True, check=True)``,
+	ma il processo viene ucciso appena il token si annulla o scade"""
+	token = token or currentToken()
+	checkCancelled(token)
+	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, **kwargs)
+	remove = token.onCancel(proc.kill) if token is not None else (lambda: None)
+	try:
+		stdout, stderr = proc.communicate()
+	finally:
+		remove()
+	checkCancelled(token)
+	if proc.returncode != 0:
+		raise subprocess.CalledProcessError(proc.returncode, cmd, stdout, stderr)
+	return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+class JobRegistry:
+	"""Token dei job in corso, annullabili per ID anche da un altro processo.
+
+	Con più worker (gunicorn) la richiesta di annullamento può arrivare a un
+	processo diverso da quello che esegue il job: ``cancel`` scrive un file
+	marcatore in ``markerDir`` e un thread per processo lo cerca per i job
+	registrati localmente.
+	"""
+
+	def __init__(self, markerDir: str, pollInterval: float = 0.5):
+		self.markerDir = Path(markerDir)
+		self.markerDir.mkdir(parents=True, exist_ok=True)
+		self.pollInterval = pollInterval
+		self._tokens: Dict[str, CancelToken] = {}
+		self._lock = threading.Lock()
+		self._watcher: Optional[threading.Thread] = None
+
+	@staticmethod
+	def validId(jobId: Optional[str]) -> bool:
+		return bool(jobId) and bool(_JOB_ID.match(jobId))
+
+	def _marker(self, jobId: str) -> Path:
+		return self.markerDir / jobId
+
+	def register(self, jobId: str, token: CancelToken) -> None:
+		if not self.validId(jobId):
+			raise ValueError(f"job_id non valido: {jobId}")
+		self._pruneMarkers()
+		with self._lock:
+			self._tokens[jobId] = token
+			if self._watcher is None or not self._watcher.is_alive():
+				self._watcher = threading.Thread(target=self._watch, name="job-cancel-watcher", daemon=True)
+				self._watcher.start()
+		# Annullato prima ancora di partire (es. la pagina chiusa durante l'upload)
+		if self._marker(jobId).exists():
+			token.cancel()
+
+	def unregister(self, jobId: str) -> None:
+		with self._lock:
+			self._tokens.pop(jobId, None)
+		try:
+			self._marker(jobId).unlink()
+		except OSError:
+			pass
+
+	def cancel(self, jobId: str) -> bool:
+		"""Annulla il job; True se era in corso in questo processo"""
+		if not self.validId(jobId):
+			return False
+		self._marker(jobId).touch()
+		with self._lock:
+			token = self._tokens.get(jobId)
+		return token is not None and token.cancel()
+
+	def _pruneMarkers(self, maxAge: float = 86400) -> None:
+		# Marcatori di job mai partiti in questo archivio (annullati durante l'upload)
+		limit = time.time() - maxAge
+		for marker in self.markerDir.iterdir():
+			try:
+				if marker.stat().st_mtime < limit:
+					marker.unlink()
+			except OSError:
+				continue
+
+	def _watch(self) -> None:
+		while True:
+			time.sleep(self.pollInterval)
+			with self._lock:
+				tokens = list(self._tokens.items())
+			for jobId, token in tokens:
+				if not token.cancelled and os.path.exists(self._marker(jobId)):
+					token.cancel()
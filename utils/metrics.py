@@ -0,0 +1,446 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+	import fcntl
+except ImportError:  # pragma: no cover - Windows, solo sviluppo a processo singolo
+	fcntl = None
+
+from utils.usage import currentLedger
+
+
+# Metriche in memoria nel formato testuale di Prometheus, senza dipendenze.
+# Ogni processo ha il proprio registro; con più worker gunicorn i registri si
+# condividono via file (Registry.shareWith) e ogni scrape di /api/metrics
+# somma tutti i worker: contatori e istogrammi includono anche i worker
+# terminati, i gauge solo quelli vivi.
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _labelKey(labelNames: Tuple[str, ...], labels: Dict[str, str]) -> Tuple[str, ...]:
+	return tuple(str(labels.get(name, "")) for name in labelNames)
+
+def _formatLabels(labelNames: Tuple[str, ...], key: Tuple[str, ...], extra: str = "") -> str:
+	parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelNames, key)]
+	if extra:
+		parts.append(extra)
+	return "{" + ",".join(parts) + "}" if parts else ""
+
+def _escape(value: str) -> str:
+	return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+
+	kind = ""
+
+	def __init__(self, name: str, help: str, labelNames: Tuple[str, ...] = ()):
+		self.name = name
+		self.help = help
+		self.labelNames = tuple(labelNames)
+		self._lock = threading.Lock()
+
+	def header(self) -> List[str]:
+		return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+	def spec(self) -> Dict:
+		"""Descrizione e valori della metrica, serializzabili in JSON"""
+		return {"kind": self.kind, "help": self.help, "labelNames": list(self.labelNames),
+			"values": self.state()}
+
+	def state(self) -> list:
+		with self._lock:
+			return [[list(key), value] for key, value in self._values.items()]
+
+	def absorb(self, values: list) -> None:
+		"""Somma ai propri i valori di ``state()`` di un altro processo"""
+		with self._lock:
+			for key, value in values:
+				key = tuple(key)
+				self._values[key] = self._values.get(key, 0) + value
+
+
+class Counter(_Metric):
+
+	kind = "counter"
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._values: Dict[Tuple[str, ...], float] = {}
+
+	def inc(self, amount: float = 1, **labels) -> None:
+		key = _labelKey(self.labelNames, labels)
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + amount
+
+	def render(self) -> List[str]:
+		with self._lock:
+			items = sorted(self._values.items())
+		return self.header() + [f"{self.name}{_formatLabels(self.labelNames, k)} {v}" for k, v in items]
+
+
+class Gauge(_Metric):
+	"""Valore istantaneo; con ``callback`` viene letto al momento dello scrape.
+
+	Con ``local`` descrive solo il processo che risponde e non si somma agli
+	altri worker.
+	"""
+
+	kind = "gauge"
+
+	def __init__(self, *args, callback: Optional[Callable[[], float]] = None, local: bool = False, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._values: Dict[Tuple[str, ...], float] = {}
+		self.callback = callback
+		self.local = local
+
+	def spec(self) -> Dict:
+		return {**super().spec(), "local": self.local}
+
+	def state(self) -> list:
+		if self.callback is not None:
+			return [[[], self.callback()]]
+		return super().state()
+
+	def set(self, value: float, **labels) -> None:
+		with self._lock:
+			self._values[_labelKey(self.labelNames, labels)] = value
+
+	def inc(self, amount: float = 1, **labels) -> None:
+		key = _labelKey(self.labelNames, labels)
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + amount
+
+	def dec(self, amount: float = 1, **labels) -> None:
+		self.inc(-amount, **labels)
+
+	def render(self) -> List[str]:
+		if self.callback is not None:
+			return self.header() + [f"{self.name} {self.callback()}"]
+		with self._lock:
+			items = sorted(self._values.items())
+		return self.header() + [f"{self.name}{_formatLabels(self.labelNames, k)} {v}" for k, v in items]
+
+
+class Histogram(_Metric):
+
+	kind = "histogram"
+
+	def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.buckets = tuple(sorted(buckets))
+		# Per label: (conteggi per bucket, somma, numero di osservazioni)
+		self._values: Dict[Tuple[str, ...], list] = {}
+
+	def observe(self, value: float, **labels) -> None:
+		key = _labelKey(self.labelNames, labels)
+		idx = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			state = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+			if idx < len(self.buckets):
+				state[0][idx] += 1
+			state[1] += value
+			state[2] += 1
+
+	def spec(self) -> Dict:
+		return {**super().spec(), "buckets": list(self.buckets)}
+
+	def state(self) -> list:
+		with self._lock:
+			return [[list(key), [list(v[0]), v[1], v[2]]] for key, v in self._values.items()]
+
+	def absorb(self, values: list) -> None:
+		with self._lock:
+			for key, (counts, total, n) in values:
+				state = self._values.setdefault(tuple(key), [[0] * len(self.buckets), 0.0, 0])
+				state[0] = [a + b for a, b in zip(state[0], counts)]
+				state[1] += total
+				state[2] += n
+
+	@contextmanager
+	def time(self, **labels):
+		started = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - started, **labels)
+
+	def render(self) -> List[str]:
+		lines = self.header()
+		with self._lock:
+			items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+		for key, (counts, total, n) in items:
+			cumulative = 0
+			for bound, count in zip(self.buckets, counts):
+				cumulative += count
+				le = 'le="%s"' % bound
+				lines.append(f"{self.name}_bucket{_formatLabels(self.labelNames, key, le)} {cumulative}")
+			inf = 'le="+Inf"'
+			lines.append(f"{self.name}_bucket{_formatLabels(self.labelNames, key, inf)} {n}")
+			lines.append(f"{self.name}_sum{_formatLabels(self.labelNames, key)} {total}")
+			lines.append(f"{self.name}_count{_formatLabels(self.labelNames, key)} {n}")
+		return lines
+
+
+_KINDS = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+
+def _fromSpec(name: str, spec: Dict) -> _Metric:
+	kwargs = {"buckets": tuple(spec["buckets"])} if spec["kind"] == "histogram" else {}
+	return _KINDS[spec["kind"]](name, spec["help"], tuple(spec["labelNames"]), **kwargs)
+
+def _renderMetrics(metrics: List[_Metric]) -> str:
+	lines = []
+	for metric in metrics:
+		lines.extend(metric.render())
+	return "\n".join(lines) + "\n"
+
+def _alive(pid: int) -> bool:
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+@contextmanager
+def _shareLock(directory: Path, exclusive: bool = False):
+	"""Lock tra processi sulla cartella condivisa: l'archivio cambia solo in esclusiva"""
+	if fcntl is None:
+		yield
+		return
+	with open(directory / ".lock", "a") as handle:
+		fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+		try:
+			yield
+		finally:
+			fcntl.flock(handle, fcntl.LOCK_UN)
+
+def _readJson(path: Path) -> Optional[Dict]:
+	try:
+		return json.loads(path.read_text(encoding="utf-8"))
+	except (OSError, ValueError):
+		return None
+
+def _writeJson(path: Path, data: Dict) -> None:
+	tmp = path.with_name(f".{path.name}.tmp")
+	tmp.write_text(json.dumps(data), encoding="utf-8")
+	os.replace(tmp, path)
+
+ARCHIVE_FILE = "archive.json"
+
+def archiveSnapshot(directory: str, pid: int) -> None:
+	"""Sposta contatori e istogrammi di un worker terminato nell'archivio comune.
+
+	Da chiamare nel master (hook ``child_exit`` di gunicorn): i totali non
+	calano quando un worker viene riciclato e la cartella non cresce.
+	"""
+	directory = Path(directory)
+	path = directory / f"{pid}.json"
+	with _shareLock(directory, exclusive=True):
+		snapshot = _readJson(path)
+		if snapshot is None:
+			return
+		archive = _readJson(directory / ARCHIVE_FILE) or {"pid": None, "metrics": {}}
+		for name, spec in snapshot["metrics"].items():
+			if spec["kind"] == "gauge":
+				continue
+			metric = _fromSpec(name, spec)
+			metric.absorb(archive["metrics"].get(name, {}).get("values", []))
+			metric.absorb(spec["values"])
+			archive["metrics"][name] = metric.spec()
+		_writeJson(directory / ARCHIVE_FILE, archive)
+		path.unlink()
+
+
+class Registry:
+
+	def __init__(self):
+		self._metrics: Dict[str, _Metric] = {}
+		self._lock = threading.Lock()
+		self.shareDir: Optional[Path] = None
+
+	def _get(self, cls, name: str, help: str, labelNames: Tuple[str, ...], **kwargs):
+		with self._lock:
+			metric = self._metrics.get(name)
+			if metric is None:
+				metric = self._metrics[name] = cls(name, help, tuple(labelNames), **kwargs)
+			return metric
+
+	def counter(self, name: str, help: str, labelNames: Tuple[str, ...] = ()) -> Counter:
+		return self._get(Counter, name, help, labelNames)
+
+	def gauge(self, name: str, help: str, labelNames: Tuple[str, ...] = (), callback=None,
+			local: bool = False) -> Gauge:
+		return self._get(Gauge, name, help, labelNames, callback=callback, local=local)
+
+	def histogram(self, name: str, help: str, labelNames: Tuple[str, ...] = (),
+			buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+		return self._get(Histogram, name, help, labelNames, buckets=buckets)
+
+	def snapshot(self) -> Dict:
+		with self._lock:
+			metrics = dict(self._metrics)
+		return {"pid": os.getpid(), "metrics": {name: metric.spec() for name, metric in metrics.items()}}
+
+	def shareWith(self, directory: str, interval: float = 5.0) -> None:
+		"""Condivide il registro con gli altri processi che usano ``directory``.
+
+		Un thread scrive lo stato del processo in ``<pid>.json`` ogni
+		``interval`` secondi; render() somma quelli di tutti i processi.
+		"""
+		self.shareDir = Path(directory)
+		self.shareDir.mkdir(parents=True, exist_ok=True)
+		self.flush()
+		threading.Thread(target=self._flushLoop, args=(interval,), name="metrics-flush", daemon=True).start()
+
+	def _flushLoop(self, interval: float) -> None:
+		while True:
+			time.sleep(interval)
+			try:
+				self.flush()
+			except OSError:
+				pass
+
+	def flush(self) -> None:
+		"""Scrive subito lo stato del processo nella cartella condivisa"""
+		if self.shareDir is not None:
+			_writeJson(self.shareDir / f"{os.getpid()}.json", self.snapshot())
+
+	def render(self) -> str:
+		if self.shareDir is None:
+			with self._lock:
+				metrics = [self._metrics[name] for name in sorted(self._metrics)]
+			return _renderMetrics(metrics)
+		return self._renderShared()
+
+	def _renderShared(self) -> str:
+		own = self.snapshot()
+		snapshots = [own]
+		with _shareLock(self.shareDir):
+			for path in self.shareDir.glob("*.json"):
+				if path.stem != str(own["pid"]):
+					snapshot = _readJson(path)
+					if snapshot is not None:
+						snapshots.append(snapshot)
+		merged: Dict[str, _Metric] = {}
+		for snapshot in snapshots:
+			mine = snapshot is own
+			alive = mine or (snapshot["pid"] is not None and _alive(snapshot["pid"]))
+			for name, spec in snapshot["metrics"].items():
+				# Gauge: solo i processi vivi, e quelli locali solo da chi risponde
+				if spec["kind"] == "gauge" and (not alive or (spec.get("local") and not mine)):
+					continue
+				if name not in merged:
+					merged[name] = _fromSpec(name, spec)
+				merged[name].absorb(spec["values"])
+		return _renderMetrics([merged[name] for name in sorted(merged)])
+
+
+REGISTRY = Registry()
+
+# Metriche della pipeline, condivise da ingest, chunker, accumulation e app
+EXTRACTION_SECONDS = REGISTRY.histogram(
+	"summy_extraction_seconds", "Tempo di estrazione per file, per tipo", ("type",))
+LLM_REQUEST_SECONDS = REGISTRY.histogram(
+	"summy_llm_request_seconds", "Latenza delle chiamate al modello", ("stage", "model"))
+LLM_TOKENS = REGISTRY.counter(
+	"summy_llm_tokens_total", "Token di input/output delle chiamate al modello", ("stage", "direction"))
+LLM_CACHED_TOKENS = REGISTRY.counter(
+	"summy_llm_cached_prompt_tokens_total", "Token di prompt serviti dalla prompt cache", ("stage",))
+LLM_ERRORS = REGISTRY.counter(
+	"summy_llm_errors_total", "Chiamate al modello fallite (sostituite da fallback o ritentate)", ("stage",))
+LLM_INFLIGHT = REGISTRY.gauge(
+	"summy_llm_inflight", "Chiamate al modello in corso", ("stage",))
+CACHE_LOOKUPS = REGISTRY.counter(
+	"summy_cache_lookups_total", "Ricerche nelle cache locali (riassunti, embedding, ingest)", ("cache", "result"))
+STAGE_SECONDS = REGISTRY.histogram(
+	"summy_stage_seconds", "Durata delle fasi di un job", ("stage",))
+PROCESS_PID = REGISTRY.gauge(
+	"summy_process_pid", "PID del worker che ha risposto allo scrape", callback=os.getpid, local=True)
+JOBS = REGISTRY.counter(
+	"summy_jobs_total", "Job di elaborazione conclusi", ("status",))
+MODEL_ESCALATIONS = REGISTRY.counter(
+	"summy_model_escalations_total", "Richieste ripetute sul modello di escalation dopo una risposta non valida",
+	("stage", "model"))
+QUEUE_TASKS = REGISTRY.counter(
+	"summy_queue_tasks_total", "Task della coda condivisa eseguiti dai worker", ("kind", "status"))
+SCHEDULER_WAIT_SECONDS = REGISTRY.histogram(
+	"summy_scheduler_wait_seconds", "Attesa di uno slot dello scheduler", ("resource", "priority"))
+SCHEDULER_ACTIVE = REGISTRY.gauge(
+	"summy_scheduler_active", "Slot dello scheduler in uso", ("resource", "priority"))
+SCHEDULER_QUEUED = REGISTRY.gauge(
+	"summy_scheduler_queued", "Richieste in attesa di uno slot dello scheduler", ("resource", "priority"))
+
+
+class LlmCall:
+	"""Modello e durata di una chiamata misurata da ``llmCall``"""
+	__slots__ = ("model", "seconds")
+
+	def __init__(self, model: str):
+		self.model = model
+		self.seconds: Optional[float] = None
+
+@contextmanager
+def llmCall(stage: str, model: str):
+	"""Misura una chiamata al modello: latenza, chiamate in corso ed errori"""
+	LLM_INFLIGHT.inc(stage=stage)
+	call = LlmCall(model)
+	started = time.perf_counter()
+	try:
+		yield call
+	except Exception:
+		LLM_ERRORS.inc(stage=stage)
+		raise
+	finally:
+		call.seconds = time.perf_counter() - started
+		LLM_INFLIGHT.dec(stage=stage)
+		LLM_REQUEST_SECONDS.observe(call.seconds, stage=stage, model=model)
+
+def recordUsage(stage: str, response, call: Optional[LlmCall] = None) -> None:
+	"""Token di input/output e in cache dal campo usage di una risposta OpenAI.
+
+	Con un registro del job attivo (vedi utils/usage.py) la chiamata vi viene
+	annotata con modello e durata presi da ``call``.
+	"""
+	usage = getattr(response, "usage", None)
+	if usage is None:
+		return
+	LLM_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, stage=stage, direction="in")
+	LLM_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, stage=stage, direction="out")
+	details = getattr(usage, "prompt_tokens_details", None)
+	LLM_CACHED_TOKENS.inc(getattr(details, "cached_tokens", None) or 0, stage=stage)
+	ledger = currentLedger()
+	if ledger is not None:
+		model = call.model if call is not None else getattr(response, "model", None)
+		ledger.record(stage, model, usage, call.seconds if call is not None else None)
+
+
+class JobTimings:
+	"""Ripartizione dei tempi di un singolo job, da restituire nel risultato"""
+
+	def __init__(self):
+		self.stages: Dict[str, float] = {}
+		self._started = time.perf_counter()
+
+	@contextmanager
+	def stage(self, name: str):
+		started = time.perf_counter()
+		try:
+			yield
+		finally:
+			elapsed = time.perf_counter() - started
+			self.stages[name] = self.stages.get(name, 0.0) + elapsed
+			STAGE_SECONDS.observe(elapsed, stage=name)
+
+	def report(self) -> Dict[str, float]:
+		report = {name: round(seconds, 3) for name, seconds in self.stages.items()}
+		report["total"] = round(time.perf_counter() - self._started, 3)
+		return report
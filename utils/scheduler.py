@@ -0,0 +1,232 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+from typing import Dict, Optional, Tuple
+
+from utils.metrics import SCHEDULER_WAIT_SECONDS, SCHEDULER_ACTIVE, SCHEDULER_QUEUED
+from utils.cancellation import checkCancelled
+
+# Scheduler a priorità con equità tra tenant per le risorse condivise del
+# processo: le chiamate al modello e l'estrazione (Whisper, OCR, PDF).
+#
+# - Due classi di priorità: "interactive" (upload dell'utente, domande) e
+#   "bulk" (backfill, lotti grandi). Uno slot libero va sempre prima a chi
+#   attende in classe interactive.
+# - Dentro una classe gli slot girano a turno tra i tenant (round robin):
+#   un tenant con mille chunk in coda non fa aspettare chi ne ha tre.
+# - Ogni chiamata al modello e ogni file estratto chiede uno slot: un job
+#   bulk cede il passo tra un chunk e l'altro, senza interrompere le
+#   chiamate già partite.
+# - Quando c'è traffico interactive (in corso, in attesa o visto negli
+#   ultimi ``cooldown`` secondi) i job bulk scendono a ``bulkShare`` degli
+#   slot; a sistema libero li usano tutti.
+#
+# La classe e il tenant del job corrente viaggiano in un ContextVar
+# (``jobContext``): passano ai task asyncio creati dal job e alle coroutine
+# inviate al runtime condiviso, senza toccare le firme delle funzioni.
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITY_CLASSES = (INTERACTIVE, BULK)
+
+DEFAULT_TENANT = "default"
+
+_currentJob: contextvars.ContextVar = contextvars.ContextVar("summyJob", default=(INTERACTIVE, DEFAULT_TENANT))
+
+
+@contextmanager
+def jobContext(priority: str = INTERACTIVE, tenant: Optional[str] = None):
+	"""Classe di priorità e tenant per tutto il lavoro svolto nel blocco"""
+	if priority not in PRIORITY_CLASSES:
+		raise ValueError(f"Classe di priorità non valida: {priority}")
+	token = _currentJob.set((priority, tenant or DEFAULT_TENANT))
+	try:
+		yield
+	finally:
+		_currentJob.reset(token)
+
+def currentJob() -> Tuple[str, str]:
+	return _currentJob.get()
+
+
+class _Waiter:
+	__slots__ = ("priority", "tenant", "event", "future", "loop", "granted", "queuedAt")
+
+	def __init__(self, priority: str, tenant: str, loop: Optional[asyncio.AbstractEventLoop] = None):
+		self.priority = priority
+		self.tenant = tenant
+		self.loop = loop
+		self.future = loop.create_future() if loop is not None else None
+		self.event = threading.Event() if loop is None else None
+		self.granted = False
+		self.queuedAt = time.perf_counter()
+
+	def wake(self) -> None:
+		if self.event is not None:
+			self.event.set()
+		else:
+			self.loop.call_soon_threadsafe(_resolve, self.future)
+
+def _resolve(future: asyncio.Future) -> None:
+	if not future.done():
+		future.set_result(None)
+
+
+class FairScheduler:
+	"""Slot di una risorsa condivisa, usabile da thread e da coroutine"""
+
+	def __init__(self, name: str, capacity: int, bulkShare: float = 0.25, cooldown: float = 5.0):
+		self.name = name
+		self.capacity = max(1, capacity)
+		# Slot concessi ai job bulk mentre c'è traffico interactive (almeno uno: niente starvation)
+		self.bulkLimit = max(1, int(self.capacity * bulkShare))
+		self.cooldown = cooldown
+		self._lock = threading.Lock()
+		self._queues: Dict[str, "OrderedDict[str, deque]"] = {cls: OrderedDict() for cls in PRIORITY_CLASSES}
+		self._active: Dict[str, int] = {cls: 0 for cls in PRIORITY_CLASSES}
+		self._lastInteractive = float("-inf")
+
+	# ------------------------------------------------------------------
+	# Politica
+	# ------------------------------------------------------------------
+	def _interactiveBusy(self) -> bool:
+		return (self._active[INTERACTIVE] > 0 or bool(self._queues[INTERACTIVE])
+			or time.monotonic() - self._lastInteractive < self.cooldown)
+
+	def _limit(self, priority: str) -> int:
+		if priority == BULK and self._interactiveBusy():
+			return self.bulkLimit
+		return self.capacity
+
+	def _next(self) -> Optional[_Waiter]:
+		for priority in PRIORITY_CLASSES:
+			tenants = self._queues[priority]
+			if not tenants or self._active[priority] >= self._limit(priority):
+				continue
+			# Round robin: il tenant servito passa in fondo al giro
+			tenant, waiters = next(iter(tenants.items()))
+			waiter = waiters.popleft()
+			if waiters:
+				tenants.move_to_end(tenant)
+			else:
+				del tenants[tenant]
+			return waiter
+		return None
+
+	def _dispatch(self) -> None:
+		while sum(self._active.values()) < self.capacity:
+			waiter = self._next()
+			if waiter is None:
+				return
+			waiter.granted = True
+			self._active[waiter.priority] += 1
+			SCHEDULER_QUEUED.dec(resource=self.name, priority=waiter.priority)
+			SCHEDULER_ACTIVE.inc(resource=self.name, priority=waiter.priority)
+			waiter.wake()
+
+	# ------------------------------------------------------------------
+	# Acquisizione e rilascio
+	# ------------------------------------------------------------------
+	def _enqueue(self, waiter: _Waiter) -> None:
+		with self._lock:
+			if waiter.priority == INTERACTIVE:
+				self._lastInteractive = time.monotonic()
+			self._queues[waiter.priority].setdefault(waiter.tenant, deque()).append(waiter)
+			SCHEDULER_QUEUED.inc(resource=self.name, priority=waiter.priority)
+			self._dispatch()
+
+	def _abandon(self, waiter: _Waiter) -> None:
+		"""Il richiedente rinuncia (cancellazione): libera lo slot o esce dalla coda"""
+		with self._lock:
+			if not waiter.granted:
+				tenants = self._queues[waiter.priority]
+				waiters = tenants.get(waiter.tenant)
+				if waiters is not None and waiter in waiters:
+					waiters.remove(waiter)
+					if not waiters:
+						del tenants[waiter.tenant]
+				SCHEDULER_QUEUED.dec(resource=self.name, priority=waiter.priority)
+				return
+		self._release(waiter.priority)
+
+	def _release(self, priority: str) -> None:
+		with self._lock:
+			self._active[priority] -= 1
+			if priority == INTERACTIVE:
+				self._lastInteractive = time.monotonic()
+			SCHEDULER_ACTIVE.dec(resource=self.name, priority=priority)
+			self._dispatch()
+
+	def _granted(self, waiter: _Waiter) -> None:
+		SCHEDULER_WAIT_SECONDS.observe(time.perf_counter() - waiter.queuedAt,
+			resource=self.name, priority=waiter.priority)
+
+	@contextmanager
+	def slot(self):
+		"""Slot per il job corrente (da thread sincroni, es. l'estrazione)"""
+		priority, tenant = currentJob()
+		waiter = _Waiter(priority, tenant)
+		self._enqueue(waiter)
+		try:
+			# Attesa a intervalli: un job annullato esce dalla coda senza aspettare lo slot
+			while not waiter.event.wait(0.25):
+				checkCancelled()
+		except BaseException:
+			self._abandon(waiter)
+			raise
+		self._granted(waiter)
+		try:
+			yield
+		finally:
+			self._release(priority)
+
+	@asynccontextmanager
+	async def asyncSlot(self):
+		"""Slot per il job corrente, da coroutine (chiamate al modello)"""
+		priority, tenant = currentJob()
+		waiter = _Waiter(priority, tenant, asyncio.get_running_loop())
+		self._enqueue(waiter)
+		try:
+			await waiter.future
+		except BaseException:
+			self._abandon(waiter)
+			raise
+		self._granted(waiter)
+		try:
+			yield
+		finally:
+			self._release(priority)
+
+	def stats(self) -> Dict[str, Dict[str, int]]:
+		with self._lock:
+			return {cls: {"active": self._active[cls],
+				"queued": sum(len(w) for w in self._queues[cls].values()),
+				"tenants": len(self._queues[cls])} for cls in PRIORITY_CLASSES}
+
+
+_schedulers: Dict[str, FairScheduler] = {}
+_schedulersLock = threading.Lock()
+
+def _scheduler(name: str, envSlots: str, defaultSlots: int) -> FairScheduler:
+	if name not in _schedulers:
+		with _schedulersLock:
+			if name not in _schedulers:
+				_schedulers[name] = FairScheduler(
+					name,
+					int(os.getenv(envSlots, defaultSlots)),
+					bulkShare=float(os.getenv("SUMMY_BULK_SHARE", 0.25)),
+					cooldown=float(os.getenv("SUMMY_INTERACTIVE_COOLDOWN", 5.0))
+				)
+	return _schedulers[name]
+
+def llmScheduler() -> FairScheduler:
+	"""Chiamate al modello in parallelo nel processo (tutte le fasi e tutti i job)"""
+	return _scheduler("llm", "SUMMY_LLM_SLOTS", 16)
+
+def ingestScheduler() -> FairScheduler:
+	"""File in estrazione in parallelo nel processo"""
+	return _scheduler("ingest", "SUMMY_INGEST_SLOTS", max(1, (os.cpu_count() or 2) // 2))
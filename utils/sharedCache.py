@@ -0,0 +1,47 @@
+import os
+import socket
+import json
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from utils.metrics import CACHE_LOOKUPS
+
+# Cache dei risultati indirizzata per contenuto, su filesystem condiviso.
+# La chiave è l'ID del task che ha prodotto il valore (hash di tipo e
+# payload, vedi taskQueue.py): lo stesso lavoro fatto da qualsiasi nodo
+# finisce nello stesso file, quindi scritture concorrenti sono innocue.
+# Layout: <root>/<chiave[:2]>/<chiave>.json, scritto in modo atomico.
+
+class SharedCache:
+
+	def __init__(self, rootDir: str):
+		self.root = Path(rootDir)
+		self.root.mkdir(parents=True, exist_ok=True)
+
+	def _path(self, key: str) -> Path:
+		return self.root / key[:2] / f"{key}.json"
+
+	def has(self, key: str) -> bool:
+		return self._path(key).exists()
+
+	def get(self, key: str) -> Optional[Any]:
+		try:
+			with open(self._path(key), "r", encoding="utf-8") as f:
+				value = json.load(f)["value"]
+		except (OSError, json.JSONDecodeError, KeyError, TypeError):
+			CACHE_LOOKUPS.inc(cache="shared", result="miss")
+			return None
+		CACHE_LOOKUPS.inc(cache="shared", result="hit")
+		return value
+
+	def put(self, key: str, value: Any) -> None:
+		path = self._path(key)
+		path.parent.mkdir(parents=True, exist_ok=True)
+		# Nome temporaneo unico per nodo e processo: niente collisioni su NFS
+		tmp = path.with_name(f"{path.name}.{socket.gethostname()}.{os.getpid()}.tmp")
+		with open(tmp, "w", encoding="utf-8") as f:
+			json.dump({"value": value, "saved_at": time.time()}, f, ensure_ascii=False)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, path)
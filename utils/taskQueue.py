@@ -0,0 +1,226 @@
+import json
+import time
+import hashlib
+from typing import Any, Dict, Iterable, List, Optional
+
+from formatting.storing import open_database
+
+# Coda durevole dei task della pipeline (estrazione, map, reduce, accumulation)
+# condivisa dai worker di più processi o macchine. È una coda su SQLite: basta
+# un file su filesystem condiviso, nessun broker da installare.
+#
+# - L'ID di un task è l'hash di tipo e payload: accodare due volte lo stesso
+#   lavoro (anche da nodi diversi) produce un solo task, e lo stesso ID è la
+#   chiave del risultato nella cache condivisa (vedi sharedCache.py).
+# - Un worker prende un task in lease per ``leaseSeconds`` e lo rinnova con
+#   ``heartbeat``; se il worker muore il lease scade e il task torna in coda.
+# - Un task fallito viene ritentato con backoff esponenziale fino a
+#   ``max_attempts``, poi resta "failed" finché qualcuno non lo riaccoda.
+#
+# I lease si confrontano con l'orologio di sistema: i nodi devono avere gli
+# orologi sincronizzati (NTP). Su filesystem di rete serve journalMode="DELETE".
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+	id TEXT PRIMARY KEY,
+	kind TEXT NOT NULL,
+	payload TEXT NOT NULL,
+	priority INTEGER NOT NULL DEFAULT 0,
+	status TEXT NOT NULL,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	max_attempts INTEGER NOT NULL,
+	available_at REAL NOT NULL,
+	lease_owner TEXT,
+	lease_expires REAL,
+	error TEXT,
+	created_at REAL NOT NULL,
+	updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_ready ON tasks(status, priority DESC, available_at);
+"""
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+FINAL_STATUSES = (DONE, FAILED)
+
+DEFAULT_LEASE = 60.0
+DEFAULT_MAX_ATTEMPTS = 3
+MAX_BACKOFF = 300.0
+
+# Limite dei parametri per query IN (...) di SQLite
+_IN_BATCH = 500
+
+
+def taskKey(kind: str, payload: Any) -> str:
+	raw = json.dumps([kind, payload], sort_keys=True, ensure_ascii=False, default=str)
+	return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+class TaskQueue:
+
+	def __init__(self, dbPath: str, journalMode: str = "WAL", retryDelay: float = 2.0):
+		self.dbPath = dbPath
+		self.journalMode = journalMode
+		self.retryDelay = retryDelay
+
+	def _db(self):
+		return open_database(self.dbPath, SCHEMA, journal_mode=self.journalMode)
+
+	def _write(self, fn):
+		db = self._db()
+		db.execute("BEGIN IMMEDIATE")
+		try:
+			result = fn(db)
+			db.execute("COMMIT")
+			return result
+		except Exception:
+			db.execute("ROLLBACK")
+			raise
+
+	# ------------------------------------------------------------------
+	# Produttori
+	# ------------------------------------------------------------------
+	def enqueue(self, kind: str, payload: Any, priority: int = 0,
+			maxAttempts: int = DEFAULT_MAX_ATTEMPTS) -> str:
+		return self.enqueueMany([{"kind": kind, "payload": payload, "priority": priority,
+			"max_attempts": maxAttempts}])[0]
+
+	def enqueueMany(self, tasks: Iterable[Dict[str, Any]]) -> List[str]:
+		"""Accoda in una transazione; restituisce gli ID nello stesso ordine.
+
+		Un task già presente non viene duplicato: se era fallito torna in coda
+		con i tentativi azzerati, altrimenti resta com'è (in corso o concluso).
+		"""
+		now = time.time()
+		rows = []
+		for task in tasks:
+			taskId = taskKey(task["kind"], task["payload"])
+			rows.append((taskId, task["kind"], json.dumps(task["payload"], ensure_ascii=False),
+				task.get("priority", 0), task.get("max_attempts", DEFAULT_MAX_ATTEMPTS)))
+
+		def insert(db):
+			db.executemany(
+				"INSERT INTO tasks (id, kind, payload, priority, status, max_attempts, available_at, "
+				"created_at, updated_at) VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?) "
+				"ON CONFLICT(id) DO UPDATE SET status = 'queued', attempts = 0, error = NULL, "
+				"available_at = excluded.available_at, updated_at = excluded.updated_at "
+				"WHERE tasks.status = 'failed'",
+				[(taskId, kind, payload, priority, maxAttempts, now, now, now)
+					for taskId, kind, payload, priority, maxAttempts in rows]
+			)
+
+		self._write(insert)
+		return [row[0] for row in rows]
+
+	# ------------------------------------------------------------------
+	# Worker
+	# ------------------------------------------------------------------
+	def lease(self, workerId: str, kinds: Optional[Iterable[str]] = None,
+			leaseSeconds: float = DEFAULT_LEASE) -> Optional[Dict[str, Any]]:
+		"""Prende il task pronto con priorità più alta, None se la coda è vuota"""
+		kinds = list(kinds or [])
+
+		def take(db):
+			now = time.time()
+			self._reclaimExpired(db, now)
+			query = "SELECT id, kind, payload, attempts FROM tasks WHERE status = 'queued' AND available_at <= ?"
+			params: List[Any] = [now]
+			if kinds:
+				query += f" AND kind IN ({', '.join('?' * len(kinds))})"
+				params.extend(kinds)
+			row = db.execute(query + " ORDER BY priority DESC, available_at LIMIT 1", params).fetchone()
+			if row is None:
+				return None
+			db.execute(
+				"UPDATE tasks SET status = 'leased', lease_owner = ?, lease_expires = ?, "
+				"attempts = attempts + 1, updated_at = ? WHERE id = ?",
+				(workerId, now + leaseSeconds, now, row["id"])
+			)
+			return {"id": row["id"], "kind": row["kind"], "payload": json.loads(row["payload"]),
+				"attempt": row["attempts"] + 1}
+
+		return self._write(take)
+
+	def _reclaimExpired(self, db, now: float) -> None:
+		# Lease scaduto: il worker è morto o bloccato, il task torna disponibile
+		db.execute(
+			"UPDATE tasks SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END, "
+			"error = 'lease scaduto (' || COALESCE(lease_owner, '?') || ')', lease_owner = NULL, "
+			"lease_expires = NULL, available_at = ?, updated_at = ? "
+			"WHERE status = 'leased' AND lease_expires < ?",
+			(now, now, now)
+		)
+
+	def heartbeat(self, taskId: str, workerId: str, leaseSeconds: float = DEFAULT_LEASE) -> bool:
+		"""Rinnova il lease; False se è scaduto e il task è passato ad altri"""
+		now = time.time()
+		cursor = self._db().execute(
+			"UPDATE tasks SET lease_expires = ?, updated_at = ? "
+			"WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+			(now + leaseSeconds, now, taskId, workerId)
+		)
+		return cursor.rowcount == 1
+
+	def complete(self, taskId: str, workerId: str) -> bool:
+		"""Segna il task concluso (il risultato è già nella cache condivisa)"""
+		cursor = self._db().execute(
+			"UPDATE tasks SET status = 'done', error = NULL, lease_owner = NULL, lease_expires = NULL, "
+			"updated_at = ? WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+			(time.time(), taskId, workerId)
+		)
+		return cursor.rowcount == 1
+
+	def fail(self, taskId: str, workerId: str, error: str, retryable: bool = True) -> Optional[str]:
+		"""Registra un errore; il task torna in coda con backoff o diventa "failed".
+
+		Restituisce il nuovo stato, None se il lease non era più di questo worker.
+		"""
+		def update(db):
+			row = db.execute(
+				"SELECT attempts, max_attempts FROM tasks WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+				(taskId, workerId)
+			).fetchone()
+			if row is None:
+				return None
+			now = time.time()
+			status = QUEUED if retryable and row["attempts"] < row["max_attempts"] else FAILED
+			delay = min(self.retryDelay * 2 ** (row["attempts"] - 1), MAX_BACKOFF)
+			db.execute(
+				"UPDATE tasks SET status = ?, error = ?, lease_owner = NULL, lease_expires = NULL, "
+				"available_at = ?, updated_at = ? WHERE id = ?",
+				(status, error[:2000], now + delay, now, taskId)
+			)
+			return status
+
+		return self._write(update)
+
+	# ------------------------------------------------------------------
+	# Stato
+	# ------------------------------------------------------------------
+	def statuses(self, taskIds: List[str]) -> Dict[str, Dict[str, Any]]:
+		db = self._db()
+		found = {}
+		for i in range(0, len(taskIds), _IN_BATCH):
+			part = taskIds[i:i + _IN_BATCH]
+			rows = db.execute(
+				f"SELECT id, status, attempts, error FROM tasks WHERE id IN ({', '.join('?' * len(part))})", part)
+			found.update({r["id"]: {"status": r["status"], "attempts": r["attempts"], "error": r["error"]}
+				for r in rows})
+		return found
+
+	def counts(self) -> Dict[str, Dict[str, int]]:
+		rows = self._db().execute("SELECT kind, status, COUNT(*) AS n FROM tasks GROUP BY kind, status")
+		counts: Dict[str, Dict[str, int]] = {}
+		for r in rows:
+			counts.setdefault(r["kind"], {})[r["status"]] = r["n"]
+		return counts
+
+	def prune(self, maxAgeSeconds: float) -> int:
+		"""Elimina i task conclusi o falliti non toccati da ``maxAgeSeconds``"""
+		cursor = self._db().execute(
+			"DELETE FROM tasks WHERE status IN ('done', 'failed') AND updated_at < ?",
+			(time.time() - maxAgeSeconds,)
+		)
+		return cursor.rowcount
@@ -0,0 +1,229 @@
+import os
+import re
+import json
+import uuid
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, Optional, BinaryIO
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# Blocchi letti dallo stream della richiesta: la memoria resta costante
+READ_BLOCK = 1024 * 1024
+DEFAULT_MAX_SIZE = 5 * 1024 * 1024 * 1024
+
+_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+
+class UploadError(Exception):
+
+	def __init__(self, message: str, status: int = 400):
+		super().__init__(message)
+		self.status = status
+
+
+# Upload ripristinabili: ogni sessione scrive in <root>/sessions/<id>.part e
+# calcola lo SHA-256 man mano che arrivano i blocchi. A upload completo il
+# file diventa <root>/blobs/<sha256>: un contenuto già visto non viene
+# salvato (né estratto) una seconda volta.
+#
+# I byte si ricevono sempre: lo sha256 dichiarato all'apertura serve solo a
+# verificare il file. Dedurre il contenuto dal solo hash permetterebbe a chi
+# conosce l'hash di ottenere il documento di qualcun altro.
+class UploadStore:
+
+	def __init__(self, rootDir: str, maxSize: int = DEFAULT_MAX_SIZE):
+		self.root = Path(rootDir)
+		self.sessions = self.root / "sessions"
+		self.blobs = self.root / "blobs"
+		self.sessions.mkdir(parents=True, exist_ok=True)
+		self.blobs.mkdir(parents=True, exist_ok=True)
+		self.maxSize = maxSize
+		# Stato dell'hash per sessione in questo processo: (offset, hasher)
+		self._hashers: Dict[str, tuple] = {}
+		self._threadLocks: Dict[str, threading.Lock] = {}
+		self._lock = threading.Lock()
+
+	# ------------------------------------------------------------------
+	# Sessioni
+	# ------------------------------------------------------------------
+	def createSession(self, filename: str, size: int, sha256: Optional[str] = None) -> Dict:
+		if not filename:
+			raise UploadError("Nome file mancante")
+		if size < 0 or size > self.maxSize:
+			raise UploadError(f"Dimensione non valida: {size} (massimo {self.maxSize} byte)", 413)
+		if sha256 is not None:
+			sha256 = sha256.lower()
+			if not _SHA256.match(sha256):
+				raise UploadError("sha256 non valido")
+
+		session = {
+			"upload_id": uuid.uuid4().hex,
+			"filename": filename,
+			"size": size,
+			"offset": 0,
+			"expected_sha256": sha256,
+			"sha256": None,
+			"status": "uploading",
+			"duplicate": False,
+		}
+
+		self._partPath(session["upload_id"]).touch()
+		self._saveSession(session)
+		return session
+
+	def getSession(self, uploadId: str) -> Dict:
+		path = self._sessionPath(uploadId)
+		try:
+			with open(path, "r", encoding="utf-8") as f:
+				return json.load(f)
+		except FileNotFoundError:
+			raise UploadError("Upload non trovato", 404)
+
+	def writeChunk(self, uploadId: str, offset: int, stream: BinaryIO) -> Dict:
+		"""Accoda i byte dello stream a partire da ``offset`` (deve coincidere con quello salvato)"""
+		with self._sessionLock(uploadId):
+			session = self.getSession(uploadId)
+			if session["status"] == "complete":
+				return session
+			if offset != session["offset"]:
+				raise UploadError(f"Offset {offset} non valido, atteso {session['offset']}", 409)
+
+			part = self._partPath(uploadId)
+			hasher = self._hasherAt(uploadId, part, offset)
+			written = offset
+			with open(part, "r+b") as f:
+				# Byte oltre l'offset salvato sono residui di una richiesta interrotta
+				f.seek(offset)
+				f.truncate()
+				while True:
+					block = stream.read(READ_BLOCK)
+					if not block:
+						break
+					written += len(block)
+					if written > session["size"]:
+						raise UploadError("Dati oltre la dimensione dichiarata", 413)
+					f.write(block)
+					hasher.update(block)
+				f.flush()
+				os.fsync(f.fileno())
+
+			session["offset"] = written
+			self._hashers[uploadId] = (written, hasher)
+			if written == session["size"]:
+				self._finalize(session, hasher.hexdigest())
+			self._saveSession(session)
+			return session
+
+	def _finalize(self, session: Dict, digest: str) -> None:
+		uploadId = session["upload_id"]
+		expected = session.get("expected_sha256")
+		if expected and expected != digest:
+			# Il file è corrotto: si riparte da zero invece di conservarlo
+			self._partPath(uploadId).write_bytes(b"")
+			session["offset"] = 0
+			self._hashers.pop(uploadId, None)
+			self._saveSession(session)
+			raise UploadError(f"Hash non corrispondente: atteso {expected}, ricevuto {digest}", 422)
+
+		part = self._partPath(uploadId)
+		if self.hasBlob(digest):
+			part.unlink()
+			session["duplicate"] = True
+		else:
+			os.replace(part, self.blobPath(digest))
+		self._hashers.pop(uploadId, None)
+		session.update(sha256=digest, status="complete")
+
+	def _hasherAt(self, uploadId: str, part: Path, offset: int):
+		cached = self._hashers.get(uploadId)
+		if cached and cached[0] == offset:
+			# Copia: se la scrittura fallisce a metà lo stato in cache resta valido
+			return cached[1].copy()
+		# Ripresa dopo un riavvio o su un altro worker: si rilegge la parte già scritta
+		hasher = hashlib.sha256()
+		remaining = offset
+		with open(part, "rb") as f:
+			while remaining > 0:
+				block = f.read(min(READ_BLOCK, remaining))
+				if not block:
+					raise UploadError("File parziale più corto dell'offset salvato", 409)
+				hasher.update(block)
+				remaining -= len(block)
+		return hasher
+
+	# ------------------------------------------------------------------
+	# Contenuti
+	# ------------------------------------------------------------------
+	def blobPath(self, sha256: str) -> Path:
+		if not _SHA256.match(sha256 or ""):
+			raise UploadError("sha256 non valido")
+		return self.blobs / sha256
+
+	def hasBlob(self, sha256: str) -> bool:
+		return self.blobPath(sha256).exists()
+
+	def getIngested(self, sha256: str) -> Optional[Dict]:
+		"""Documento dell'ingest già prodotto per questo contenuto, se esiste"""
+		try:
+			with open(self.blobPath(sha256).with_suffix(".ingest.json"), "r", encoding="utf-8") as f:
+				return json.load(f)
+		except (FileNotFoundError, json.JSONDecodeError):
+			return None
+
+	def saveIngested(self, sha256: str, document: Dict) -> None:
+		self._atomicJson(self.blobPath(sha256).with_suffix(".ingest.json"), document)
+
+	# ------------------------------------------------------------------
+	# File system
+	# ------------------------------------------------------------------
+	def _sessionPath(self, uploadId: str) -> Path:
+		if not _UPLOAD_ID.match(uploadId or ""):
+			raise UploadError("ID upload non valido")
+		return self.sessions / f"{uploadId}.json"
+
+	def _partPath(self, uploadId: str) -> Path:
+		return self._sessionPath(uploadId).with_suffix(".part")
+
+	def _saveSession(self, session: Dict) -> None:
+		self._atomicJson(self._sessionPath(session["upload_id"]), session)
+
+	@staticmethod
+	def _atomicJson(path: Path, data: Dict) -> None:
+		tmp = path.with_name(path.name + ".tmp")
+		with open(tmp, "w", encoding="utf-8") as f:
+			json.dump(data, f, indent=2, ensure_ascii=False)
+		os.replace(tmp, path)
+
+	def _sessionLock(self, uploadId: str):
+		with self._lock:
+			threadLock = self._threadLocks.setdefault(uploadId, threading.Lock())
+		return _FileLock(self._sessionPath(uploadId).with_suffix(".lock"), threadLock)
+
+
+class _FileLock:
+	"""Lock esclusivo tra thread e, dove c'è fcntl, tra processi"""
+
+	def __init__(self, path: Path, threadLock: threading.Lock):
+		self.path = path
+		self.threadLock = threadLock
+		self.handle = None
+
+	def __enter__(self):
+		self.threadLock.acquire()
+		if fcntl is not None:
+			self.handle = open(self.path, "a")
+			fcntl.flock(self.handle, fcntl.LOCK_EX)
+		return self
+
+	def __exit__(self, *exc):
+		if self.handle is not None:
+			fcntl.flock(self.handle, fcntl.LOCK_UN)
+			self.handle.close()
+			self.handle = None
+		self.threadLock.release()
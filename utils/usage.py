@@ -0,0 +1,317 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from formatting.storing import open_database
+
+# Registro di token, costi e latenze delle chiamate al modello.
+#
+# Un UsageLedger accompagna un job: ogni chiamata (map, reduce, accumulation,
+# embedding, risposta) vi registra modello, token di prompt, di output e in
+# cache, latenza e documento di provenienza. Il rapporto aggregato per fase,
+# documento e modello finisce nel risultato del job; le singole chiamate
+# vengono salvate in UsageStore per i report (tipi di file, keywords, tenant).
+#
+# Come priorità e annullamento (vedi scheduler.py e cancellation.py) il
+# registro corrente e il documento in lavorazione viaggiano in ContextVar.
+#
+# Con un budget (token o dollari) il registro annulla il job alla prima
+# chiamata che lo supera: le chiamate già partite arrivano in fondo e si
+# contano, quelle in attesa non partono.
+
+# Prezzi in dollari per milione di token: (input, input in cache, output).
+# Si confrontano per prefisso, quindi valgono anche per le versioni datate
+# (gpt-4o-2024-08-06). Sovrascrivibili con SUMMY_MODEL_PRICES, es.
+# '{"gpt-4o": [2.5, 1.25, 10]}'.
+MODEL_PRICES: Dict[str, Tuple[float, float, float]] = {
+	"gpt-4o-mini": (0.15, 0.075, 0.60),
+	"gpt-4o": (2.50, 1.25, 10.00),
+	"gpt-4.1-nano": (0.10, 0.025, 0.40),
+	"gpt-4.1-mini": (0.40, 0.10, 1.60),
+	"gpt-4.1": (2.00, 0.50, 8.00),
+	"text-embedding-3-small": (0.02, 0.02, 0.0),
+	"text-embedding-3-large": (0.13, 0.13, 0.0),
+}
+# La Batch API costa la metà
+BATCH_DISCOUNT = 0.5
+
+
+def _loadPrices() -> Dict[str, Tuple[float, float, float]]:
+	prices = dict(MODEL_PRICES)
+	override = os.getenv("SUMMY_MODEL_PRICES")
+	if override:
+		try:
+			prices.update({model: tuple(float(p) for p in values) for model, values in json.loads(override).items()})
+		except (ValueError, TypeError, AttributeError) as e:
+			print(f"Error: SUMMY_MODEL_PRICES non valido, uso i prezzi predefiniti: {e}")
+	return prices
+
+_prices = _loadPrices()
+
+def modelPrice(model: Optional[str]) -> Optional[Tuple[float, float, float]]:
+	if not model:
+		return None
+	# Prefisso più lungo: "gpt-4o-mini" prima di "gpt-4o"
+	for name in sorted(_prices, key=len, reverse=True):
+		if model.startswith(name):
+			return _prices[name]
+	return None
+
+def callCost(model: Optional[str], promptTokens: int, completionTokens: int, cachedTokens: int = 0,
+		batch: bool = False) -> Optional[float]:
+	"""Costo in dollari di una chiamata; None per un modello senza prezzo"""
+	price = modelPrice(model)
+	if price is None:
+		return None
+	inputPrice, cachedPrice, outputPrice = price
+	cost = ((promptTokens - cachedTokens) * inputPrice + cachedTokens * cachedPrice
+		+ completionTokens * outputPrice) / 1_000_000
+	return cost * BATCH_DISCOUNT if batch else cost
+
+
+def _field(obj: Any, name: str) -> Any:
+	# Campo usage di un oggetto della libreria openai o di un dict (output della Batch API)
+	if isinstance(obj, dict):
+		return obj.get(name)
+	return getattr(obj, name, None)
+
+def usageTokens(usage: Any) -> Tuple[int, int, int]:
+	"""(prompt, completion, cached) dal campo usage di una risposta"""
+	details = _field(usage, "prompt_tokens_details")
+	cached = _field(details, "cached_tokens") if details is not None else 0
+	return (_field(usage, "prompt_tokens") or 0, _field(usage, "completion_tokens") or 0, cached or 0)
+
+
+def _emptyTotals() -> Dict[str, Any]:
+	return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+		"cost_usd": 0.0, "seconds": 0.0}
+
+
+class UsageLedger:
+	"""Chiamate al modello di un job, con budget facoltativo"""
+
+	def __init__(self, jobId: Optional[str] = None, maxTokens: Optional[int] = None,
+			maxCost: Optional[float] = None, cancelToken=None):
+		self.jobId = jobId
+		self.maxTokens = maxTokens or None
+		self.maxCost = maxCost or None
+		self.cancelToken = cancelToken
+		self.calls: List[Dict[str, Any]] = []
+		self.exceeded: Optional[str] = None
+		self.unpriced: set = set()
+		self._totals = _emptyTotals()
+		self._lock = threading.Lock()
+
+	def record(self, stage: str, model: Optional[str], usage: Any, seconds: Optional[float] = None,
+			document: Optional[Tuple[str, str]] = None, batch: bool = False) -> None:
+		"""Registra una chiamata; ``document`` è (nome file, tipo), di default quello corrente"""
+		prompt, completion, cached = usageTokens(usage)
+		cost = callCost(model, prompt, completion, cached, batch)
+		filename, docType = document or currentDocument() or (None, None)
+		call = {"stage": stage, "model": model, "document": filename, "doc_type": docType,
+			"prompt_tokens": prompt, "completion_tokens": completion, "cached_tokens": cached,
+			"seconds": round(seconds, 4) if seconds is not None else None,
+			"cost_usd": cost, "batch": batch, "at": time.time()}
+		with self._lock:
+			self.calls.append(call)
+			totals = self._totals
+			totals["calls"] += 1
+			totals["prompt_tokens"] += prompt
+			totals["completion_tokens"] += completion
+			totals["cached_tokens"] += cached
+			totals["cost_usd"] += cost or 0.0
+			totals["seconds"] += seconds or 0.0
+			if cost is None:
+				self.unpriced.add(model)
+			exceeded = self._checkBudget() if self.exceeded is None else None
+			if exceeded:
+				self.exceeded = exceeded
+		if exceeded:
+			print(f"Budget del job {self.jobId or ''} superato: {exceeded}")
+			if self.cancelToken is not None:
+				self.cancelToken.cancel("budget")
+
+	def _checkBudget(self) -> Optional[str]:
+		tokens = self._totals["prompt_tokens"] + self._totals["completion_tokens"]
+		if self.maxTokens is not None and tokens > self.maxTokens:
+			return f"{tokens} token su {self.maxTokens}"
+		if self.maxCost is not None and self._totals["cost_usd"] > self.maxCost:
+			return f"{self._totals['cost_usd']:.4f}$ su {self.maxCost}$"
+		return None
+
+	def report(self) -> Dict[str, Any]:
+		"""Totali del job e ripartizione per fase, documento e modello"""
+		with self._lock:
+			calls = list(self.calls)
+		groups: Dict[str, Dict[str, Dict[str, Any]]] = {"by_stage": {}, "by_document": {}, "by_model": {}}
+		for call in calls:
+			for group, key in (("by_stage", call["stage"]), ("by_document", call["document"]),
+					("by_model", call["model"])):
+				if key is None:
+					continue
+				totals = groups[group].setdefault(key, _emptyTotals())
+				totals["calls"] += 1
+				for field in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+					totals[field] += call[field]
+				totals["cost_usd"] += call["cost_usd"] or 0.0
+				totals["seconds"] += call["seconds"] or 0.0
+		report = {"job_id": self.jobId, "totals": _rounded(dict(self._totals)),
+			**{group: {key: _rounded(t) for key, t in values.items()} for group, values in groups.items()}}
+		if self.maxTokens is not None or self.maxCost is not None:
+			report["budget"] = {"max_tokens": self.maxTokens, "max_cost_usd": self.maxCost,
+				"exceeded": self.exceeded}
+		if self.unpriced:
+			# Il costo di questi modelli non è nei totali (manca il prezzo)
+			report["unpriced_models"] = sorted(str(m) for m in self.unpriced)
+		return report
+
+def _rounded(totals: Dict[str, Any]) -> Dict[str, Any]:
+	return {**totals, "cost_usd": round(totals["cost_usd"], 6), "seconds": round(totals["seconds"], 3)}
+
+
+_currentLedger: contextvars.ContextVar = contextvars.ContextVar("summyUsageLedger", default=None)
+_currentDocument: contextvars.ContextVar = contextvars.ContextVar("summyUsageDocument", default=None)
+
+@contextmanager
+def usageScope(ledger: Optional[UsageLedger]):
+	"""Le chiamate al modello nel blocco finiscono in ``ledger``"""
+	reset = _currentLedger.set(ledger)
+	try:
+		yield ledger
+	finally:
+		_currentLedger.reset(reset)
+
+def currentLedger() -> Optional[UsageLedger]:
+	return _currentLedger.get()
+
+@contextmanager
+def usageDocument(filename: str, docType: Optional[str] = None):
+	"""Attribuisce al documento le chiamate fatte nel blocco (e nei task creati lì)"""
+	reset = _currentDocument.set((filename, docType))
+	try:
+		yield
+	finally:
+		_currentDocument.reset(reset)
+
+def currentDocument() -> Optional[Tuple[str, Optional[str]]]:
+	return _currentDocument.get()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_jobs (
+	job_id TEXT PRIMARY KEY,
+	created_at REAL NOT NULL,
+	status TEXT,
+	priority TEXT,
+	tenant TEXT,
+	keywords TEXT,
+	calls INTEGER NOT NULL,
+	prompt_tokens INTEGER NOT NULL,
+	completion_tokens INTEGER NOT NULL,
+	cached_tokens INTEGER NOT NULL,
+	cost_usd REAL NOT NULL,
+	seconds REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usage_calls (
+	job_id TEXT NOT NULL,
+	at REAL NOT NULL,
+	stage TEXT NOT NULL,
+	model TEXT,
+	document TEXT,
+	doc_type TEXT,
+	prompt_tokens INTEGER NOT NULL,
+	completion_tokens INTEGER NOT NULL,
+	cached_tokens INTEGER NOT NULL,
+	seconds REAL,
+	cost_usd REAL,
+	batch INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_usage_calls_job ON usage_calls(job_id);
+CREATE INDEX IF NOT EXISTS idx_usage_calls_at ON usage_calls(at);
+CREATE INDEX IF NOT EXISTS idx_usage_jobs_created ON usage_jobs(created_at);
+"""
+
+# Raggruppamenti ammessi nei report: colonna di usage_calls o di usage_jobs
+_GROUPS = {
+	"stage": "c.stage",
+	"model": "c.model",
+	"doc_type": "c.doc_type",
+	"document": "c.document",
+	"keywords": "j.keywords",
+	"tenant": "j.tenant",
+	"priority": "j.priority",
+	"day": "date(c.at, 'unixepoch')",
+}
+
+
+class UsageStore:
+	"""Archivio SQLite dei registri dei job, per i report di costo"""
+
+	def __init__(self, dbPath: str):
+		self.dbPath = dbPath
+
+	def _db(self):
+		return open_database(self.dbPath, SCHEMA)
+
+	def save(self, ledger: UsageLedger, status: Optional[str] = None, priority: Optional[str] = None,
+			tenant: Optional[str] = None, keywords: Optional[List[str]] = None) -> None:
+		report = ledger.report()
+		totals = report["totals"]
+		with ledger._lock:
+			calls = list(ledger.calls)
+		db = self._db()
+		db.execute("BEGIN IMMEDIATE")
+		try:
+			# Un job rilanciato con lo stesso ID sostituisce il registro precedente
+			db.execute("DELETE FROM usage_calls WHERE job_id = ?", (ledger.jobId,))
+			db.execute(
+				"INSERT OR REPLACE INTO usage_jobs (job_id, created_at, status, priority, tenant, keywords, calls, "
+				"prompt_tokens, completion_tokens, cached_tokens, cost_usd, seconds) "
+				"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				(ledger.jobId, time.time(), status, priority, tenant,
+					",".join(sorted(k.lower() for k in keywords or [])),
+					totals["calls"], totals["prompt_tokens"], totals["completion_tokens"],
+					totals["cached_tokens"], totals["cost_usd"], totals["seconds"])
+			)
+			db.executemany(
+				"INSERT INTO usage_calls (job_id, at, stage, model, document, doc_type, prompt_tokens, "
+				"completion_tokens, cached_tokens, seconds, cost_usd, batch) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				[(ledger.jobId, c["at"], c["stage"], c["model"], c["document"], c["doc_type"], c["prompt_tokens"],
+					c["completion_tokens"], c["cached_tokens"], c["seconds"], c["cost_usd"], int(c["batch"]))
+					for c in calls]
+			)
+			db.execute("COMMIT")
+		except Exception:
+			db.execute("ROLLBACK")
+			raise
+
+	def summary(self, groupBy: str = "stage", since: Optional[float] = None,
+			until: Optional[float] = None) -> List[Dict[str, Any]]:
+		"""Token, costo e latenza aggregati per ``groupBy``, dal più costoso"""
+		if groupBy not in _GROUPS:
+			raise ValueError(f"Raggruppamento non valido: {groupBy} (ammessi: {', '.join(_GROUPS)})")
+		column = _GROUPS[groupBy]
+		query = (
+			f"SELECT {column} AS grp, COUNT(*) AS calls, COUNT(DISTINCT c.job_id) AS jobs, "
+			"SUM(c.prompt_tokens) AS prompt_tokens, SUM(c.completion_tokens) AS completion_tokens, "
+			"SUM(c.cached_tokens) AS cached_tokens, SUM(COALESCE(c.cost_usd, 0)) AS cost_usd, "
+			"AVG(c.seconds) AS avg_seconds "
+			"FROM usage_calls c JOIN usage_jobs j ON j.job_id = c.job_id WHERE 1 = 1"
+		)
+		params: List[Any] = []
+		if since is not None:
+			query += " AND c.at >= ?"
+			params.append(since)
+		if until is not None:
+			query += " AND c.at < ?"
+			params.append(until)
+		rows = self._db().execute(query + " GROUP BY grp ORDER BY cost_usd DESC", params)
+		return [{groupBy: r["grp"], "calls": r["calls"], "jobs": r["jobs"],
+			"prompt_tokens": r["prompt_tokens"], "completion_tokens": r["completion_tokens"],
+			"cached_tokens": r["cached_tokens"], "cost_usd": round(r["cost_usd"], 6),
+			"avg_seconds": round(r["avg_seconds"], 3) if r["avg_seconds"] is not None else None}
+			for r in rows]
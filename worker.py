@@ -0,0 +1,436 @@
+"""worker.py – Worker distribuiti su coda e cache condivise
+-----------------------------------------------------------------------
+Più macchine che vedono lo stesso filesystem si dividono ingest e
+riassunto. Ogni fase della pipeline è un task della coda condivisa
+(utils/taskQueue.py):
+
+- ``extract``: estrazione di un file (``extractDocument``);
+- ``map``: riassunto di un chunk;
+- ``reduce``: unione dei chunk di un documento;
+- ``accumulate``: accumulation finale dei riassunti.
+
+``serve`` avvia un worker: prende task in lease, li rinnova con un
+heartbeat mentre lavora e pubblica il risultato nella cache condivisa
+(utils/sharedCache.py) sotto l'ID del task. Un worker che muore perde il
+lease e il task passa a un altro; un errore viene ritentato con backoff.
+
+``submit`` è il coordinatore di un lavoro: accoda l'estrazione dei file e,
+man mano che i risultati arrivano, i map di ogni documento, il suo reduce
+e infine l'accumulation. Costa poca CPU e può girare su qualsiasi nodo; gli
+ID dei task derivano dal contenuto, quindi rilanciarlo dopo un'interruzione
+riusa tutto ciò che è già in cache.
+
+Layout di ``--shared``: ``queue.sqlite`` e ``cache/``. I file di input
+devono avere lo stesso percorso assoluto su tutti i nodi.
+
+Uso:
+    python worker.py serve --shared /mnt/share/summy [--slots 8] [--extract-slots 1]
+        [--kinds extract,map,reduce,accumulate] [--exit-when-idle]
+    python worker.py submit <cartella> --shared /mnt/share/summy --output <cartella_output>
+        [--keywords costi,emissioni] [--accumulate]
+    python worker.py status --shared /mnt/share/summy
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT / "summarize"))
+sys.path.insert(0, str(ROOT / "formatting"))
+sys.path.insert(0, str(ROOT))
+
+from cli import iter_files, _init_worker, _extract_file  # noqa: E402
+from formatting.summary_index import summary_id  # noqa: E402
+from utils.ingestHelper import getFileHash  # noqa: E402
+from utils.metrics import QUEUE_TASKS  # noqa: E402
+from utils.sharedCache import SharedCache  # noqa: E402
+from utils.taskQueue import TaskQueue, DONE, FINAL_STATUSES  # noqa: E402
+
+KINDS = ("extract", "map", "reduce", "accumulate")
+# Le fasi finali hanno la precedenza: i job già avviati si chiudono prima
+# che ne partano di nuovi, e i risultati arrivano prima all'utente
+PRIORITY = {"extract": 0, "map": 1, "reduce": 2, "accumulate": 3}
+
+
+def open_shared(shared: Path, journal_mode: str):
+    shared.mkdir(parents=True, exist_ok=True)
+    return TaskQueue(str(shared / "queue.sqlite"), journalMode=journal_mode), SharedCache(str(shared / "cache"))
+
+
+def _task(kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    return {"kind": kind, "payload": payload, "priority": PRIORITY[kind]}
+
+
+# ---------------------------------------------------------------------------
+# Worker
+# ---------------------------------------------------------------------------
+class Worker:
+    """Esegue i task della coda finché non riceve SIGINT/SIGTERM"""
+
+    def __init__(self, queue: TaskQueue, cache: SharedCache, args):
+        self.queue = queue
+        self.cache = cache
+        self.args = args
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.kinds = [k for k in args.kinds.split(",") if k]
+        self.stopping = asyncio.Event()
+        self.running: Dict[str, asyncio.Task] = {}
+        self.extracting = 0
+        self._chunkers: Dict[str, Any] = {}
+        self._client = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from chunker import get_client
+            self._client = get_client()
+        return self._client
+
+    def chunker(self, settings: Dict[str, Any], keywords: List[str]):
+        """Un Chunker per configurazione e keywords (le keywords sono stato dell'istanza)"""
+        from chunker import Chunker, ChunkerConfig
+
+        key = json.dumps([settings, keywords], sort_keys=True)
+        if key not in self._chunkers:
+            if len(self._chunkers) >= 16:
+                self._chunkers.pop(next(iter(self._chunkers)))
+            chunker = Chunker(ChunkerConfig(**settings), client=self.client)
+            chunker.set_keywords(keywords)
+            self._chunkers[key] = chunker
+        return self._chunkers[key]
+
+    # -- Handler ----------------------------------------------------------
+    async def handle_extract(self, payload):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.args.extract_slots, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker, initargs=(str(Path(self.args.config).resolve()), False))
+        out = await asyncio.get_running_loop().run_in_executor(
+            self._pool, _extract_file, payload["path"], payload["name"])
+        if out.get("error"):
+            raise RuntimeError(out["error"])
+        return {"document": out["document"]}
+
+    # Map e reduce sollevano se il Chunker ha ripiegato sul testo grezzo: un
+    # fallback finirebbe in cache per sempre, un errore passa da TaskQueue.fail
+    # e viene ritentato. Il ripiego resta al coordinatore (Submission.on_map).
+    async def handle_map(self, payload):
+        from chunker import Chunk
+
+        chunker = self.chunker(payload["settings"], payload["keywords"])
+        chunk = Chunk(**payload["chunk"])
+        value = await chunker.map_chunk(payload["doc"], chunk, payload["total_chunks"])
+        if value.get("fallback"):
+            raise RuntimeError(f"map del chunk {chunk.idx} senza una risposta valida del modello")
+        return value
+
+    async def handle_reduce(self, payload):
+        chunker = self.chunker(payload["settings"], payload["keywords"])
+        value = await chunker.reduce_partials(payload["doc"], payload["partials"])
+        if value.get("fallback"):
+            raise RuntimeError("reduce senza una risposta valida del modello")
+        return value
+
+    async def handle_accumulate(self, payload):
+        from formatting.accumulation import accumulation_async
+
+        result = await accumulation_async(payload["summaries"], payload["keywords"], client=self.client)
+        if not isinstance(result, dict) or "error" in result:
+            raise RuntimeError(f"accumulation fallita: {result}")
+        return result
+
+    # -- Ciclo ------------------------------------------------------------
+    async def run_task(self, task: Dict[str, Any]) -> None:
+        task_id, kind = task["id"], task["kind"]
+        if self.cache.has(task_id):
+            # Già calcolato da un altro nodo (es. lease scaduto mentre finiva)
+            await asyncio.to_thread(self.queue.complete, task_id, self.worker_id)
+            QUEUE_TASKS.inc(kind=kind, status="cached")
+            return
+
+        work = asyncio.ensure_future(getattr(self, f"handle_{kind}")(task["payload"]))
+        heartbeat = asyncio.ensure_future(self._heartbeat(task_id, work))
+        try:
+            value = await work
+            await asyncio.to_thread(self.cache.put, task_id, value)
+            await asyncio.to_thread(self.queue.complete, task_id, self.worker_id)
+            QUEUE_TASKS.inc(kind=kind, status="done")
+        except asyncio.CancelledError:
+            print(f"[{self.worker_id}] lease perso: {kind} {task_id}", file=sys.stderr)
+            QUEUE_TASKS.inc(kind=kind, status="lost")
+        except Exception as e:
+            status = await asyncio.to_thread(self.queue.fail, task_id, self.worker_id,
+                                             f"{type(e).__name__}: {e}")
+            print(f"[{self.worker_id}] {kind} {task_id} fallito (tentativo {task['attempt']}): {e}",
+                  file=sys.stderr)
+            QUEUE_TASKS.inc(kind=kind, status=status or "lost")
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, task_id: str, work: asyncio.Future) -> None:
+        while not work.done():
+            await asyncio.sleep(self.args.lease / 3)
+            if not await asyncio.to_thread(self.queue.heartbeat, task_id, self.worker_id, self.args.lease):
+                # Il task è passato a un altro worker: inutile continuare a pagarlo
+                work.cancel()
+                return
+
+    def _leasable_kinds(self) -> List[str]:
+        if self.extracting >= self.args.extract_slots:
+            return [k for k in self.kinds if k != "extract"]
+        return self.kinds
+
+    async def serve(self) -> int:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        print(f"Worker {self.worker_id}: {', '.join(self.kinds)} ({self.args.slots} slot)")
+
+        slots = asyncio.Semaphore(self.args.slots)
+        while not self.stopping.is_set():
+            await slots.acquire()
+            kinds = self._leasable_kinds()
+            task = await asyncio.to_thread(self.queue.lease, self.worker_id, kinds, self.args.lease) if kinds else None
+            if task is None:
+                slots.release()
+                if self.args.exit_when_idle and not self.running:
+                    break
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), self.args.poll)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if task["kind"] == "extract":
+                self.extracting += 1
+            running = asyncio.ensure_future(self.run_task(task))
+            self.running[task["id"]] = running
+            running.add_done_callback(lambda _, task=task: self._finished(task, slots))
+
+        # Arresto ordinato: i task in corso finiscono, nessuno nuovo viene preso
+        if self.running:
+            print(f"Attesa di {len(self.running)} task in corso...")
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+        if self._pool is not None:
+            self._pool.shutdown()
+        if self._client is not None:
+            await self._client.close()
+        return 0
+
+    def _finished(self, task: Dict[str, Any], slots: asyncio.Semaphore) -> None:
+        self.running.pop(task["id"], None)
+        if task["kind"] == "extract":
+            self.extracting -= 1
+        slots.release()
+
+
+# ---------------------------------------------------------------------------
+# Coordinatore
+# ---------------------------------------------------------------------------
+class Submission:
+    """Stato di un lavoro: quali task attende e cosa fare quando finiscono"""
+
+    def __init__(self, queue: TaskQueue, cache: SharedCache, chunker, keywords: List[str]):
+        self.queue = queue
+        self.cache = cache
+        self.chunker = chunker
+        self.keywords = keywords
+        self.settings = chunker.cfg.output_settings()
+        self.pending: Dict[str, List[tuple]] = {}
+        self.docs: Dict[str, Dict[str, Any]] = {}
+        self.summaries: Dict[str, Dict[str, Any]] = {}
+        self.errors: Dict[str, str] = {}
+
+    def _wait(self, tasks: List[Dict[str, Any]], refs: List[tuple]) -> None:
+        for task_id, ref in zip(self.queue.enqueueMany(tasks), refs):
+            self.pending.setdefault(task_id, []).append(ref)
+
+    def submit_files(self, input_dir: Path) -> int:
+        tasks, refs = [], []
+        for path in iter_files(input_dir):
+            name = path.relative_to(input_dir).as_posix()
+            tasks.append(_task("extract", {"path": str(path), "name": name, "hash": getFileHash(str(path))}))
+            refs.append(("extract", name))
+        self._wait(tasks, refs)
+        return len(tasks)
+
+    def on_extract(self, name: str, value: Optional[Dict[str, Any]], error: Optional[str]) -> None:
+        document = (value or {}).get("document")
+        if document is None:
+            self.errors[name] = error or "nessun contenuto estratto"
+            return
+        chunks, selected = self.chunker.plan_document(document)
+        meta = {**document, "content": ""}
+        state = self.docs[name] = {"document": document, "meta": meta, "total": len(chunks), "partials": {}}
+        tasks, refs = [], []
+        for ch in chunks:
+            if ch.idx in selected:
+                tasks.append(_task("map", {"doc": meta, "chunk": asdict(ch), "total_chunks": len(chunks),
+                                           "keywords": self.keywords, "settings": self.settings}))
+                refs.append(("map", name, ch))
+            else:
+                state["partials"][ch.idx] = self.chunker.extractive_chunk(document, ch, len(chunks))
+        self._wait(tasks, refs)
+        self._maybe_reduce(name)
+
+    def on_map(self, name: str, chunk, value: Optional[Dict[str, Any]]) -> None:
+        state = self.docs[name]
+        # Map fallito dopo tutti i tentativi: sintesi estrattiva locale
+        state["partials"][chunk.idx] = value or self.chunker.extractive_chunk(state["document"], chunk, state["total"])
+        self._maybe_reduce(name)
+
+    def _maybe_reduce(self, name: str) -> None:
+        state = self.docs[name]
+        if len(state["partials"]) < state["total"] or state.get("reducing"):
+            return
+        state["reducing"] = True
+        partials = [state["partials"][i] for i in sorted(state["partials"])]
+        self._wait([_task("reduce", {"doc": state["meta"], "partials": partials,
+                                     "keywords": self.keywords, "settings": self.settings})], [("reduce", name)])
+
+    def on_reduce(self, name: str, value: Optional[Dict[str, Any]], error: Optional[str]) -> None:
+        if value is None:
+            self.errors[name] = f"reduce: {error}"
+        else:
+            self.summaries[name] = value
+
+    def poll(self) -> None:
+        statuses = self.queue.statuses(list(self.pending))
+        for task_id, status in statuses.items():
+            if status["status"] not in FINAL_STATUSES:
+                continue
+            value = self.cache.get(task_id) if status["status"] == DONE else None
+            for ref in self.pending.pop(task_id):
+                if ref[0] == "extract":
+                    self.on_extract(ref[1], value, status["error"])
+                elif ref[0] == "map":
+                    self.on_map(ref[1], ref[2], value)
+                else:
+                    self.on_reduce(ref[1], value, status["error"])
+
+    def progress(self) -> str:
+        counts: Dict[str, int] = {}
+        for refs in self.pending.values():
+            for ref in refs:
+                counts[ref[0]] = counts.get(ref[0], 0) + 1
+        waiting = ", ".join(f"{k} {n}" for k, n in sorted(counts.items())) or "-"
+        return f"riassunti {len(self.summaries)} | errori {len(self.errors)} | in attesa: {waiting}"
+
+
+async def submit(args) -> int:
+    from chunker import Chunker, ChunkerConfig
+
+    queue, cache = open_shared(Path(args.shared), args.journal_mode)
+    input_dir = Path(args.input_dir).resolve()
+    output_dir = Path(args.output).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    keywords = [k.strip() for k in (args.keywords or "").split(",") if k.strip()]
+
+    # Il coordinatore fa solo chunking e pre-filtro: nessuna chiamata al modello
+    # I modelli viaggiano nelle impostazioni dei task: i worker usano quelli scelti qui
+    chunker = Chunker(ChunkerConfig(max_tokens=args.max_tokens, adaptive_chunking=True, handle_audio_video=True,
+                                    model_map=args.model_map, model_reduce=args.model_reduce,
+                                    model_escalation=args.model_escalation or None))
+    chunker.set_keywords(keywords)
+    job = Submission(queue, cache, chunker, keywords)
+    print(f"{job.submit_files(input_dir)} file accodati da {input_dir}")
+
+    last = ""
+    while job.pending:
+        await asyncio.sleep(args.poll)
+        job.poll()
+        report = job.progress()
+        if report != last:
+            print(report, flush=True)
+            last = report
+
+    settings = chunker.cfg.output_settings()
+    summaries_path = output_dir / "summaries.jsonl"
+    with open(summaries_path, "w", encoding="utf-8") as f:
+        for name in sorted(job.summaries):
+            sid = summary_id(job.docs[name]["document"], settings, keywords)
+            f.write(json.dumps({"path": name, "summary_id": sid, **job.summaries[name]}, ensure_ascii=False) + "\n")
+    print(f"Output: {summaries_path}")
+    for name, error in sorted(job.errors.items())[:10]:
+        print(f"  errore: {name}: {error}")
+
+    result = 0
+    if args.accumulate and job.summaries:
+        summaries = [{"filename": n, "content": job.summaries[n].get("content", "")} for n in sorted(job.summaries)]
+        task_id = queue.enqueue("accumulate", {"summaries": summaries, "keywords": keywords},
+                                priority=PRIORITY["accumulate"])
+        while (status := queue.statuses([task_id])[task_id])["status"] not in FINAL_STATUSES:
+            await asyncio.sleep(args.poll)
+        accumulated = cache.get(task_id) if status["status"] == DONE else {"error": status["error"]}
+        out = output_dir / "accumulated.json"
+        out.write_text(json.dumps(accumulated, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"Accumulation: {out}")
+        result = 0 if "error" not in accumulated else 1
+    return result if not job.errors else 1
+
+
+def status(args) -> int:
+    queue, _ = open_shared(Path(args.shared), args.journal_mode)
+    print(json.dumps(queue.counts(), indent=2))
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Worker distribuiti su coda e cache condivise")
+    parser.add_argument("--shared", required=True, help="cartella condivisa (coda e cache)")
+    parser.add_argument("--journal-mode", choices=["WAL", "DELETE"], default="WAL",
+                        help="DELETE se la cartella è su filesystem di rete usato da più macchine")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = sub.add_parser("serve", help="avvia un worker")
+    serve_parser.add_argument("--kinds", default=",".join(KINDS), help="tipi di task da eseguire")
+    serve_parser.add_argument("--slots", type=int, default=8, help="task in parallelo")
+    serve_parser.add_argument("--extract-slots", type=int, default=1, help="estrazioni in parallelo (processi)")
+    serve_parser.add_argument("--lease", type=float, default=120.0, help="durata del lease in secondi")
+    serve_parser.add_argument("--poll", type=float, default=1.0, help="attesa con coda vuota")
+    serve_parser.add_argument("--config", default=str(ROOT / "config.json"))
+    serve_parser.add_argument("--exit-when-idle", action="store_true", help="termina quando la coda è vuota")
+
+    submit_parser = sub.add_parser("submit", help="accoda una cartella e attende i riassunti")
+    submit_parser.add_argument("input_dir")
+    submit_parser.add_argument("--output", required=True, help="cartella di output (JSONL)")
+    submit_parser.add_argument("--keywords", help="keywords separate da virgola")
+    submit_parser.add_argument("--max-tokens", type=int, default=1024)
+    submit_parser.add_argument("--model-map", default="gpt-4o-mini", help="modello delle map (vedi summarize/routing.py)")
+    submit_parser.add_argument("--model-reduce", default="gpt-4o", help="modello di reduce, tabelle e chunk lunghi")
+    submit_parser.add_argument("--model-escalation", default="gpt-4o",
+                               help="modello per le risposte non valide ('' per disattivare)")
+    submit_parser.add_argument("--accumulate", action="store_true", help="accumulation finale dei riassunti")
+    submit_parser.add_argument("--poll", type=float, default=1.0)
+
+    sub.add_parser("status", help="task in coda per tipo e stato")
+
+    args = parser.parse_args()
+    if args.command == "status":
+        return status(args)
+    if args.command == "submit":
+        return asyncio.run(submit(args))
+    queue, cache = open_shared(Path(args.shared), args.journal_mode)
+    # Il limite di chiamate al modello del processo è dato dagli slot del worker
+    os.environ.setdefault("SUMMY_LLM_SLOTS", str(args.slots))
+    return asyncio.run(Worker(queue, cache, args).serve())
+
+
+if __name__ == "__main__":
+    sys.exit(main())